@@ -0,0 +1,364 @@
+"""Load test of the reply path against a fake OpenRouter and a fake homeserver.
+
+Conversations are driven through ``ChatGPTBot.on_message``, the same way
+messages arrive from Matrix: the first turn mentions the bot, the following
+ones reply to its last reply. The plugin runs unmodified with the defaults
+of base-config.yaml, talking HTTP to a fake OpenRouter API in a separate
+process, so that the CPU time of the fake server isn't counted:
+
+- /models and /models/{model}/endpoints serve a small catalog
+- /chat/completions streams a reply as SSE, after ``--ttft`` seconds and at
+  ``--tokens-per-second``. The stream is a synthetic reply, or the ``data:``
+  lines of a recorded stream given with ``--recording``
+
+The fake Matrix client keeps the sent events for get_event, records the
+edits of every reply and rejects a ``--rate-limit`` fraction of them with
+M_LIMIT_EXCEEDED.
+
+For 1, 10 and 100 concurrent conversations it reports the percentiles of the
+time to first edit (the first edit with reply text, not the model or tool
+notices), the total latency of a reply, the CPU time per reply and the
+event loop lag, sampled every 10 ms.
+
+No network access is needed. Run from the plugin directory:
+python -m benchmarks.load_test [--levels 1 10 100] [--turns 2] [--json]
+"""
+from multiprocessing import Pipe, Process
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+
+import aiohttp
+from aiohttp import web
+from mautrix.errors import MLimitExceeded
+from mautrix.types import EventType, MessageEvent, RelationType
+from mautrix.util.config import RecursiveDict
+from maubot.matrix import MaubotMessageEvent
+from ruamel.yaml import YAML
+
+from chatgpt.bot import ChatGPTBot
+from chatgpt.config import Config
+
+BOT = "@bot:example.org"
+USER = "@user{n}:example.org"
+MODEL = "openai/gpt-4o"
+MODELS = [MODEL, "openai/gpt-4o-mini", "anthropic/claude-3.5-haiku"]
+QUESTION = "What's the cheapest time to charge the car tomorrow, and why?"
+ANSWER = (
+    "Here's a summary of the **prices** for tomorrow:\n\n"
+    "1. The cheapest three-hour window is *02:00–05:00* at 1.2 c/kWh\n"
+    "2. The most expensive hour is 18:00 at 14.5 c/kWh\n\n"
+    "| Hour | Price |\n|------|-------|\n| 02:00 | 1.1 |\n| 03:00 | 1.2 |\n| 04:00 | 1.3 |\n\n"
+    "Charging overnight is cheapest because demand is low and wind power covers most of it. "
+    "Let me know if you want the hourly list or a comparison with today's prices."
+)
+# Roughly how the streamed chunks of OpenAI models split text
+TOKEN_PATTERN = re.compile(r"\s?\w{1,6}|\s?[^\w\s]|\s+")
+LAG_INTERVAL = 0.01
+
+
+def _chunk(model: str, delta: Optional[dict] = None, finish: Optional[str] = None, usage: Optional[dict] = None) -> dict:
+    return {
+        "id": "gen-load-test",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish}],
+        **({"usage": usage} if usage else {}),
+    }
+
+
+def synthetic_stream(text: str = ANSWER) -> List[dict]:
+    tokens = TOKEN_PATTERN.findall(text)
+    return ([_chunk(MODEL, {"role": "assistant", "content": ""})]
+            + [_chunk(MODEL, {"content": token}) for token in tokens]
+            + [_chunk(MODEL, {}, "stop")])
+
+
+def recorded_stream(path: str) -> List[dict]:
+    """The chunks of a stream recorded as SSE, f.ex with curl -N. The usage chunk is dropped."""
+    chunks = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith("data:") and line[5:].strip() != "[DONE]":
+                chunk = json.loads(line[5:])
+                if chunk.get("choices"):
+                    chunks.append(chunk)
+    return chunks
+
+
+class FakeOpenRouter:
+    """The parts of the OpenRouter API the plugin uses, streaming replies at a fixed token rate."""
+
+    def __init__(self, chunks: List[dict], ttft: float, ttft_jitter: float, tokens_per_second: float):
+        self.chunks = chunks
+        self.ttft = ttft
+        self.ttft_jitter = ttft_jitter
+        self.tokens_per_second = tokens_per_second
+        self.app = web.Application()
+        self.app.router.add_get("/api/v1/models", self.models)
+        self.app.router.add_get("/api/v1/models/{author}/{slug}/endpoints", self.endpoints)
+        self.app.router.add_post("/api/v1/chat/completions", self.chat_completions)
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": [{"id": model, "name": model} for model in MODELS]})
+
+    async def endpoints(self, request: web.Request) -> web.Response:
+        model = f"{request.match_info['author']}/{request.match_info['slug']}"
+        if model not in MODELS:
+            return web.json_response({"error": {"code": 404, "message": "Model not found"}}, status=404)
+        return web.json_response({"data": {"id": model, "endpoints": [{
+            "pricing": {"prompt": "0.0000025", "completion": "0.00001"},
+            "context_length": 128000,
+            "max_completion_tokens": 16384,
+            "supported_parameters": ["tools", "tool_choice", "temperature", "max_tokens", "include_reasoning"],
+        }]}})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body["model"]
+        # A rough prompt size is enough for the usage chunk
+        prompt_tokens = len(json.dumps(body["messages"])) // 4
+        completion_tokens = sum(1 for chunk in self.chunks if chunk["choices"][0]["delta"].get("content"))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "cost": prompt_tokens * 0.0000025 + completion_tokens * 0.00001}
+        await asyncio.sleep(max(self.ttft + random.uniform(-self.ttft_jitter, self.ttft_jitter), 0))
+
+        if not body.get("stream"):
+            text = "".join(chunk["choices"][0]["delta"].get("content") or "" for chunk in self.chunks)
+            return web.json_response({
+                "id": "gen-load-test", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        started = time.monotonic()
+        sent = 0
+        for chunk in self.chunks:
+            if chunk["choices"][0]["delta"].get("content"):
+                # Tokens that are due are sent together, like a provider catching up
+                delay = started + sent / self.tokens_per_second - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                sent += 1
+            await response.write(f"data: {json.dumps({**chunk, 'model': model})}\n\n".encode())
+        await response.write(f"data: {json.dumps(_chunk(model, usage=usage))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def serve(connection: Any, chunks: List[dict], ttft: float, ttft_jitter: float, tokens_per_second: float) -> None:
+    """Run the fake API in this process, sending its port through ``connection``."""
+    async def run() -> None:
+        runner = web.AppRunner(FakeOpenRouter(chunks, ttft, ttft_jitter, tokens_per_second).app,
+                               access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        connection.send(site._server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+    asyncio.run(run())
+
+
+class FakeMatrixClient:
+    """Keeps the events sent by the bot and records the edits of its replies."""
+
+    disable_replies = False
+
+    def __init__(self, latency: float = 0.02, rate_limit: float = 0.0, retry_after_ms: int = 500):
+        self.mxid = BOT
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after_ms = retry_after_ms
+        self.events: Dict[str, MessageEvent] = {}
+        # Send time and body of every edit, by the edited event
+        self.edits: Dict[str, List[tuple]] = {}
+        # The bot's reply to each event
+        self.replies: Dict[str, str] = {}
+        self.rate_limited = 0
+        self._next_id = 0
+
+    def _event(self, room_id: str, sender: str, content: dict) -> MessageEvent:
+        self._next_id += 1
+        event = MessageEvent.deserialize({
+            "type": "m.room.message", "event_id": f"$event{self._next_id}", "room_id": room_id,
+            "sender": sender, "origin_server_ts": int(time.time() * 1000), "content": content,
+        })
+        self.events[event.event_id] = event
+        return event
+
+    def user_message(self, room_id: str, sender: str, text: str, reply_to: Optional[str] = None) -> MaubotMessageEvent:
+        if reply_to is None:
+            content = {"msgtype": "m.text", "body": f"bot: {text}", "format": "org.matrix.custom.html",
+                       "formatted_body": f'<a href="https://matrix.to/#/{BOT}">bot</a>: {text}'}
+        else:
+            content = {"msgtype": "m.text", "body": text, "m.relates_to": {"m.in_reply_to": {"event_id": reply_to}}}
+        return MaubotMessageEvent(self._event(room_id, sender, content), self)
+
+    async def send_message_event(self, room_id: str, event_type: EventType, content: Any, **kwargs: Any) -> str:
+        await asyncio.sleep(self.latency)
+        event = self._event(room_id, BOT, content.serialize())
+        reply_to = content.get_reply_to()
+        if reply_to:
+            self.replies[reply_to] = event.event_id
+        return event.event_id
+
+    async def send_message(self, room_id: str, content: Any, **kwargs: Any) -> str:
+        await asyncio.sleep(self.latency)
+        edited = content.relates_to.event_id if content.relates_to.rel_type == RelationType.REPLACE else None
+        if edited and random.random() < self.rate_limit:
+            self.rate_limited += 1
+            error = MLimitExceeded(429, "Too Many Requests")
+            error.retry_after_ms = self.retry_after_ms
+            raise error
+        event = self._event(room_id, BOT, content.serialize())
+        if edited:
+            self.edits.setdefault(edited, []).append((time.monotonic(), content.body))
+        return event.event_id
+
+    async def get_event(self, room_id: str, event_id: str) -> MessageEvent:
+        await asyncio.sleep(self.latency)
+        return self.events[event_id]
+
+
+def load_config(overrides: Dict[str, Any]) -> Config:
+    yaml = YAML()
+    with open("base-config.yaml") as file:
+        base = RecursiveDict(yaml.load(file), dict)
+    config = Config(lambda: RecursiveDict({}, dict), lambda: base, lambda data: None)
+    config.load_and_update()
+    for key, value in overrides.items():
+        config[key] = value
+    return config
+
+
+def percentiles(values: List[float]) -> List[float]:
+    values = sorted(values)
+    if not values:
+        return [float("nan")] * 3
+    return [values[min(int(fraction * len(values)), len(values) - 1)] for fraction in (0.5, 0.95, 0.99)]
+
+
+async def measure_lag(lags: List[float]) -> None:
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.monotonic() - started - LAG_INTERVAL)
+
+
+async def run_level(args: argparse.Namespace, base_url: str, conversations: int) -> Dict[str, Any]:
+    client = FakeMatrixClient(latency=args.homeserver_latency, rate_limit=args.rate_limit)
+    config = load_config({
+        "api-key": "load-test",
+        "bot-name": BOT,
+        "base_url": base_url,
+        "electricity.prefetch": False,
+        "metadata_cache.persist": False,
+        "scheduler.max_concurrent": args.max_concurrent,
+        "scheduler.max_queued": max(conversations, 50),
+    })
+    async with aiohttp.ClientSession() as http:
+        bot = ChatGPTBot(client, asyncio.get_running_loop(), http, "load-test", logging.getLogger("maubot.chatgpt"),
+                         config, None, None, None, None)
+        await bot.start()
+        on_message = ChatGPTBot.on_message.__mb_passive_orig__
+        replies = []
+
+        async def conversation(n: int) -> None:
+            room_id = f"!room{n}:example.org"
+            parent = None
+            for _ in range(args.turns):
+                evt = client.user_message(room_id, USER.format(n=n), QUESTION, reply_to=parent)
+                started = time.monotonic()
+                await on_message(bot, evt, ("",))
+                ended = time.monotonic()
+                parent = client.replies.get(evt.event_id)
+                edits = client.edits.get(parent, [])
+                first = next((at for at, body in edits if not body.startswith("Using ")), None)
+                replies.append((None if first is None else first - started, ended - started, len(edits)))
+                if parent is None:
+                    return
+
+        lags: List[float] = []
+        lag_task = asyncio.create_task(measure_lag(lags))
+        cpu_started = time.process_time()
+        await asyncio.gather(*(conversation(n) for n in range(conversations)))
+        cpu = time.process_time() - cpu_started
+        lag_task.cancel()
+        await bot.stop()
+
+    first_edits = [reply[0] for reply in replies if reply[0] is not None]
+    return {
+        "conversations": conversations,
+        "replies": len(replies),
+        "first_edit": percentiles(first_edits),
+        "total": percentiles([reply[1] for reply in replies]),
+        "cpu_per_reply": cpu / max(len(replies), 1),
+        "loop_lag": percentiles(lags) + [max(lags, default=0.0)],
+        "edits_per_reply": sum(reply[2] for reply in replies) / max(len(replies), 1),
+        "rate_limited": client.rate_limited,
+        "rejected": bot.scheduler.rejected,
+    }
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    def ms(values: List[float]) -> str:
+        return "/".join(f"{value * 1000:.0f}" for value in values)
+
+    print(f"{'convs':>5} {'replies':>7}  {'first edit p50/95/99 ms':>24}  {'total p50/95/99 ms':>20}  "
+          f"{'cpu/reply ms':>12}  {'loop lag p50/95/99/max ms':>25}  {'edits':>5}  {'429s':>4}  {'busy':>4}")
+    for result in results:
+        print(f"{result['conversations']:>5} {result['replies']:>7}  {ms(result['first_edit']):>24}  "
+              f"{ms(result['total']):>20}  {result['cpu_per_reply'] * 1000:>12.1f}  "
+              f"{ms(result['loop_lag']):>25}  {result['edits_per_reply']:>5.1f}  {result['rate_limited']:>4}  "
+              f"{result['rejected']:>4}")
+
+
+async def run(args: argparse.Namespace, port: int) -> List[Dict[str, Any]]:
+    base_url = f"http://127.0.0.1:{port}/api/v1"
+    return [await run_level(args, base_url, conversations) for conversations in args.levels]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 10, 100], help="Concurrent conversations")
+    parser.add_argument("--turns", type=int, default=2, help="Replies per conversation")
+    parser.add_argument("--recording", help="SSE stream to replay instead of the synthetic reply")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Seconds to the first token")
+    parser.add_argument("--ttft-jitter", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=100)
+    parser.add_argument("--homeserver-latency", type=float, default=0.02, help="Seconds per homeserver request")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of edits rejected with a 429")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="scheduler.max_concurrent of the plugin")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--log-level", default="ERROR", help="Level of the plugin's logs")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    chunks = recorded_stream(args.recording) if args.recording else synthetic_stream()
+    parent_connection, child_connection = Pipe()
+    server = Process(target=serve, args=(child_connection, chunks, args.ttft, args.ttft_jitter,
+                                         args.tokens_per_second), daemon=True)
+    server.start()
+    try:
+        results = asyncio.run(run(args, parent_connection.recv()))
+    finally:
+        server.terminate()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
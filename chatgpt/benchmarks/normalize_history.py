@@ -0,0 +1,98 @@
+"""Prompt tokens of a reply thread with and without MessageNormalizer.
+
+The thread is shaped like one recorded from Element: every message is a reply
+to the previous one, with an <mx-reply> quote of the parent in formatted_body
+and a "> <@user>" quote in body, and the bot's replies are rendered markdown.
+
+Run from the plugin directory: python -m benchmarks.normalize_history
+"""
+import html
+import re
+import time
+
+from mautrix.types import MessageEvent
+from mautrix.util import markdown
+
+from chatgpt import context
+from chatgpt.context import TokenCounter
+from chatgpt.normalize import MessageNormalizer
+
+BOT = "@bot:example.org"
+USER = "@alice:example.org"
+ROOM = "!room:example.org"
+TURNS = 40
+
+QUESTIONS = [
+    "What's the **cheapest** time to charge the car tomorrow?",
+    "Compare these:\n\n- heat pump\n- direct electric heating\n- district heating",
+    "Can you write a `python` function that parses `2024-01-01T10:00`?",
+    "Why is that? Explain it like I'm five.",
+]
+ANSWER = (
+    "Here's a summary of the **prices**:\n\n"
+    "1. The cheapest 3 h window is *02:00–05:00* at 1.2 c/kWh\n"
+    "2. The most expensive hour is 18:00 at 14.5 c/kWh\n\n"
+    "```python\nfrom datetime import datetime\n\ndef parse(value):\n    return datetime.fromisoformat(value)\n```\n\n"
+    "> Prices include VAT.\n\nLet me know if you want the hourly list."
+)
+
+
+def recorded_thread(turns: int = TURNS) -> list:
+    events = []
+    parent = None
+    parent_body = parent_html = None
+    for i in range(turns):
+        sender = BOT if i % 2 else USER
+        text = ANSWER if i % 2 else QUESTIONS[i // 2 % len(QUESTIONS)]
+        formatted = markdown.render(text, allow_html=True)
+        if sender == USER:
+            pill = f'<a href="https://matrix.to/#/{BOT}">Bot</a>: '
+            formatted = pill + formatted
+            text = "Bot: " + text
+        content = {"msgtype": "m.text", "body": text, "format": "org.matrix.custom.html",
+                   "formatted_body": formatted}
+        if parent is not None:
+            # Clients quote the parent without its own fallback
+            quoted = "\n".join(f"> {line}" for line in f"<{parent['sender']}> {parent_body}".split("\n"))
+            content["body"] = f"{quoted}\n\n{content['body']}"
+            content["formatted_body"] = (
+                f'<mx-reply><blockquote><a href="https://matrix.to/#/{ROOM}/{parent["event_id"]}">In reply to</a> '
+                f'<a href="https://matrix.to/#/{parent["sender"]}">{html.escape(parent["sender"])}</a>'
+                f"<br>{parent_html}</blockquote></mx-reply>{content['formatted_body']}"
+            )
+            content["m.relates_to"] = {"m.in_reply_to": {"event_id": parent["event_id"]}}
+        event = {"type": "m.room.message", "event_id": f"$event{i}", "room_id": ROOM, "sender": sender,
+                 "origin_server_ts": i, "content": content}
+        events.append(event)
+        parent, parent_body, parent_html = event, text, formatted
+    return [MessageEvent.deserialize(event) for event in events]
+
+
+def legacy(event: MessageEvent) -> str:
+    """What _thread_message sent to the model before MessageNormalizer."""
+    if event.sender == BOT:
+        return event.content.body
+    pattern = re.compile(fr'<a href="https://matrix\.to/#/{re.escape(BOT)}">.*?</a>:? ?')
+    return pattern.sub("", event.content.formatted_body or event.content.body)
+
+
+def main() -> None:
+    thread = recorded_thread()
+    counter = TokenCounter()
+    old = counter.count_messages([{"role": "user", "content": legacy(event)} for event in thread])
+
+    normalizer = MessageNormalizer(BOT)
+    start = time.process_time()
+    normalized = [normalizer.normalize(event.content)[0] for event in thread]
+    elapsed = time.process_time() - start
+    new = counter.count_messages([{"role": "user", "content": text} for text in normalized])
+
+    tokenizer = "tiktoken" if context.tiktoken is not None else "estimated"
+    print(f"{len(thread)} message thread, {tokenizer} tokens")
+    print(f"raw history:        {old:6d} tokens")
+    print(f"normalized history: {new:6d} tokens ({100 - new * 100 / old:.0f}% fewer)")
+    print(f"normalization:      {elapsed / len(thread) * 1_000_000:6.0f} µs CPU/message, once per event")
+
+
+if __name__ == "__main__":
+    main()
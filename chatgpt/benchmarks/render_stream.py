@@ -0,0 +1,67 @@
+"""Per-edit rendering cost of a streamed reply: full re-render vs StreamingRenderer.
+
+Run from the plugin directory: python -m benchmarks.render_stream
+"""
+import time
+
+from mautrix.util import markdown
+
+from chatgpt.render import StreamingRenderer
+
+SECTION = """## Section {n}
+
+Here is a paragraph with **bold**, *italic*, `inline code` and a [link](https://example.com).
+It continues on a second line so that the paragraph is a bit longer than one line.
+
+1. First item of an ordered list
+2. Second item with `code`
+3. Third item
+
+- Bullet one
+- Bullet two
+
+```python
+def example_{n}(value):
+    # A code block with a blank line inside
+
+    return value * {n}
+```
+
+> A quote that ends the section.
+
+"""
+
+CHUNK = 40  # Characters per streamed chunk
+EDIT_EVERY = 10  # Chunks between edits
+SIZES = (2_000, 5_000, 10_000, 20_000, 40_000)
+
+
+def main() -> None:
+    document = "".join(SECTION.format(n=n) for n in range(200))[:SIZES[-1]]
+    renderer = StreamingRenderer()
+    full = {size: [] for size in SIZES}
+    incremental = {size: [] for size in SIZES}
+
+    for end in range(CHUNK * EDIT_EVERY, len(document) + 1, CHUNK * EDIT_EVERY):
+        text = document[:end]
+        bucket = next(size for size in SIZES if end <= size)
+
+        start = time.perf_counter()
+        expected = markdown.render(text, allow_html=True)
+        full[bucket].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        html = renderer.render(text)
+        incremental[bucket].append(time.perf_counter() - start)
+        assert html.count("<pre>") == expected.count("<pre>")
+
+    print(f"{'reply size':>12} {'full ms/edit':>14} {'incremental ms/edit':>20}")
+    for size in SIZES:
+        if not full[size]:
+            continue
+        print(f"{size:>12} {1000 * sum(full[size]) / len(full[size]):>14.3f} "
+              f"{1000 * sum(incremental[size]) / len(incremental[size]):>20.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Per-chunk CPU cost of collecting a 5,000 chunk stream: the old dict-based loop vs StreamAccumulator.
+
+Run from the plugin directory: python -m benchmarks.stream_accumulator
+"""
+import json
+import time
+
+from openai.types.chat import ChatCompletionChunk
+
+from chatgpt.stream import StreamAccumulator
+
+CHUNKS = 5000
+ROUNDS = 5
+
+
+def recorded_stream(chunks: int = CHUNKS) -> list:
+    """A stream shaped like a recorded reasoning model reply: reasoning, then content, then usage."""
+    reasoning = chunks // 4
+    raw = []
+    for i in range(chunks - 1):
+        if i < reasoning:
+            delta = {"role": "assistant", "content": None, "reasoning": f"thinking step {i}\n" if i % 10 == 0 else "hmm, "}
+        else:
+            delta = {"role": "assistant", "content": f"word{i} " if i % 20 else f"\n\nParagraph {i}. "}
+        raw.append({"id": "gen-1", "object": "chat.completion.chunk", "created": 0, "model": "test/model",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+    raw.append({"id": "gen-1", "object": "chat.completion.chunk", "created": 0, "model": "test/model",
+                "choices": [{"index": 0, "delta": {"content": ""}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": chunks, "total_tokens": 100 + chunks}})
+    return [ChatCompletionChunk.model_validate(chunk) for chunk in raw]
+
+
+def legacy(stream: list) -> str:
+    """The loop chat_gpt_request used before StreamAccumulator, minus the edits."""
+    current_content = ""
+    for chunk in stream:
+        if not isinstance(chunk, dict):
+            chunk = json.loads(chunk.model_dump_json())
+        if "choices" in chunk and chunk["choices"]:
+            delta = chunk["choices"][0].get("delta", {})
+            if "content" in delta and delta["content"] is not None:
+                current_content += delta["content"]
+            elif "tool_calls" in delta and delta["tool_calls"]:
+                current_content += json.dumps(delta["tool_calls"][0]["function"])
+            if "content" in delta and delta["content"] is not None:
+                if "accumulated_content" not in locals():
+                    accumulated_content = ""
+                if "accumulated_reasoning" not in locals():
+                    accumulated_reasoning = ""
+                accumulated_content += delta["content"]
+            else:
+                if "accumulated_reasoning" not in locals():
+                    accumulated_reasoning = ""
+                if delta.get("reasoning") is not None:
+                    accumulated_reasoning += f"{delta['reasoning']}"
+            if "accumulated_content" not in locals() or not accumulated_content:
+                preview = "*Reasoning...*<br>" + accumulated_reasoning.replace("\n", "<br>")
+            else:
+                preview = accumulated_content
+    return accumulated_content
+
+
+def accumulator(stream: list) -> str:
+    acc = StreamAccumulator()
+    for chunk in stream:
+        acc.add(chunk)
+    return acc.content
+
+
+def measure(fn, stream: list) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        fn(stream)
+        best = min(best, time.process_time() - start)
+    return best / len(stream) * 1_000_000
+
+
+def main() -> None:
+    stream = recorded_stream()
+    assert legacy(stream) == accumulator(stream)
+    old = measure(legacy, stream)
+    new = measure(accumulator, stream)
+    print(f"{len(stream)} chunks, best of {ROUNDS} runs")
+    print(f"legacy loop:       {old:8.2f} µs CPU/chunk")
+    print(f"StreamAccumulator: {new:8.2f} µs CPU/chunk ({old / new:.0f}x less)")
+
+
+if __name__ == "__main__":
+    main()
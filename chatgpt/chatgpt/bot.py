@@ -1,33 +1,61 @@
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
+from maubot.handlers import command, event, web
+from aiohttp.web import Request, Response
+from mautrix.errors import MLimitExceeded
 from mautrix.util.config import BaseProxyConfig
-from mautrix.types import MessageType, EventType, Format, TextMessageEventContent
+from mautrix.util.async_db import UpgradeTable
+from mautrix.types import (MessageType, EventType, Format, TextMessageEventContent, ReactionEvent,
+                           RedactionEvent)
 from mautrix.util import markdown
 import re
 import json
 import logging
-from typing import Tuple
+from typing import List, Optional, Tuple
+import asyncio
 import datetime
-import difflib
+import time
+import zoneinfo
 
 from .config import Config
+from .normalize import MessageNormalizer
+from .context import TokenCounter, cache_breakpoints, context_budget, pack_messages
+from .edits import EditScheduler
+from .generations import Generation, GenerationRegistry
+from .metrics import Metrics
+from .render import StreamingRenderer
+from .scheduler import QueueFull, RequestScheduler, Ticket
+from .stream import StreamAccumulator
+from .store import ReplyStore, SentEvents, ThreadMessage, ThreadStore
+from .summary import ThreadSummarizer
+from .tracing import Tracer
+from . import tracing
+from .db import upgrade_table
 from .client import OpenRouterClient, OpenRouterError
-from .tools import available_tools, function_map, vat
+from .router import LatencyRouter
+from .tools import available_tools, function_map, ToolRuntime, PriceStore, configure_electricity, configure_weather
 from .utils import (
     format_message_history,
     parse_function_call,
-    truncate_message_history,
     clean_markdown,
     format_error_message
 )
 
+SENDER_PATTERN = re.compile(r"^@([a-zA-Z0-9]+):")
+HELSINKI = zoneinfo.ZoneInfo("Europe/Helsinki")
+# Stripped from edited commands before they're used as the new query
+COMMAND_PREFIX = re.compile(r"^!(?:chatgpt|c)\s+")
+MODEL_OVERRIDE = re.compile(r"!([\w/:.-]+)")  # Match allowed model string
+STOPPED_NOTE = "*(stopped)*"
+# Kept byte-for-byte the same across requests, so that providers can cache the prompt
+# prefix. Anything that changes between requests goes into the query, the last message:
+# OpenRouter merges all system messages into the system prompt of some providers.
+SYSTEM_PROMPT = "Your role is to be a chatbot called Matrix. Prefer metric units. Do not use latex, always use markdown."
+
+
 class ChatGPTBot(Plugin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.assistant_replies = {}
-        self.max_messages = 100
         self.log = logging.getLogger("maubot.chatgpt")
-        self.log.setLevel(logging.DEBUG)
 
     async def start(self) -> None:
         self.log.info("Starting ChatGPT bot...")
@@ -39,59 +67,171 @@ class ChatGPTBot(Plugin):
             api_key=self.config["api-key"],
             site_url=self.config["site_url"],
             site_name=self.config["site_name"],
-            config=self.config
+            config=self.config,
+            database=self.database
         )
         self.log.info("OpenRouter client initialized")
+        self.router = LatencyRouter(
+            self.openrouter_client,
+            fallback_models=self.config["router.fallback_models"],
+            percentile=self.config["router.percentile"],
+            min_deadline=self.config["router.min_deadline"],
+            max_deadline=self.config["router.max_deadline"],
+            default_deadline=self.config["router.default_deadline"],
+            max_error_rate=self.config["router.max_error_rate"]
+        )
 
-        # Set global VAT rate for electricity prices
-        global vat
-        vat = self.config["vat"]
-        self.log.debug(f"Set global VAT rate to {vat}")
+        self.thread_store = ThreadStore(
+            database=self.database,
+            max_entries=self.config["thread_cache.max_entries"]
+        )
+        self.sent_events = SentEvents(
+            database=self.database,
+            max_entries=self.config["thread_cache.max_entries"]
+        )
+        self.reply_store = ReplyStore(
+            database=self.database,
+            max_bytes=self.config["reply_cache.max_memory_kb"] * 1024
+        )
+        self.edit_scheduler = EditScheduler(
+            self._edit,
+            min_interval=self.config["edits.min_interval"],
+            max_interval=self.config["edits.max_interval"],
+            growth_chars=self.config["edits.growth_chars"],
+            growth_factor=self.config["edits.growth_factor"]
+        )
+        self.scheduler = RequestScheduler(
+            max_concurrent=self.config["scheduler.max_concurrent"],
+            max_queued=self.config["scheduler.max_queued"]
+        )
+        self.generations = GenerationRegistry()
+        self.metrics = Metrics()
+        self.tracer = Tracer(
+            enabled=self.config["tracing.enabled"],
+            sample_rate=self.config["tracing.sample_rate"],
+            payloads=self.config["tracing.payloads"],
+            max_payload_chars=self.config["tracing.max_payload_chars"]
+        )
+        self.metrics.track_metadata(self.openrouter_client.metadata)
+        self.metrics.track_scheduler(self.scheduler)
+        # Compared without emoji variation selectors, clients differ in sending them
+        self.stop_reactions = {reaction.replace("\ufe0f", "") for reaction in self.config["cancel.reactions"]}
+        self.normalizer = MessageNormalizer(self.config["bot-name"])
+        self.token_counter = TokenCounter(
+            encoding=self.config["context.tokenizer"],
+            max_entries=self.config["thread_cache.max_entries"]
+        )
+        # The tool definitions are sent with every request, reserve room for them too
+        self.reserved_tokens = (self.config["context.reserve_tokens"]
+                                + self.token_counter.count_text(json.dumps(available_tools)))
+        self.summarizer = None
+        if self.config["summary.enabled"]:
+            self.summarizer = ThreadSummarizer(
+                self.openrouter_client,
+                model=self.config["summary.model"],
+                max_tokens=self.config["summary.max_tokens"],
+                database=self.database
+            )
+        self.tool_runtime = ToolRuntime(
+            function_map,
+            max_workers=self.config["tools.max_workers"],
+            default_timeout=self.config["tools.timeout"],
+            default_concurrency=self.config["tools.concurrency"],
+            limits=self.config["tools.limits"]
+        )
+        configure_weather(self.tool_runtime)
+
+        # Set up the electricity price store and VAT rate for the electricity tool
+        price_store = PriceStore(self.http, database=self.database)
+        configure_electricity(price_store, self.config["vat"])
+        self.log.debug(f"Set VAT rate for electricity prices to {self.config['vat']}")
+        self.prefetch_task = None
+        if self.config["electricity.prefetch"]:
+            publish_time = datetime.time.fromisoformat(self.config["electricity.prefetch_time"])
+            self.prefetch_task = asyncio.create_task(price_store.prefetch(publish_time))
+
+    async def stop(self) -> None:
+        self.generations.cancel_all("plugin stopped")
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+        if self.summarizer:
+            self.summarizer.close()
+        self.tool_runtime.shutdown()
+        await self.openrouter_client.close()
+        self.log.info("OpenRouter client closed")
+
+    async def _thread_message(self, event) -> ThreadMessage:
+        """Convert an event into a reply-chain entry, normalizing its content for the model."""
+        get_reply_to = getattr(event.content, "get_reply_to", None)
+        parent_id = get_reply_to() if get_reply_to else None
+        if event.type != EventType.ROOM_MESSAGE:
+            return ThreadMessage(event.event_id, event.room_id, parent_id, None, None, None)
 
-    async def get_conversation_history(self, evt: MessageEvent, event_id: str) -> list:
-        """Get the conversation history for a given event."""
-        history = []
         bot_name = self.config["bot-name"]
-        pattern = re.compile(r"^@([a-zA-Z0-9]+):")
-        userIdPattern = re.compile(fr'<a href="https://matrix\.to/#/{re.escape(bot_name)}">.*?</a>:? ?')
-
-        while event_id:
-            event = await self.client.get_event(evt.room_id, event_id)
-            if event["type"] == EventType.ROOM_MESSAGE:
-                sender_name = event["sender"]
-                match = pattern.search(sender_name)
-                filtered_name = match.group(1) if match else ""
-                role = "assistant" if sender_name == bot_name else "user"
-                if sender_name == bot_name:
-                    content = self.assistant_replies.get(event_id, event['content']['body'])
-                else:
-                    content = userIdPattern.sub('', event['content']['formatted_body'] if event['content']['formatted_body'] else event['content']['body'])
-                history.insert(0, {"role": role, "name": filtered_name, "content": content})
-
-            if event.content.get("_relates_to") and event.content["_relates_to"]["in_reply_to"].get("event_id"):
-                event_id = event["content"]["_relates_to"]["in_reply_to"]["event_id"]
-            else:
-                break
+        sender_name = event.sender
+        match = SENDER_PATTERN.search(sender_name)
+        filtered_name = match.group(1) if match else ""
+        if sender_name == bot_name:
+            role = "assistant"
+            content = await self.reply_store.get(event.event_id) or self.normalizer.normalize_event(event)[0]
+        else:
+            role = "user"
+            content = self.normalizer.normalize_event(event)[0]
+        return ThreadMessage(event.event_id, event.room_id, parent_id, role, filtered_name, content)
 
+    async def get_conversation_history(self, evt: MessageEvent, event_id: str) -> List[ThreadMessage]:
+        """Get the conversation history for a given event, oldest first.
+
+        Messages already in the thread store are not fetched again, so only the
+        part of the chain the bot hasn't seen yet costs homeserver requests.
+        """
+        history = []
+        started = time.monotonic()
+        fetches = 0
+
+        with tracing.span("reply_chain") as span:
+            while event_id:
+                chain = await self.thread_store.get_chain(event_id)
+                if chain:
+                    history.extend(message for message in chain if message.role)
+                    event_id = chain[-1].parent_id
+                    continue
+
+                fetches += 1
+                event = await self.client.get_event(evt.room_id, event_id)
+                message = await self._thread_message(event)
+                await self.thread_store.put(message)
+                if message.role:
+                    history.append(message)
+                event_id = message.parent_id
+
+            span.set(messages=len(history), fetches=fetches)
+        history.reverse()
+        self.metrics.chain_seconds.observe(time.monotonic() - started)
+        self.metrics.chain_messages.observe(len(history))
+        self.metrics.chain_fetches.observe(fetches)
         return history
 
     @command.new("chatgpt", aliases=["c"], help="Chat with ChatGPT from Matrix.")
     @command.argument("query", pass_raw=True)
     async def chat_gpt_handler(self, evt: MessageEvent, query: str) -> None:
         """Handle the chatgpt command."""
+        # Edits of a command restart its reply in on_message, from m.new_content
+        if evt.content.get_edit():
+            return
         query = query.strip()
         if not query:
             await evt.reply("Please provide a message to chat with ChatGPT.")
             return
 
-        if evt.content.get("_relates_to") and evt.content["_relates_to"]["in_reply_to"].get("event_id"):
-            in_reply_to_event_id = evt.content["_relates_to"]["in_reply_to"]["event_id"]
-            conversation_history = await self.get_conversation_history(evt, in_reply_to_event_id)
-        else:
-            conversation_history = []
+        with self.tracer.trace("reply", room_id=evt.room_id, event_id=evt.event_id, command=True):
+            in_reply_to_event_id = evt.content.get_reply_to()
+            if in_reply_to_event_id:
+                conversation_history = await self.get_conversation_history(evt, in_reply_to_event_id)
+            else:
+                conversation_history = []
 
-        event_id = await evt.reply("…", allow_html=True)
-        await self.chat_gpt_request(query, conversation_history, evt, event_id)
+            await self.schedule_request(query, conversation_history, evt)
 
     @command.passive(".*")
     async def on_message(self, evt: MessageEvent, match: Tuple[str]) -> None:
@@ -100,53 +240,156 @@ class ChatGPTBot(Plugin):
         if evt.sender == self.config["bot-name"]:
             return
 
+        # An edit restarts the reply to the edited query if it's still being generated
+        edited_id = evt.content.get_edit()
+        if edited_id:
+            generation = self.generations.get(edited_id)
+            if generation and generation.user_event_id == edited_id and generation.sender == evt.sender:
+                self.generations.cancel(edited_id, "query edited", restart_query=self._edited_query(evt.content))
+            return
+
         if evt.content.get("msgtype") == MessageType.TEXT:
-            formatted_body = evt.content.get("formatted_body", "") or evt.content["body"]
-            bot_name = self.config["bot-name"]
-            pattern = re.compile(fr'<a href="https://matrix\.to/#/{re.escape(bot_name)}">.*?</a>:? ?')
-
-            # Check if this is a reply to the bot's message
-            is_reply_to_bot = False
-            in_reply_to_event_id = None
-            if evt.content.get("_relates_to") and evt.content["_relates_to"]["in_reply_to"].get("event_id"):
-                in_reply_to_event_id = evt.content["_relates_to"]["in_reply_to"]["event_id"]
-                try:
-                    in_reply_to_event = await self.client.get_event(evt.room_id, in_reply_to_event_id)
-                    is_reply_to_bot = in_reply_to_event.sender == bot_name
-                except Exception:
-                    pass
-
-            # Check if the bot is mentioned
-            is_mentioned = bool(pattern.search(formatted_body))
+            # Decide cheaply whether the message is for the bot, this runs for every message
+            is_mentioned = self.normalizer.mentions_bot(evt.content)
+
+            # Check if this is a reply to the bot's message. Clients that send m.mentions
+            # list the sender of the parent in it, so without a mention of the bot only
+            # the events the bot sent are checked, the homeserver isn't asked.
+            in_reply_to_event_id = evt.content.get_reply_to()
+            is_reply_to_bot = bool(in_reply_to_event_id) and await self._sent_by_bot(
+                evt.room_id, in_reply_to_event_id,
+                fetch=is_mentioned or evt.content.get("m.mentions") is None
+            )
 
             # Only respond if the message is a reply to the bot or mentions it
             if not (is_reply_to_bot or is_mentioned):
                 return
 
-            # Get conversation history if this is a reply
-            conversation_history = []
-            if is_reply_to_bot and in_reply_to_event_id:
-                conversation_history = await self.get_conversation_history(evt, in_reply_to_event_id)
-
-            # Remove bot mention from the message
-            if is_mentioned:
-                query = pattern.sub('', formatted_body)
-                # Also remove any trailing colon and whitespace
-                query = re.sub(r'^\s*:?\s*', '', query)
-                # Convert any remaining HTML to plain text
-                query = re.sub(r'<[^>]+>', '', query).strip()
-            else:
-                query = evt.content["body"]
-
-            # Send the response
+            # The query is the message without the mention, reply fallback and HTML
+            query = self.normalizer.normalize_event(evt)[0]
+
+            with self.tracer.trace("reply", room_id=evt.room_id, event_id=evt.event_id, command=False):
+                # Get conversation history if this is a reply
+                conversation_history = []
+                if is_reply_to_bot and in_reply_to_event_id:
+                    conversation_history = await self.get_conversation_history(evt, in_reply_to_event_id)
+
+                # Send the response
+                await self.schedule_request(query, conversation_history, evt)
+
+    def _edited_query(self, content) -> str:
+        """The new query of an edit, from its ``m.new_content`` rather than the "* " fallback body.
+
+        mautrix usually deserializes edits with ``m.new_content`` as the content already.
+        """
+        new_content = content.get("m.new_content")
+        if new_content is not None:
+            content = (TextMessageEventContent.deserialize(new_content) if isinstance(new_content, dict)
+                       else new_content)
+        return COMMAND_PREFIX.sub("", self.normalizer.normalize(content)[0])
+
+    async def _sent_by_bot(self, room_id: str, event_id: str, fetch: bool = True) -> bool:
+        """Whether the bot sent ``event_id``.
+
+        The events the bot sent are checked first. With ``fetch``, the thread
+        store is checked too and, if the event isn't there either, it's fetched
+        from the homeserver. Only events the bot sent are stored from the fetch.
+        """
+        if await self.sent_events.contains(event_id):
+            return True
+        if not fetch:
+            return False
+        message = await self.thread_store.get(event_id)
+        if message is not None:
+            return message.role == "assistant"
+        try:
+            event = await self.client.get_event(room_id, event_id)
+        except Exception as e:
+            self.log.warning(f"Failed to fetch the parent {event_id} of a reply: {e}")
+            return False
+        if event.sender != self.config["bot-name"]:
+            return False
+        await self.thread_store.put(await self._thread_message(event))
+        await self.sent_events.add(event_id, room_id)
+        return True
+
+    async def schedule_request(self, query: str, conversation_history: List[ThreadMessage],
+                               evt: MessageEvent) -> None:
+        """Queue a chat request behind the others of the room and user, or reply that the bot is busy."""
+        try:
+            ticket = self.scheduler.enqueue(evt.room_id, evt.sender)
+        except QueueFull as e:
+            self.log.warning(f"Rejected request from {evt.sender} in {evt.room_id}: {e}")
+            self.metrics.rejected.inc()
+            await self.sent_events.add(await evt.reply(self.config["scheduler.busy_message"]), evt.room_id)
+            return
+        async with ticket:
+            await self.thread_store.put(await self._thread_message(evt))
             event_id = await evt.reply("…", allow_html=True)
-            await self.chat_gpt_request(query, conversation_history, evt, event_id)
+            await self.sent_events.add(event_id, evt.room_id)
+            generation = self.generations.register(evt.room_id, evt.event_id, event_id, evt.sender)
+            try:
+                while True:
+                    generation.task = asyncio.create_task(
+                        self._generate(ticket, generation, query, conversation_history, evt)
+                    )
+                    generation.task.add_done_callback(self._log_generation_error)
+                    await asyncio.wait([generation.task])
+                    if generation.restart_query is None:
+                        break
+                    # The query was edited, start over with the new text
+                    query, generation.reason, generation.restart_query = generation.restart_query, None, None
+                    message = await self._thread_message(evt)
+                    message.content = query
+                    await self.thread_store.put(message)
+            finally:
+                if not generation.task.done():
+                    generation.task.cancel()
+                self.generations.unregister(generation)
+
+    def _log_generation_error(self, task: asyncio.Task) -> None:
+        """Log a generation that failed outside of the error handling of chat_gpt_request."""
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f"Generating a reply failed: {task.exception()}", exc_info=task.exception())
+
+    async def _generate(self, ticket: Ticket, generation: Generation, query: str,
+                        conversation_history: List[ThreadMessage], evt: MessageEvent) -> None:
+        try:
+            with tracing.span("queue"):
+                self.metrics.queue_wait_seconds.observe(await ticket.wait())
+        except asyncio.CancelledError:
+            # Stopped while queued
+            if generation.reason and generation.restart_query is None:
+                await self._edit(evt.room_id, generation.placeholder_id, STOPPED_NOTE)
+            raise
+        with tracing.span("generate", placeholder_id=generation.placeholder_id) as span:
+            try:
+                await self.chat_gpt_request(query, conversation_history, evt, generation.placeholder_id)
+            finally:
+                if generation.reason:
+                    span.set(cancelled=generation.reason)
+
+    @event.on(EventType.ROOM_REDACTION)
+    async def on_redaction(self, evt: RedactionEvent) -> None:
+        """Stop generating a reply when its query or the reply itself is redacted."""
+        self.generations.cancel(evt.redacts, "redacted")
+
+    @event.on(EventType.REACTION)
+    async def on_reaction(self, evt: ReactionEvent) -> None:
+        """Stop generating a reply when the asker reacts to the query or the reply with a stop reaction."""
+        relates_to = evt.content.relates_to
+        if not relates_to or (relates_to.key or "").replace("\ufe0f", "") not in self.stop_reactions:
+            return
+        generation = self.generations.get(relates_to.event_id)
+        if generation and generation.sender == evt.sender:
+            self.generations.cancel(relates_to.event_id, f"stop reaction {relates_to.key}")
 
-    async def chat_gpt_request(self, query: str, conversation_history: list, evt: MessageEvent, event_id: str) -> None:
+    async def chat_gpt_request(self, query: str, conversation_history: List[ThreadMessage], evt: MessageEvent,
+                               event_id: str) -> None:
         """Process a chat request."""
-        current_content = ""
-        last_update = datetime.datetime.now()
-        update_interval = datetime.timedelta(milliseconds=1000)  # Update every 300ms at most
+        reply_text = None  # Final text of the reply without the reasoning, as stored for history
+        acc = None  # The stream being received
+        edits = self.edit_scheduler.session(evt.room_id, event_id)
 
         try:
             self.log.info(f"Processing chat request from {evt['sender']}")
@@ -154,39 +397,30 @@ class ChatGPTBot(Plugin):
 
             # Get user info
             sender_name = evt["sender"]
-            pattern = re.compile(r"^@([a-zA-Z0-9]+):")
-            match = pattern.search(sender_name)
+            match = SENDER_PATTERN.search(sender_name)
             filtered_name = match.group(1) if match else ""
             self.log.debug(f"Filtered sender name: {filtered_name}")
 
-            # Get current time in Helsinki timezone
-            utc_now = datetime.datetime.now(datetime.timezone.utc)
-            helsinki_offset = datetime.timedelta(hours=2)  # Adjust for Helsinki timezone
-            helsinki_now = utc_now.astimezone(datetime.timezone(helsinki_offset))
-            current_date = helsinki_now.strftime("%A %B %d, %Y")
-            current_time = helsinki_now.strftime("%H:%M %Z")
-
             # Prepare messages
-            messages = [
-                {"role": "system", "content": f"Your role is to be a chatbot called Matrix. Prefer metric units. Do not use latex, always use markdown. Today is {current_date} and time is {current_time}."},
-            ]
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 
             # Add conversation history if exists
             if conversation_history:
                 self.log.debug(f"Adding conversation history: {len(conversation_history)} messages")
-                messages.extend(conversation_history)
+                messages.extend(message.to_message() for message in conversation_history)
 
-            # Add the current query
-            messages.extend([{"role": "user", "name": filtered_name, "content": query}])
+            # Add the current query, prefixed with the current time in Helsinki
+            helsinki_now = datetime.datetime.now(HELSINKI)
+            messages.append({"role": "user", "name": filtered_name, "content":
+                             f"(Today is {helsinki_now:%A %B %d, %Y} and time is {helsinki_now:%H:%M %Z}.)\n\n{query}"})
             # Look for model override
-            pattern = re.compile(r"!([\w/:.-]+)")  # Match allowed model string
             override_model = None
             online_requested = False
             for message in messages:
                 content = message.get("content")
                 if not content:
                     continue
-                match = pattern.search(content)
+                match = MODEL_OVERRIDE.search(content)
                 if match:
                     raw_override = match.group(1)
                     if ":online" in raw_override:
@@ -194,14 +428,13 @@ class ChatGPTBot(Plugin):
                         raw_override = raw_override.replace(":online", "")
                     override_model = raw_override
                     self.log.info(f"Found model override: {override_model}" + (f" with :online" if online_requested else ""))
-                    message["content"] = re.sub(pattern, "", content, count=1).strip()
-                    # Fetch available models and pick the closest match
-                    all_models_json = self.openrouter_client.fetch_all_models()
-                    all_ids = [model["id"] for model in all_models_json.get("data", [])]
-                    closest_matches = difflib.get_close_matches(override_model, all_ids, n=1, cutoff=0.3)
-                    if closest_matches:
-                        self.log.info(f"Replacing override '{override_model}' with closest match '{closest_matches[0]}'")
-                        override_model = closest_matches[0]
+                    message["content"] = MODEL_OVERRIDE.sub("", content, count=1).strip()
+                    # Pick the closest match from the model catalog
+                    catalog = await self.openrouter_client.get_model_catalog()
+                    closest_match = catalog.resolve(override_model)
+                    if closest_match:
+                        self.log.info(f"Replacing override '{override_model}' with closest match '{closest_match}'")
+                        override_model = closest_match
                     else:
                         self.log.debug("No close match found for override; using provided override")
                     # If :online was requested, adjust the model name accordingly
@@ -215,172 +448,275 @@ class ChatGPTBot(Plugin):
             selected_model = override_model if override_model else self.config["model"]
             # Only add the free suffix if :online was not requested
             if not online_requested and not selected_model.endswith(":free"):
-                free_candidate = f"{selected_model}:free"
-                all_models_json = self.openrouter_client.fetch_all_models()
-                all_ids = [model["id"] for model in all_models_json.get("data", [])]
-                if free_candidate in all_ids:
-                    selected_model = free_candidate
+                catalog = await self.openrouter_client.get_model_catalog()
+                selected_model = catalog.free_variant(selected_model) or selected_model
             self.log.info(f"Using model: {selected_model}")
-            await self._edit(evt.room_id, event_id, f"Using model: {selected_model}")
+            edits.update(lambda: (f"Using model: {selected_model}", None))
 
-            # Log the full message context being sent
-            self.log.debug(f"Full message context being sent to API: {json.dumps(messages, indent=2)}")
+            # Fit the conversation into the model's context window
+            with tracing.span("fit_context"):
+                messages = await self._fit_context(messages, conversation_history, selected_model)
 
             # Create chat completion with streaming
             self.log.debug("Making streaming API request to OpenRouter...")
-            stream = self.openrouter_client.create_chat_completion(
+            breakpoints = cache_breakpoints(messages)
+            started = time.monotonic()
+            stream = await self.router.create_stream(
                 messages=messages,
                 model=selected_model,
                 temperature=0.7,
                 tools=available_tools,
-                stream=True,
-                include_reasoning=True
+                include_reasoning=True,
+                cache_breakpoints=breakpoints
             )
-
-            async def process_chunks():
-                nonlocal current_content, last_update
-                async for chunk in stream:
-                    self.log.debug(f"Received chunk: {chunk}")
-                    if not isinstance(chunk, dict):
-                        chunk = json.loads(chunk.model_dump_json())
-
-                    if "choices" in chunk and chunk["choices"]:
-                        delta = chunk["choices"][0].get("delta", {})
-                        if "content" in delta and delta["content"] is not None:
-                            current_content += delta["content"]
-                        elif "tool_calls" in delta and delta["tool_calls"]:
-                            # Append tool call details as JSON so that function call can be parsed later
-                            current_content += json.dumps(delta["tool_calls"][0]["function"])
-                        # Added support for reasoning: format as markdown italic for Matrix
-                        # Use separate accumulators for reasoning and content.
-                        if "content" in delta and delta["content"] is not None:
-                            # If content starts, append it.
-                            if "accumulated_content" not in locals():
-                                accumulated_content = ""
-                            if "accumulated_reasoning" not in locals():
-                                accumulated_reasoning = ""
-                            accumulated_content += delta["content"]
-                        else:
-                            # No content; accumulate reasoning.
-                            if "accumulated_reasoning" not in locals():
-                                accumulated_reasoning = ""
-                            if delta.get("reasoning") is not None:
-                                accumulated_reasoning += f"{delta['reasoning']}"
-
-                        # Determine what to preview:
-                        if "accumulated_content" not in locals() or not accumulated_content:
-                            # Only reasoning so far; show it as-is.
-                            preview = "*Reasoning...*<br>" + accumulated_reasoning.replace("\n", "<br>")
-                        else:
-                            # Content has started; display content normally and move reasoning into a <details> block if present.
-                            preview = accumulated_content
-                            if "accumulated_reasoning" in locals() and accumulated_reasoning:
-                                preview += f"<br><details><summary>Reasoning</summary><br>{accumulated_reasoning.replace('\n', '<br>')}<br></details>"
-
-                        now = datetime.datetime.now()
-                        if now - last_update >= update_interval and (delta.get("content") or delta.get("reasoning")):
-                            await self._edit(evt.room_id, event_id, preview)
-                            last_update = now
+            if stream.model != selected_model:
+                # A fallback answered faster, continue with it in the tool rounds
+                selected_model = stream.model
+                edits.update(lambda: (f"Using model: {selected_model}", None))
+
+            async def process_chunks(started: float) -> StreamAccumulator:
+                nonlocal reply_text, acc
+                renderer = StreamingRenderer()
+                acc = StreamAccumulator()
+                ttft = None
+
+                def preview() -> Tuple[str, str]:
+                    # Built only when an edit is actually sent. The HTML is rendered
+                    # incrementally, the final edit below renders the complete text once.
+                    if not acc.content:
+                        # Only reasoning so far; show it as-is.
+                        return f"Reasoning...\n{acc.reasoning}", f"<p><em>Reasoning...</em><br>{acc.reasoning_html}</p>"
+                    # Content has started; display content normally and move reasoning into a <details> block if present.
+                    preview_html = renderer.render(acc.content)
+                    if acc.reasoning_html:
+                        preview_html += f"<details><summary>Reasoning</summary>{acc.reasoning_html}</details>"
+                    return acc.content, preview_html
+
+                # Closing the stream closes its connection, also when the generation is cancelled
+                with tracing.span("stream", model=stream.model) as span:
+                    async with stream:
+                        async for chunk in stream:
+                            if acc.add(chunk):
+                                if ttft is None:
+                                    ttft = time.monotonic() - started
+                                edits.update(preview)
+                    span.set(ttft=round(ttft, 3) if ttft is not None else None, chunks=acc.chunks, content_chars=len(acc.content),
+                             reasoning_chars=len(acc.reasoning), tool_calls=len(acc.tool_calls()))
+                self._log_usage(stream.model, acc, ttft, time.monotonic() - started)
 
                 # Final update with complete content
-                if ("accumulated_content" in locals() and accumulated_content) or ("accumulated_reasoning" in locals() and accumulated_reasoning):
-                    if "accumulated_content" in locals() and accumulated_content:
-                        final = accumulated_content
-                        if "accumulated_reasoning" in locals() and accumulated_reasoning:
-                            final += f"<br><details><summary>Reasoning</summary><br>{accumulated_reasoning.replace('\n', '<br>')}<br></details>"
+                if acc.content or acc.reasoning:
+                    if acc.content:
+                        final = acc.content
+                        reply_text = acc.content
+                        if acc.reasoning:
+                            reasoning_text = acc.reasoning.replace("\n", "<br>")
+                            final += f"<br><details><summary>Reasoning</summary><br>{reasoning_text}<br></details>"
                     else:
-                        final = accumulated_reasoning.replace("\n", "<br>")
-                    self.log.debug(f"Final streaming complete content: {final}")
-                    await self._edit(evt.room_id, event_id, final)
+                        final = acc.reasoning.replace("\n", "<br>")
+                        reply_text = acc.reasoning
+                    self.log.debug(f"Stream complete after {acc.chunks} chunks, {len(final)} characters")
+                    await edits.flush(final)
+                return acc
 
             # Process the initial response
-            await process_chunks()
-
-            # Check for function calls in the complete response
-            try:
-                function_call = json.loads(current_content)
-                if not (isinstance(function_call, dict) and "name" in function_call and "arguments" in function_call):
-                    function_call = None
-            except json.JSONDecodeError:
-                function_call = None
-            if function_call:
-                self.log.info(f"Function call detected: {function_call['name']}")
-                # Get the function and its arguments
-                func_name = function_call["name"]
-                func_args = function_call["arguments"]
-                # Convert string arguments to dict if necessary
-                if isinstance(func_args, str):
-                    try:
-                        func_args = json.loads(func_args)
-                    except Exception:
-                        func_args = {"raw": func_args}
-                self.log.debug(f"Function arguments: {json.dumps(func_args, indent=2)}")
-                if func_name in function_map:
-                    # Add user info to arguments
-                    func_args["user"] = sender_name
-                    # Execute the function
-                    self.log.debug(f"Executing function {func_name} with args: {json.dumps(func_args, indent=2)}")
-                    function_response = function_map[func_name](**func_args)
-                    self.log.debug(f"Function response: {function_response}")
-
-                    # Add function result to messages
-                    messages.append({
-                        "role": "assistant",
-                        "content": current_content,
-                        "tool_calls": [{
-                            "id": "1",  # We don't have a real ID in streaming mode
-                            "type": "function",
-                            "function": {
-                                "name": func_name,
-                                "arguments": json.dumps(func_args)
-                            }
-                        }]
-                    })
-                    messages.append({
-                        "role": "tool",
-                        "content": str(function_response),
-                        "tool_call_id": "1"
-                    })
-
-                    # Get a new streaming response that includes the function result
-                    self.log.debug("Making second streaming API request with function results...")
-                    current_content = ""  # Reset content for the second response
-                    stream = self.openrouter_client.create_chat_completion(
-                        messages=messages,
-                        model=selected_model,
-                        temperature=0.7,
-                        stream=True
-                    )
-                    await process_chunks()
+            acc = await process_chunks(started)
+
+            # Run the requested tools concurrently and continue the conversation with their
+            # results, for up to max_tool_rounds rounds. In the last round the model can't
+            # call tools, so it has to answer. The tools are still sent to keep the cached
+            # prompt prefix intact.
+            max_tool_rounds = self.config["max_tool_rounds"]
+            tool_round = 0
+            while tool_round < max_tool_rounds:
+                tool_calls = acc.tool_calls()
+                if not tool_calls:
+                    break
+                tool_round += 1
+                names = ", ".join(dict.fromkeys(call["function"]["name"] for call in tool_calls))
+                self.log.info(f"Tool round {tool_round}: {names}")
+                edits.update(lambda: (f"Using tools: {names}", None))
+
+                results = await asyncio.gather(*(self._run_tool(call, sender_name) for call in tool_calls))
+                messages.append({"role": "assistant", "content": acc.content or None, "tool_calls": tool_calls})
+                for call, result in zip(tool_calls, results):
+                    messages.append({"role": "tool", "tool_call_id": call["id"], "content": result})
+
+                # Get a new streaming response that includes the tool results
+                self.log.debug(f"Making streaming API request with {len(tool_calls)} tool results...")
+                started = time.monotonic()
+                stream = await self.router.create_stream(
+                    messages=messages,
+                    model=selected_model,
+                    temperature=0.7,
+                    tools=available_tools,
+                    tool_choice=None if tool_round < max_tool_rounds else "none",
+                    cache_breakpoints=breakpoints + [len(messages) - 1]
+                )
+                acc = await process_chunks(started)
 
         except OpenRouterError as e:
+            tracing.current_span().fail(e)
             self.log.error(f"OpenRouter API Error: {str(e)}", exc_info=True)
             error_msg = f"OpenRouter API Error: {str(e)}"
             self.log.debug(f"Sending error message to user: {error_msg}")
-            await self._edit(evt.room_id, event_id, error_msg)
+            await edits.flush(error_msg)
+            reply_text = error_msg
         except Exception as e:
+            tracing.current_span().fail(e)
             self.log.error(f"Unexpected error: {str(e)}", exc_info=True)
             error_msg = f"Error: {str(e)}"
             self.log.debug(f"Sending error message to user: {error_msg}")
-            await self._edit(evt.room_id, event_id, error_msg)
+            await edits.flush(error_msg)
+            reply_text = error_msg
+        except asyncio.CancelledError:
+            generation = self.generations.get(event_id)
+            if generation is None or generation.reason is None:
+                raise
+            reply_text = None
+            if generation.restart_query is None:
+                # Stopped by the user, keep what was generated so far
+                text = acc.content if acc else ""
+                await edits.flush(f"{text}\n\n{STOPPED_NOTE}" if text else STOPPED_NOTE)
+                reply_text = text or None
+        finally:
+            await edits.close()
+            self.metrics.edits_per_reply.observe(edits.edits)
+            tracing.current_span().set(edits=edits.edits)
+
+        # Remember the reply so that follow-ups don't have to fetch it from the homeserver
+        if reply_text is not None:
+            await self.reply_store.put(event_id, evt.room_id, reply_text)
+            match = SENDER_PATTERN.search(self.config["bot-name"])
+            await self.thread_store.put(ThreadMessage(
+                event_id, evt.room_id, evt.event_id, "assistant", match.group(1) if match else "", reply_text
+            ))
+
+    async def _context_budget(self, model: str) -> int:
+        """Tokens of conversation to send to ``model``, based on its context length."""
+        try:
+            context_length = (await self.openrouter_client.get_model_info(model)).context_length
+        except Exception as e:
+            self.log.warning(f"Failed to get the context length of {model}, using the default: {e}")
+            context_length = None
+        return context_budget(
+            context_length,
+            default_length=self.config["context.default_length"],
+            max_tokens=self.config["context.max_tokens"],
+            reserve_tokens=self.reserved_tokens
+        )
+
+    async def _fit_context(self, messages: list, thread: List[ThreadMessage], model: str) -> list:
+        """Fit ``messages`` (system prompt, ``thread`` and query) into the context of ``model``.
+
+        The oldest turns are replaced by the thread's summary as far as it reaches,
+        and the rest that don't fit are dropped and added to the summary.
+        """
+        head, history, tail = messages[:1], messages[1:-1], messages[-1:]
+        summary = None
+        covered = 0
+        if self.summarizer and thread:
+            summary = await self.summarizer.get(thread[0].event_id)
+            covered = summary.covered(thread) if summary else 0
+            if covered:
+                head.append(summary.to_message())
+        packed = pack_messages(head + history[covered:] + tail, await self._context_budget(model),
+                               self.token_counter)
+        dropped = len(head) + len(history) - covered + len(tail) - len(packed)
+        tracing.current_span().set(history=len(history), summarized=covered, dropped=dropped)
+        if dropped and self.summarizer:
+            self.summarizer.extend_in_background(thread[0].event_id, summary if covered else None,
+                                                 thread[covered:covered + dropped])
+        return packed
+
+    def _log_usage(self, model: str, acc: StreamAccumulator, ttft: Optional[float], duration: float) -> None:
+        """Log and record the token usage, prompt cache hits and cost reported at the end of a stream,
+        and its speed. ``duration`` is the time from sending the request to the end of the stream.
+        """
+        usage = acc.usage
+        ttft_text = f"{ttft:.2f}s" if ttft is not None else "n/a"
+        if ttft is not None:
+            self.metrics.ttft_seconds.observe(ttft, model)
+        if usage is None:
+            self.log.info(f"{model}: no usage reported, TTFT {ttft_text}")
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        cost = getattr(usage, "cost", None)
+        self.metrics.prompt_tokens.inc(usage.prompt_tokens or 0, model)
+        self.metrics.cached_tokens.inc(cached, model)
+        self.metrics.completion_tokens.inc(usage.completion_tokens or 0, model)
+        if cost is not None:
+            self.metrics.cost.inc(cost, model)
+        if ttft is not None and usage.completion_tokens and duration > ttft:
+            self.metrics.tokens_per_second.observe(usage.completion_tokens / (duration - ttft), model)
+        self.log.info(
+            f"{model}: {usage.prompt_tokens} prompt tokens ({cached} cached), "
+            f"{usage.completion_tokens} completion tokens"
+            + (f", cost {cost}" if cost is not None else "")
+            + f", TTFT {ttft_text}"
+        )
 
-    async def _edit(self, room_id: str, event_id: str, text: str) -> None:
-        """Edit a message with new content."""
+    async def _run_tool(self, tool_call: dict, sender_name: str) -> str:
+        """Execute one tool call, returning its result as the content of a tool message."""
+        func_name = tool_call["function"]["name"]
+        try:
+            arguments = tool_call["function"]["arguments"]
+            func_args = json.loads(arguments) if arguments else {}
+        except json.JSONDecodeError as e:
+            return json.dumps({"error": {"tool": func_name, "type": "invalid_arguments", "message": str(e)}})
+        if not isinstance(func_args, dict):
+            return json.dumps({"error": {"tool": func_name, "type": "invalid_arguments",
+                                         "message": f"Expected a JSON object, got {type(func_args).__name__}"}})
+        # Add user info to arguments
+        func_args["user"] = sender_name
+        self.log.debug(f"Executing function {func_name} with args: {func_args}")
+        started = time.monotonic()
+        with tracing.span("tool", tool=func_name) as span:
+            span.capture("arguments", lambda: func_args)
+            result = await self.tool_runtime.call(func_name, func_args)
+            # The runtime reports failures and timeouts as an error object for the model
+            status = "error" if result.startswith('{"error"') else "ok"
+            span.set(status=status, result_chars=len(result))
+            if status == "error":
+                span.capture("result", lambda: result)
+        # Names the model made up would each become a series of their own
+        tool = func_name if func_name in function_map else "unknown"
+        self.metrics.tool_seconds.observe(time.monotonic() - started, tool, status)
+        return result
+
+    async def _edit(self, room_id: str, event_id: str, text: str, html: Optional[str] = None) -> None:
+        """Edit a message with new content, rendering the markdown unless the HTML is given."""
         content = TextMessageEventContent(
             msgtype=MessageType.NOTICE,
             body=text,
             format=Format.HTML,
-            formatted_body=markdown.render(text, allow_html=True)
+            formatted_body=markdown.render(text, allow_html=True) if html is None else html
         )
         content.set_edit(event_id)
-        await self.client.send_message(room_id, content)
-        self.assistant_replies[event_id] = text
-
-        # Maintain message limit
-        if len(self.assistant_replies) > self.max_messages:
-            oldest_event_id = next(iter(self.assistant_replies))
-            del self.assistant_replies[oldest_event_id]
+        started = time.monotonic()
+        try:
+            await self.client.send_message(room_id, content)
+        except MLimitExceeded:
+            self.metrics.rate_limited.inc()
+            raise
+        self.metrics.edit_seconds.observe(time.monotonic() - started)
+
+    @web.get("/metrics")
+    async def metrics_handler(self, request: Request) -> Response:
+        """Serve the metrics in the Prometheus text format."""
+        token = self.config["metrics.token"]
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return Response(status=401, text="Unauthorized")
+        return Response(
+            text=self.metrics.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
 
     @classmethod
     def get_config_class(cls) -> type[BaseProxyConfig]:
         return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
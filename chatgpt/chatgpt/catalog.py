@@ -0,0 +1,79 @@
+from typing import Dict, List, Optional, Set
+import difflib
+
+
+class ModelCatalog:
+    """Indexed snapshot of the OpenRouter model list.
+
+    Built once per refresh period. Holds a set of ids for O(1) variant checks
+    (``:free``, ``:online``) and a trigram index, so fuzzy resolution of a
+    ``!model`` override only compares against ids sharing trigrams with it.
+    """
+
+    # How many of the best trigram candidates are ranked with difflib
+    CANDIDATES = 50
+    # Same cutoff the override lookup used against the whole catalog
+    CUTOFF = 0.3
+    MAX_MEMO = 1024
+
+    def __init__(self, models_json: dict):
+        self.ids: List[str] = [model["id"] for model in models_json.get("data", []) if model.get("id")]
+        self.id_set: Set[str] = set(self.ids)
+        # Name without the vendor prefix, e.g. "gpt-4o" -> "openai/gpt-4o". First one wins.
+        self._by_name: Dict[str, str] = {}
+        self._trigrams: Dict[str, List[int]] = {}
+        self._memo: Dict[str, Optional[str]] = {}
+        for index, model_id in enumerate(self.ids):
+            self._by_name.setdefault(model_id.rsplit("/", 1)[-1].lower(), model_id)
+            for gram in self._grams(model_id):
+                self._trigrams.setdefault(gram, []).append(index)
+
+    @staticmethod
+    def _grams(text: str) -> Set[str]:
+        text = f" {text.lower()} "
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self.id_set
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def resolve(self, query: str) -> Optional[str]:
+        """Find the model id closest to ``query``, or None if nothing is close enough.
+
+        Results are memoized for the lifetime of the catalog.
+        """
+        try:
+            return self._memo[query]
+        except KeyError:
+            pass
+        result = self._resolve(query)
+        if len(self._memo) >= self.MAX_MEMO:
+            self._memo.clear()
+        self._memo[query] = result
+        return result
+
+    def _resolve(self, query: str) -> Optional[str]:
+        if query in self.id_set:
+            return query
+        by_name = self._by_name.get(query.lower())
+        if by_name:
+            return by_name
+
+        scores: Dict[int, int] = {}
+        for gram in self._grams(query):
+            for index in self._trigrams.get(gram, ()):
+                scores[index] = scores.get(index, 0) + 1
+        if not scores:
+            return None
+        best = sorted(scores, key=scores.__getitem__, reverse=True)[:self.CANDIDATES]
+        matches = difflib.get_close_matches(query, [self.ids[i] for i in best], n=1, cutoff=self.CUTOFF)
+        return matches[0] if matches else None
+
+    def free_variant(self, model_id: str) -> Optional[str]:
+        """Get the ``:free`` variant of a model if the catalog has one."""
+        if model_id.endswith(":free"):
+            return model_id
+        candidate = f"{model_id}:free"
+        return candidate if candidate in self.id_set else None
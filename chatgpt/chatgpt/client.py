@@ -1,96 +1,172 @@
-from openai import OpenAI
-from typing import Dict, List, Optional, Any
+from openai import AsyncOpenAI
+from typing import Dict, List, Optional, Any, Awaitable, Callable, Sequence
+import asyncio
+import fnmatch
 import json
 import logging
-import requests
-from functools import lru_cache
-import asyncio  # new import
+import random
+import time
+import httpx
+
+from .catalog import ModelCatalog
+from .metadata import ModelInfo, ModelMetadataCache
+from . import tracing
+
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_CACHE_CONTROL_PATTERNS = ["anthropic/*", "google/gemini-*"]
+
+
+def with_cache_control(messages: List[Dict[str, Any]], breakpoints: Sequence[int]) -> List[Dict[str, Any]]:
+    """Copy ``messages`` with an ephemeral cache_control breakpoint on the given messages.
+
+    The content of a message with a breakpoint becomes a list of one text part,
+    the only form that can carry cache_control. Messages without text are skipped.
+    """
+    messages = list(messages)
+    for index in breakpoints:
+        message = messages[index]
+        content = message.get("content")
+        if isinstance(content, str) and content:
+            messages[index] = {**message, "content": [
+                {"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}
+            ]}
+    return messages
+
 
 class OpenRouterClient:
-    def __init__(self, api_key: str, site_url: str, site_name: str, config: dict):
+    def __init__(self, api_key: str, site_url: str, site_name: str, config: dict, database: Any = None):
         """Initialize the OpenRouter client with the necessary configuration."""
         self.log = logging.getLogger("maubot.chatgpt.client")
-        self.log.setLevel(logging.DEBUG)
         self.log.info("Initializing OpenRouter client")
         self.api_key = api_key
         self.config = config
-        self._capabilities_cache = {}  # In-memory cache for model capabilities
-        self._pricing_cache = {}  # In-memory cache for model pricing
-        self._all_models = None   # Cache for all models
-
-        self.client = OpenAI(
+        self._catalog: Optional[_CatalogSnapshot] = None  # Model list and its index
+        self._inflight: Dict[str, asyncio.Task] = {}  # Metadata fetches in progress, by key
+        self.metadata = ModelMetadataCache(
+            fetch=self._fetch_endpoints,
+            ttl=config.get("metadata_cache.ttl", 3600),
+            max_stale=config.get("metadata_cache.max_stale", 86400),
+            database=database if config.get("metadata_cache.persist", True) else None,
+        )
+        self.base_url = (config.get("base_url", None) or DEFAULT_BASE_URL).rstrip("/")
+
+        # One pooled keep-alive connection pool to the API base URL, shared by all
+        # concurrent streams. Streams can stay open for minutes, so only the connect
+        # and pool waits are bounded tightly.
+        max_connections = config.get("max_connections", 100)
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            ),
+            timeout=httpx.Timeout(config.get("request_timeout", 300), connect=10.0, pool=30.0),
+        )
+        self.client = AsyncOpenAI(
             api_key=api_key,
-            base_url="https://openrouter.ai/api/v1",
+            base_url=self.base_url,
             default_headers={
                 "HTTP-Referer": site_url,
                 "X-Title": site_name
-            }
+            },
+            http_client=self.http,
         )
 
+    async def close(self) -> None:
+        """Close the pooled HTTP connections."""
+        await self.client.close()
+
     def _get_cache_key(self, model: str) -> str:
         """Generate a cache key for model capabilities."""
         return model
 
-    def check_model_capabilities(self, model: str) -> Dict[str, bool]:
-        """Check model capabilities using OpenRouter's API with caching.
+    async def _get_json(self, url: str) -> Any:
+        """GET a JSON document from the API with a timeout and retry/backoff.
+
+        Transport errors, 429 and 5xx responses are retried with exponential
+        backoff. Other HTTP errors are raised immediately as httpx.HTTPStatusError.
+        """
+        attempts = self.config.get("metadata_retries", 3) + 1
+        delay = 0.5
+        for attempt in range(1, attempts + 1):
+            try:
+                response = await self.http.get(
+                    url,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    timeout=self.config.get("metadata_timeout", 10),
+                )
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                if (status != 429 and status < 500) or attempt == attempts:
+                    raise
+                self.log.warning(f"GET {url} returned {status}, retrying in {delay:.1f}s")
+            except httpx.TransportError as e:
+                if attempt == attempts:
+                    raise
+                self.log.warning(f"GET {url} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay *= 2
+
+    async def _single_flight(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Run ``fetch`` once for concurrent callers with the same key.
+
+        Callers that arrive while a fetch for ``key`` is in flight wait for that
+        fetch instead of starting their own.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so that one cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def _fetch_endpoints(self, model: str) -> dict:
+        """Fetch the endpoint list of a model."""
+        return await self._single_flight(
+            f"endpoints:{model}",
+            lambda: self._get_json(f"{self.base_url}/models/{model}/endpoints"),
+        )
+
+    async def get_model_info(self, model: str) -> ModelInfo:
+        """Get pricing, tool support, context length and other endpoint metadata of a model.
 
         Args:
             model: The model identifier (e.g., "openai/gpt-4", "anthropic/claude-3-sonnet")
 
         Returns:
-            Dictionary of capabilities (e.g., {"tools": True})
+            The cached or freshly fetched ModelInfo
+
+        Raises:
+            httpx.HTTPError: If the metadata couldn't be fetched and nothing is cached
         """
-        cache_key = self._get_cache_key(model)
+        return await self.metadata.get(self._get_cache_key(model))
 
-        # Check in-memory cache first
-        if cache_key in self._capabilities_cache:
-            self.log.debug(f"Cache hit for model capabilities: {model}")
-            return self._capabilities_cache[cache_key]
+    async def check_model_capabilities(self, model: str) -> Dict[str, bool]:
+        """Check model capabilities using OpenRouter's API with caching.
 
-        self.log.debug(f"Cache miss for model capabilities: {model}")
+        Args:
+            model: The model identifier (e.g., "openai/gpt-4", "anthropic/claude-3-sonnet")
+
+        Returns:
+            Dictionary of capabilities (e.g., {"tools": True})
+        """
         try:
-            self.log.debug(f"Checking capabilities for model: {model}")
-            response = requests.get(
-                f"https://openrouter.ai/api/v1/models/{model}/endpoints",
-                headers={"Authorization": f"Bearer {self.api_key}"}
-            )
-            response.raise_for_status()
-            endpoint_data = response.json()
-
-            # Log endpoint information for debugging
-            self.log.debug(f"Endpoint info: {json.dumps(endpoint_data, indent=2)}")
-
-            # Check if any endpoint supports tools
-            supports_tools = False
-            if "data" in endpoint_data and "endpoints" in endpoint_data["data"]:
-                for endpoint in endpoint_data["data"]["endpoints"]:
-                    if "supported_parameters" in endpoint and "tools" in endpoint["supported_parameters"]:
-                        supports_tools = True
-                        break
-
-            self.log.debug(f"Model {model} tools support: {supports_tools}")
-
-            # Cache the result
-            capabilities = {"tools": supports_tools}
-            self._capabilities_cache[cache_key] = capabilities
-            self.log.debug(f"Cached capabilities for {model}")
-
-            return capabilities
-
-        except requests.exceptions.RequestException as e:
+            info = await self.get_model_info(model)
+        except httpx.HTTPError as e:
+            # Default to no capabilities, the failure is not cached
             self.log.error(f"Error checking model capabilities: {str(e)}", exc_info=True)
-            if e.response is not None and e.response.status_code == 404:
-                # If we get a 404, the model doesn't exist or doesn't support tools
-                capabilities = {"tools": False}
-                self._capabilities_cache[cache_key] = capabilities
-                return capabilities
-            # For other errors, default to no capabilities but don't cache
             return {"tools": False}
         except Exception as e:
             self.log.error(f"Unexpected error checking model capabilities for model {model}: {str(e)}", exc_info=True)
             raise OpenRouterError(f"Model {model} not found due to error: {str(e)}")
 
-    def check_model_pricing(self, model: str) -> Dict[str, bool]:
+        self.log.debug(f"Model {model} tools support: {info.supports_tools}")
+        return {"tools": info.supports_tools}
+
+    async def check_model_pricing(self, model: str) -> Dict[str, bool]:
         """Check if model's price is within allowed limits.
 
         Args:
@@ -99,74 +175,28 @@ class OpenRouterClient:
         Returns:
             Dictionary with pricing info and whether model is allowed
         """
-        cache_key = self._get_cache_key(model)
-
-        # Check in-memory cache first
-        if cache_key in self._pricing_cache:
-            self.log.debug(f"Cache hit for model pricing: {model}")
-            return self._pricing_cache[cache_key]
-
-        self.log.debug(f"Cache miss for model pricing: {model}")
         try:
-            self.log.debug(f"Checking pricing for model: {model}")
-            response = requests.get(
-                f"https://openrouter.ai/api/v1/models/{model}/endpoints",
-                headers={"Authorization": f"Bearer {self.api_key}"}
-            )
-            response.raise_for_status()
-            endpoint_data = response.json()
-
-            # Log endpoint information for debugging
-            self.log.debug(f"Endpoint info: {json.dumps(endpoint_data, indent=2)}")
-
-            # Get the lowest prompt price from all endpoints
-            min_prompt_price = float('inf')
-            if "data" in endpoint_data and "endpoints" in endpoint_data["data"]:
-                for endpoint in endpoint_data["data"]["endpoints"]:
-                    if "pricing" in endpoint and "prompt" in endpoint["pricing"]:
-                        try:
-                            price = float(endpoint["pricing"]["prompt"])
-                            min_prompt_price = min(min_prompt_price, price)
-                        except (ValueError, TypeError):
-                            continue
-
-            # Check if price is within allowed limit
-            max_price = self.config.get("max_price_per_token", 0.000005)
-            is_allowed = min_prompt_price <= max_price
-
-            self.log.debug(f"Model {model} price: {min_prompt_price}, allowed: {is_allowed}")
-
-            # Cache the result
-            result = {
-                "price_per_token": min_prompt_price,
-                "is_allowed": is_allowed
-            }
-            self._pricing_cache[cache_key] = result
-            self.log.debug(f"Cached pricing for {model}")
-
-            return result
-
-        except requests.exceptions.RequestException as e:
-            self.log.error(f"Error checking model pricing: {str(e)}", exc_info=True)
-            if e.response is not None and e.response.status_code == 404:
-                # If we get a 404, the model doesn't exist
-                result = {"price_per_token": float('inf'), "is_allowed": False}
-                self._pricing_cache[cache_key] = result
-                return result
-            # For other errors, default to not allowed but don't cache
-            return {"price_per_token": float('inf'), "is_allowed": False}
+            info = await self.get_model_info(model)
         except Exception as e:
-            self.log.error(f"Unexpected error checking model pricing: {str(e)}", exc_info=True)
-            # Default to not allowed if check fails, but don't cache
+            # Default to not allowed if check fails, the failure is not cached
+            self.log.error(f"Error checking model pricing: {str(e)}", exc_info=True)
             return {"price_per_token": float('inf'), "is_allowed": False}
 
+        # Check if price is within allowed limit
+        max_price = self.config.get("max_price_per_token", 0.000005)
+        is_allowed = info.prompt_price <= max_price
+        self.log.debug(f"Model {model} price: {info.prompt_price}, allowed: {is_allowed}")
+        return {
+            "price_per_token": info.prompt_price,
+            "is_allowed": is_allowed
+        }
+
     def clear_caches(self) -> None:
         """Clear all caches."""
         self.log.info("Clearing all caches")
-        self._capabilities_cache.clear()
-        self._pricing_cache.clear()
+        self.metadata.clear()
 
-    def create_chat_completion(
+    async def create_chat_completion(
         self,
         messages: List[Dict[str, str]],
         model: str,
@@ -177,6 +207,7 @@ class OpenRouterClient:
         stream: bool = False,
         include_reasoning: bool = False,
         logprobs: bool = False,
+        cache_breakpoints: Sequence[int] = (),
     ) -> Any:
         """
         Create a chat completion using the OpenRouter API.
@@ -189,91 +220,121 @@ class OpenRouterClient:
             tools: Optional list of function tools
             tool_choice: Optional tool choice configuration
             stream: Optional flag to enable streaming responses
+            cache_breakpoints: Indices of messages that end a prefix worth caching, used
+                for models that need explicit cache_control breakpoints
 
         Returns:
-            The API response as a dictionary or an async generator for streaming
+            The API response as a dictionary or an async iterator of chunks for streaming
 
         Raises:
             OpenRouterError: If the model is not allowed or other API errors occur
         """
-        try:
-            self.log.info(f"Creating chat completion with model: {model}")
-
-            # Check if model is allowed based on pricing
-            pricing_info = self.check_model_pricing(model)
-            if not pricing_info["is_allowed"]:
-                raise OpenRouterError(f"Model {model} exceeds maximum allowed price per token ({pricing_info['price_per_token']} > {self.config.get('max_price_per_token', 0.000005)})")
-
-            # Check if model supports tools before including them
-            capabilities = self.check_model_capabilities(model)
-            if tools and not capabilities["tools"]:
-                self.log.debug(f"Model {model} does not support tools, excluding them from request")
-                tools = None
-
-            # Prepare the request parameters
-            params = {
-                "model": model,
-                "messages": messages,
-                "temperature": temperature,
-                "extra_body": {"include_reasoning": include_reasoning, "logprobs": logprobs},
-            }
-
-            # Add optional parameters if provided
-            if max_tokens is not None:
-                params["max_tokens"] = max_tokens
-            if tools is not None:
-                params["tools"] = tools
-            if tool_choice is not None:
-                params["tool_choice"] = tool_choice
-            if stream:
-                params["stream"] = True
-
-            self.log.debug(f"Request parameters: {json.dumps(params, indent=2)}")
-
-            # Make the API call
-            self.log.debug("Making API call to OpenRouter")
-            response = self.client.chat.completions.create(**params)
-
-            if stream:
-                # Wrap synchronous iterator into an async generator
-                async def async_stream():
-                    for chunk in response:
-                        yield chunk
-                return async_stream()
-            else:
-                try:
-                    self.log.debug(f"Raw response type: {type(response)}")
-                    raw_response = response.model_dump()
-                    self.log.debug(f"Raw response dump: {json.dumps(raw_response, indent=2)}")
-                except Exception as dump_error:
-                    self.log.error(f"Error dumping response: {dump_error}")
-                    self.log.debug(f"Raw response: {response}")
-                response_dict = json.loads(response.model_dump_json())
-                self.log.debug(f"Processed response: {json.dumps(response_dict, indent=2)}")
-                if not response_dict.get("choices"):
-                    self.log.error(f"No choices in response. Full response: {json.dumps(response_dict, indent=2)}")
-                    raise OpenRouterError(f"Model {model} returned no choices in response. This might indicate an issue with the model or the API.")
-                return response_dict
+        with tracing.span("openrouter.request", model=model, stream=stream, messages=len(messages)) as span:
+            try:
+                self.log.info(f"Creating chat completion with model: {model}")
+
+                # Check if model is allowed based on pricing
+                pricing_info = await self.check_model_pricing(model)
+                if not pricing_info["is_allowed"]:
+                    raise OpenRouterError(f"Model {model} exceeds maximum allowed price per token ({pricing_info['price_per_token']} > {self.config.get('max_price_per_token', 0.000005)})")
+
+                # Check if model supports tools before including them
+                capabilities = await self.check_model_capabilities(model)
+                if tools and not capabilities["tools"]:
+                    self.log.debug(f"Model {model} does not support tools, excluding them from request")
+                    tools = None
+                    tool_choice = None
+
+                cache_control = bool(cache_breakpoints) and self.supports_cache_control(model)
+                if cache_control:
+                    messages = with_cache_control(messages, cache_breakpoints)
+
+                # Prepare the request parameters. Usage accounting adds the cached and total
+                # cost of the request to the usage of the response.
+                params = {
+                    "model": model,
+                    "messages": messages,
+                    "temperature": temperature,
+                    "extra_body": {"include_reasoning": include_reasoning, "logprobs": logprobs,
+                                   "usage": {"include": True}},
+                }
+
+                # Add optional parameters if provided
+                if max_tokens is not None:
+                    params["max_tokens"] = max_tokens
+                if tools is not None:
+                    params["tools"] = tools
+                if tool_choice is not None:
+                    params["tool_choice"] = tool_choice
+                if stream:
+                    params["stream"] = True
+                    params["stream_options"] = {"include_usage": True}
+
+                # Serialized only if the request is traced
+                span.set(tools=len(tools or ()), cache_control=cache_control)
+                span.capture("params", lambda: {key: value for key, value in params.items() if key != "tools"})
+
+                response = await self.client.chat.completions.create(**params)
+
+                if stream:
+                    return response
+                else:
+                    response_dict = json.loads(response.model_dump_json())
+                    span.capture("response", lambda: response_dict)
+                    if not response_dict.get("choices"):
+                        self.log.error(f"No choices in response from {model}")
+                        raise OpenRouterError(f"Model {model} returned no choices in response. This might indicate an issue with the model or the API.")
+                    return response_dict
 
-        except Exception as e:
-            self.log.error(f"OpenRouter API Error: {str(e)}", exc_info=True)
-            raise OpenRouterError(f"OpenRouter API Error with {model}: {str(e)}")
+            except Exception as e:
+                self.log.error(f"OpenRouter API Error: {str(e)}", exc_info=True)
+                raise OpenRouterError(f"OpenRouter API Error with {model}: {str(e)}")
+
+    def supports_cache_control(self, model: str) -> bool:
+        """Whether prompt caching of ``model`` needs cache_control breakpoints.
+
+        Other providers (e.g. OpenAI) cache stable prompt prefixes automatically.
+        """
+        patterns = self.config.get("prompt_cache.patterns", None) or DEFAULT_CACHE_CONTROL_PATTERNS
+        return any(fnmatch.fnmatchcase(model, pattern) for pattern in patterns)
 
-    def fetch_all_models(self) -> dict:
+    async def fetch_all_models(self) -> dict:
         """Fetch and cache all models from OpenRouter API."""
-        if self._all_models is None:
-            self.log.debug("Fetching all models from OpenRouter")
-            try:
-                response = requests.get(
-                    "https://openrouter.ai/api/v1/models",
-                    headers={"Authorization": f"Bearer {self.api_key}"}
-                )
-                response.raise_for_status()
-                self._all_models = response.json()  # Expecting {"data": [ ... ]}
-            except Exception as e:
-                self.log.error(f"Error fetching all models: {str(e)}", exc_info=True)
-                self._all_models = {"data": []}
-        return self._all_models
+        return (await self._load_catalog()).raw
+
+    async def get_model_catalog(self) -> ModelCatalog:
+        """Get the indexed model catalog, rebuilding it once per refresh period."""
+        return (await self._load_catalog()).catalog
+
+    async def _load_catalog(self) -> "_CatalogSnapshot":
+        snapshot = self._catalog
+        ttl = self.config.get("model_catalog_ttl", 3600)
+        if snapshot is not None and time.monotonic() - snapshot.loaded_at < ttl:
+            return snapshot
+        self.log.debug("Fetching all models from OpenRouter")
+        try:
+            raw = await self._single_flight(
+                "models", lambda: self._get_json(f"{self.base_url}/models")
+            )  # Expecting {"data": [ ... ]}
+        except Exception as e:
+            self.log.error(f"Error fetching all models: {str(e)}", exc_info=True)
+            # Keep serving the previous catalog, or an empty one, and retry in a minute
+            if snapshot is None:
+                raw = {"data": []}
+                snapshot = self._catalog = _CatalogSnapshot(raw, ModelCatalog(raw))
+            snapshot.loaded_at = time.monotonic() - ttl + 60
+            return snapshot
+        snapshot = _CatalogSnapshot(raw, ModelCatalog(raw))
+        self.log.debug(f"Built model catalog with {len(snapshot.catalog)} models")
+        self._catalog = snapshot
+        return snapshot
+
+
+class _CatalogSnapshot:
+    def __init__(self, raw: dict, catalog: ModelCatalog):
+        self.raw = raw
+        self.catalog = catalog
+        self.loaded_at = time.monotonic()
 
 class OpenRouterError(Exception):
     """Custom exception for OpenRouter API errors."""
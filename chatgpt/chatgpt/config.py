@@ -9,4 +9,49 @@ class Config(BaseProxyConfig):
         helper.copy("vat")
         helper.copy("site_url")
         helper.copy("site_name")
-        helper.copy("tool_support.patterns") 
+        helper.copy("tool_support.patterns")
+        helper.copy("base_url")
+        helper.copy("prompt_cache.patterns")
+        helper.copy("max_connections")
+        helper.copy("request_timeout")
+        helper.copy("metadata_timeout")
+        helper.copy("metadata_retries")
+        helper.copy("metadata_cache.ttl")
+        helper.copy("metadata_cache.max_stale")
+        helper.copy("metadata_cache.persist")
+        helper.copy("model_catalog_ttl")
+        helper.copy("thread_cache.max_entries")
+        helper.copy("reply_cache.max_memory_kb")
+        helper.copy("edits.min_interval")
+        helper.copy("edits.max_interval")
+        helper.copy("edits.growth_chars")
+        helper.copy("edits.growth_factor")
+        helper.copy("max_tool_rounds")
+        helper.copy("tools.max_workers")
+        helper.copy("tools.timeout")
+        helper.copy("tools.concurrency")
+        helper.copy("tools.limits")
+        helper.copy("electricity.prefetch")
+        helper.copy("electricity.prefetch_time")
+        helper.copy("context.max_tokens")
+        helper.copy("context.reserve_tokens")
+        helper.copy("context.default_length")
+        helper.copy("context.tokenizer")
+        helper.copy("summary.enabled")
+        helper.copy("summary.model")
+        helper.copy("summary.max_tokens")
+        helper.copy("scheduler.max_concurrent")
+        helper.copy("scheduler.max_queued")
+        helper.copy("scheduler.busy_message")
+        helper.copy("cancel.reactions")
+        helper.copy("router.fallback_models")
+        helper.copy("router.percentile")
+        helper.copy("router.min_deadline")
+        helper.copy("router.max_deadline")
+        helper.copy("router.default_deadline")
+        helper.copy("router.max_error_rate")
+        helper.copy("metrics.token")
+        helper.copy("tracing.enabled")
+        helper.copy("tracing.sample_rate")
+        helper.copy("tracing.payloads")
+        helper.copy("tracing.max_payload_chars")
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import logging
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Words are counted as one token per four characters, other symbols as one token each.
+# Close enough to BPE tokenizers for budgeting, and a single regex scan.
+ESTIMATE_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+# Role, separators and the like that every message costs on top of its content
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+
+class TokenCounter:
+    """Counts the tokens of chat messages, memoizing the count of every message.
+
+    Uses tiktoken when it's installed and a regex estimate otherwise. The exact
+    tokenizer differs between the models OpenRouter serves, so either way the
+    counts are estimates and the budget should leave some slack.
+    """
+
+    def __init__(self, encoding: str = "o200k_base", max_entries: int = 10000):
+        self.log = logging.getLogger("maubot.chatgpt.context")
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[tuple, int]" = OrderedDict()
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.get_encoding(encoding)
+            except Exception as e:
+                self.log.warning(f"Failed to load tokenizer {encoding}, estimating token counts: {e}")
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(ESTIMATE_PATTERN.findall(text))
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        content = message.get("content")
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False) if content else ""
+        key = (message.get("role"), message.get("name"), content)
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+            return count
+        count = MESSAGE_OVERHEAD + self.count_text(content)
+        if message.get("name"):
+            count += 1 + self.count_text(message["name"])
+        if message.get("tool_calls"):
+            count += self.count_text(json.dumps(message["tool_calls"], ensure_ascii=False))
+        self._counts[key] = count
+        if len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        return count
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(message) for message in messages) + REPLY_OVERHEAD
+
+
+def context_budget(
+    context_length: Optional[int],
+    default_length: int = 8192,
+    max_tokens: Optional[int] = None,
+    reserve_tokens: int = 0,
+) -> int:
+    """Tokens available for the messages of a request to a model with ``context_length``.
+
+    ``reserve_tokens`` are left for the reply and the tool definitions, and
+    ``max_tokens`` caps the budget of large-context models to keep requests cheap.
+    """
+    budget = (context_length or default_length) - reserve_tokens
+    if max_tokens:
+        budget = min(budget, max_tokens)
+    return max(budget, 0)
+
+
+def _fixed_parts(messages: List[Dict[str, Any]]) -> Tuple[int, int]:
+    """Split ``messages`` into leading system messages, history and the query with the
+    system messages right before it, returning the end of the first and start of the last part.
+    The first message always belongs to the leading part.
+    """
+    tail = len(messages) - 1
+    while tail > 1 and messages[tail - 1].get("role") == "system":
+        tail -= 1
+    head = 0
+    while head < tail and messages[head].get("role") == "system":
+        head += 1
+    return head, tail
+
+
+def pack_messages(messages: List[Dict[str, Any]], budget: int, counter: TokenCounter) -> List[Dict[str, Any]]:
+    """Drop the oldest history messages until ``messages`` fit in ``budget`` tokens.
+
+    The leading system messages, the last message (the current query) and the
+    system messages right before it are always kept, the history in between is
+    filled newest-first. A message is never cut in half, and history stops at
+    the first message that doesn't fit so that the kept part of the
+    conversation stays contiguous.
+    """
+    head, tail = _fixed_parts(messages)
+    used = counter.count_messages(messages[:head] + messages[tail:])
+    start = tail
+    while start > head:
+        cost = counter.count_message(messages[start - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    if start > head:
+        counter.log.debug(f"Dropped {start - head} of {tail - head} history messages to fit {budget} tokens")
+    return messages[:head] + messages[start:]
+
+
+def cache_breakpoints(messages: List[Dict[str, Any]]) -> List[int]:
+    """Indices of the messages that end the stable prefixes of ``messages``.
+
+    These are the last leading system message (system prompt and summary) and
+    the last history message before the trailing system messages and query,
+    which change on every request.
+    """
+    head, tail = _fixed_parts(messages)
+    breakpoints = [head - 1] if head else []
+    if tail > head:
+        breakpoints.append(tail - 1)
+    return breakpoints
@@ -0,0 +1,70 @@
+from mautrix.util.async_db import UpgradeTable, Connection
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Initial revision")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE model_metadata (
+            model      TEXT PRIMARY KEY,
+            data       TEXT NOT NULL,
+            fetched_at DOUBLE PRECISION NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add reply-chain store")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE thread_message (
+            event_id  TEXT PRIMARY KEY,
+            room_id   TEXT NOT NULL,
+            parent_id TEXT,
+            role      TEXT,
+            name      TEXT,
+            content   TEXT
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add assistant reply store")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE assistant_reply (
+            event_id TEXT PRIMARY KEY,
+            room_id  TEXT NOT NULL,
+            content  TEXT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add electricity price store")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE electricity_price (
+            date TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add thread summary store")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE thread_summary (
+            root_id       TEXT PRIMARY KEY,
+            last_event_id TEXT NOT NULL,
+            content       TEXT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add sent event store")
+async def upgrade_v6(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE sent_event (
+            event_id TEXT PRIMARY KEY,
+            room_id  TEXT NOT NULL
+        )"""
+    )
@@ -0,0 +1,171 @@
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import logging
+import time
+
+from mautrix.errors import MLimitExceeded
+
+Preview = Callable[[], Tuple[str, Optional[str]]]
+SendEdit = Callable[[str, str, str, Optional[str]], Awaitable[None]]
+
+
+class _RoomState:
+    def __init__(self):
+        # Edits to one room are sent one at a time, and all of them wait out a 429
+        self.lock = asyncio.Lock()
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self.sessions = 0
+
+
+class EditScheduler:
+    """Schedules the edits of streamed replies, per room.
+
+    Previews are coalesced: a session only remembers how to build its latest
+    preview and builds it when an edit is actually due. The interval between
+    previews grows exponentially with the length of the reply. Rate limits
+    (M_LIMIT_EXCEEDED) pause edits to the whole room for ``retry_after_ms``,
+    or an exponential backoff if the homeserver doesn't say.
+    """
+
+    def __init__(self, send: SendEdit, min_interval: float = 1.0, max_interval: float = 10.0,
+                 growth_chars: int = 2000, growth_factor: float = 1.5, final_attempts: int = 5):
+        self.log = logging.getLogger("maubot.chatgpt.edits")
+        self._send = send
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth_chars = growth_chars
+        self.growth_factor = growth_factor
+        self.final_attempts = final_attempts
+        self._rooms: Dict[str, _RoomState] = {}
+
+    def session(self, room_id: str, event_id: str) -> "EditSession":
+        """Start scheduling edits of the message ``event_id``."""
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = _RoomState()
+        room.sessions += 1
+        return EditSession(self, room_id, room, event_id)
+
+    def _release(self, room_id: str, room: _RoomState) -> None:
+        room.sessions -= 1
+        if room.sessions <= 0 and room.blocked_until < time.monotonic():
+            self._rooms.pop(room_id, None)
+
+    def interval(self, size: int) -> float:
+        """Minimum time between previews of a reply that is ``size`` characters long."""
+        interval = self.min_interval * self.growth_factor ** (size / self.growth_chars)
+        return min(interval, self.max_interval)
+
+    async def _send_once(self, room_id: str, room: _RoomState, event_id: str,
+                         text: str, html: Optional[str]) -> bool:
+        """Send one edit, returning False if it was rate limited."""
+        async with room.lock:
+            delay = room.blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self._send(room_id, event_id, text, html)
+            except MLimitExceeded as e:
+                retry_after_ms = getattr(e, "retry_after_ms", None)
+                if retry_after_ms:
+                    wait = retry_after_ms / 1000
+                else:
+                    wait = room.backoff = min(max(room.backoff * 2, self.min_interval), 60.0)
+                room.blocked_until = time.monotonic() + wait
+                self.log.warning(f"Rate limited while editing in {room_id}, pausing edits for {wait:.1f}s")
+                return False
+            room.backoff = 0.0
+            return True
+
+
+class EditSession:
+    """Edits of a single reply message. See :class:`EditScheduler`."""
+
+    def __init__(self, scheduler: EditScheduler, room_id: str, room: _RoomState, event_id: str):
+        self.scheduler = scheduler
+        self.room_id = room_id
+        self.room = room
+        self.event_id = event_id
+        self.edits = 0
+        self._pending: Optional[Preview] = None
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._last_sent = 0.0
+        self._last_size = 0
+        self._closed = False
+
+    def update(self, preview: Preview) -> None:
+        """Replace the pending preview. ``preview`` is only called when the edit is sent."""
+        if self._closed:
+            return
+        self._pending = preview
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            delay = self._last_sent + self.scheduler.interval(self._last_size) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            preview, self._pending = self._pending, None
+            if preview is None or self._closed:
+                continue
+            text, html = preview()
+            try:
+                sent = await self.scheduler._send_once(self.room_id, self.room, self.event_id, text, html)
+            except Exception as e:
+                # A lost preview doesn't matter, the next one or the final edit replaces it.
+                # The next one still waits for the interval, so a persistent error isn't hammered.
+                self.scheduler.log.warning(f"Failed to send preview edit of {self.event_id}: {e}")
+                self._last_sent = time.monotonic()
+                continue
+            if sent:
+                self.edits += 1
+                self._last_sent = time.monotonic()
+                self._last_size = len(text)
+            elif self._pending is None:
+                # Rate limited: retry the same preview, once the room is unblocked, unless a
+                # newer one arrived meanwhile
+                self._pending = preview
+                self._wakeup.set()
+
+    async def _stop_previews(self) -> None:
+        self._pending = None
+        worker, self._worker = self._worker, None
+        if worker is not None and not worker.done():
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+
+    async def flush(self, text: str, html: Optional[str] = None) -> None:
+        """Drop pending previews and deliver this edit, retrying through rate limits.
+
+        The session can still be updated afterwards.
+        """
+        await self._stop_previews()
+        for attempt in range(1, self.scheduler.final_attempts + 1):
+            try:
+                if await self.scheduler._send_once(self.room_id, self.room, self.event_id, text, html):
+                    self.edits += 1
+                    self._last_sent = time.monotonic()
+                    self._last_size = len(text)
+                    return
+            except Exception:
+                if attempt == self.scheduler.final_attempts:
+                    raise
+                await asyncio.sleep(attempt)
+        raise RuntimeError(f"Edit of {self.event_id} was rate limited {self.scheduler.final_attempts} times")
+
+    async def close(self) -> None:
+        """Stop sending previews and release the room."""
+        if self._closed:
+            return
+        self._closed = True
+        await self._stop_previews()
+        self.scheduler._release(self.room_id, self.room)
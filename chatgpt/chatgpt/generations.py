@@ -0,0 +1,61 @@
+from typing import Dict, Optional
+import asyncio
+import logging
+
+
+class Generation:
+    """A reply being generated, from queueing to the final edit."""
+
+    __slots__ = ("room_id", "user_event_id", "placeholder_id", "sender", "task", "reason", "restart_query")
+
+    def __init__(self, room_id: str, user_event_id: str, placeholder_id: str, sender: str):
+        self.room_id = room_id
+        self.user_event_id = user_event_id
+        self.placeholder_id = placeholder_id
+        self.sender = sender
+        self.task: Optional[asyncio.Task] = None
+        # Why the generation was cancelled, None while it runs
+        self.reason: Optional[str] = None
+        # The edited query to generate a new reply for after cancelling
+        self.restart_query: Optional[str] = None
+
+
+class GenerationRegistry:
+    """In-flight generations, by the event id of the query and of the placeholder reply."""
+
+    def __init__(self):
+        self.log = logging.getLogger("maubot.chatgpt.generations")
+        self._generations: Dict[str, Generation] = {}
+
+    def register(self, room_id: str, user_event_id: str, placeholder_id: str, sender: str) -> Generation:
+        generation = Generation(room_id, user_event_id, placeholder_id, sender)
+        self._generations[user_event_id] = self._generations[placeholder_id] = generation
+        return generation
+
+    def unregister(self, generation: Generation) -> None:
+        for event_id in (generation.user_event_id, generation.placeholder_id):
+            if self._generations.get(event_id) is generation:
+                del self._generations[event_id]
+
+    def get(self, event_id: str) -> Optional[Generation]:
+        return self._generations.get(event_id)
+
+    def cancel(self, event_id: str, reason: str, restart_query: Optional[str] = None) -> Optional[Generation]:
+        """Cancel the generation of the query or placeholder ``event_id``, if there is one.
+
+        With ``restart_query``, the generation starts over with it once cancelled.
+        """
+        generation = self._generations.get(event_id)
+        if generation is None or generation.task is None or generation.task.done():
+            return None
+        self.log.info(f"Cancelling the reply to {generation.user_event_id}: {reason}")
+        generation.reason = reason
+        generation.restart_query = restart_query
+        generation.task.cancel()
+        return generation
+
+    def cancel_all(self, reason: str) -> None:
+        for generation in set(self._generations.values()):
+            if generation.task is not None and not generation.task.done():
+                generation.reason = reason
+                generation.task.cancel()
@@ -0,0 +1,198 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+
+
+class ModelInfo:
+    """Endpoint metadata of a single model, parsed from one /models/{model}/endpoints response."""
+
+    def __init__(
+        self,
+        model: str,
+        exists: bool = True,
+        prompt_price: float = float("inf"),
+        completion_price: float = float("inf"),
+        context_length: Optional[int] = None,
+        max_completion_tokens: Optional[int] = None,
+        supported_parameters: Optional[Set[str]] = None,
+        fetched_at: float = 0.0,
+    ):
+        self.model = model
+        self.exists = exists
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.context_length = context_length
+        self.max_completion_tokens = max_completion_tokens
+        self.supported_parameters = supported_parameters or set()
+        self.fetched_at = fetched_at
+
+    @property
+    def supports_tools(self) -> bool:
+        return "tools" in self.supported_parameters
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    @classmethod
+    def from_endpoints(cls, model: str, endpoint_data: dict) -> "ModelInfo":
+        """Build the metadata from an endpoints API response.
+
+        Prices are the cheapest over all endpoints, limits the largest and the
+        supported parameters the union, since OpenRouter may route to any of them.
+        """
+        info = cls(model, fetched_at=time.time())
+        endpoints = (endpoint_data.get("data") or {}).get("endpoints") or []
+        for endpoint in endpoints:
+            pricing = endpoint.get("pricing") or {}
+            try:
+                info.prompt_price = min(info.prompt_price, float(pricing["prompt"]))
+            except (KeyError, ValueError, TypeError):
+                pass
+            try:
+                info.completion_price = min(info.completion_price, float(pricing["completion"]))
+            except (KeyError, ValueError, TypeError):
+                pass
+            if endpoint.get("context_length"):
+                info.context_length = max(info.context_length or 0, int(endpoint["context_length"]))
+            if endpoint.get("max_completion_tokens"):
+                info.max_completion_tokens = max(info.max_completion_tokens or 0,
+                                                 int(endpoint["max_completion_tokens"]))
+            info.supported_parameters.update(endpoint.get("supported_parameters") or [])
+        return info
+
+    @classmethod
+    def not_found(cls, model: str) -> "ModelInfo":
+        return cls(model, exists=False, fetched_at=time.time())
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "exists": self.exists,
+            # JSON has no infinity, None means "no price available"
+            "prompt_price": None if self.prompt_price == float("inf") else self.prompt_price,
+            "completion_price": None if self.completion_price == float("inf") else self.completion_price,
+            "context_length": self.context_length,
+            "max_completion_tokens": self.max_completion_tokens,
+            "supported_parameters": sorted(self.supported_parameters),
+        })
+
+    @classmethod
+    def from_json(cls, model: str, data: str, fetched_at: float) -> "ModelInfo":
+        raw = json.loads(data)
+        prompt_price = raw.get("prompt_price")
+        completion_price = raw.get("completion_price")
+        return cls(
+            model,
+            exists=raw.get("exists", True),
+            prompt_price=float("inf") if prompt_price is None else prompt_price,
+            completion_price=float("inf") if completion_price is None else completion_price,
+            context_length=raw.get("context_length"),
+            max_completion_tokens=raw.get("max_completion_tokens"),
+            supported_parameters=set(raw.get("supported_parameters") or []),
+            fetched_at=fetched_at,
+        )
+
+
+class ModelMetadataCache:
+    """TTL cache of ModelInfo with stale-while-revalidate and optional database persistence.
+
+    Fresh entries are served directly. Entries older than ``ttl`` are still served,
+    but trigger one background refresh. Entries older than ``max_stale`` are refreshed
+    before returning, falling back to the stale value if the refresh fails.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], Awaitable[dict]],
+        ttl: float = 3600,
+        max_stale: float = 86400,
+        database: Any = None,
+    ):
+        self.log = logging.getLogger("maubot.chatgpt.metadata")
+        self._fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.database = database
+        self._entries: Dict[str, ModelInfo] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        # How lookups were answered: from a fresh entry, a stale one, or by fetching
+        self.lookups = {"fresh": 0, "stale": 0, "miss": 0}
+
+    async def get(self, model: str) -> ModelInfo:
+        """Get the metadata of a model, fetching it only if it's missing or expired."""
+        info = self._entries.get(model)
+        if info is None and self.database is not None:
+            info = await self._load(model)
+            if info is not None:
+                self._entries[model] = info
+
+        if info is None:
+            self.lookups["miss"] += 1
+            return await self._refresh(model)
+        age = info.age()
+        if age <= self.ttl:
+            self.lookups["fresh"] += 1
+            return info
+        if age <= self.max_stale:
+            self.lookups["stale"] += 1
+            self._refresh_in_background(model)
+            return info
+        self.lookups["miss"] += 1
+        try:
+            return await self._refresh(model)
+        except Exception as e:
+            self.log.warning(f"Refreshing metadata for {model} failed, serving stale entry: {e}")
+            return info
+
+    def _refresh_in_background(self, model: str) -> None:
+        if model in self._refreshing:
+            return
+        task = asyncio.create_task(self._background_refresh(model))
+        self._refreshing[model] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(model, None))
+
+    async def _background_refresh(self, model: str) -> None:
+        try:
+            await self._refresh(model)
+        except Exception as e:
+            self.log.warning(f"Background refresh of metadata for {model} failed: {e}")
+
+    async def _refresh(self, model: str) -> ModelInfo:
+        try:
+            info = ModelInfo.from_endpoints(model, await self._fetch(model))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            info = ModelInfo.not_found(model)
+        self._entries[model] = info
+        if self.database is not None:
+            await self._save(info)
+        return info
+
+    async def _load(self, model: str) -> Optional[ModelInfo]:
+        try:
+            row = await self.database.fetchrow(
+                "SELECT data, fetched_at FROM model_metadata WHERE model=$1", model
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to load metadata for {model} from database: {e}")
+            return None
+        if row is None:
+            return None
+        return ModelInfo.from_json(model, row["data"], row["fetched_at"])
+
+    async def _save(self, info: ModelInfo) -> None:
+        try:
+            await self.database.execute(
+                "INSERT INTO model_metadata (model, data, fetched_at) VALUES ($1, $2, $3) "
+                "ON CONFLICT (model) DO UPDATE SET data=excluded.data, fetched_at=excluded.fetched_at",
+                info.model, info.to_json(), info.fetched_at,
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to store metadata for {info.model} in database: {e}")
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -0,0 +1,185 @@
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+import math
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SLOW_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """A monotonically increasing value per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Without labels there is a single series, exposed from the start
+        self._values: Dict[Tuple[str, ...], float] = {} if self.labels else {(): 0}
+
+    def inc(self, amount: float = 1, *label_values: str) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, per label combination."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per series: a count per bucket (not cumulative) plus one for +Inf, the sum and the count
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """A value read from a callback when the metrics are rendered.
+
+    With ``labels``, the callback returns the values by label value tuple.
+    """
+
+    def __init__(self, name: str, help: str, read: Callable[[], Any], kind: str = "gauge",
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.read = read
+        # Counters kept elsewhere (e.g. in a cache) can be exposed with kind="counter"
+        self.kind = kind
+        self.labels = tuple(labels)
+
+    def samples(self) -> List[str]:
+        if not self.labels:
+            return [f"{self.name} {_format_value(self.read())}"]
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in self.read().items()]
+
+
+class Registry:
+    """A set of metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name: str, help: str, read: Callable[[], Any], kind: str = "gauge",
+              labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, read, kind, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(Registry):
+    """The metrics of the plugin's request path."""
+
+    def __init__(self):
+        super().__init__()
+        self.chain_seconds = self.histogram(
+            "chatgpt_reply_chain_seconds", "Time to collect the reply chain of a request", LATENCY_BUCKETS)
+        self.chain_messages = self.histogram(
+            "chatgpt_reply_chain_messages", "Messages in the reply chain of a request", COUNT_BUCKETS)
+        self.chain_fetches = self.histogram(
+            "chatgpt_reply_chain_fetches", "Events fetched from the homeserver to collect a reply chain",
+            COUNT_BUCKETS)
+        self.queue_wait_seconds = self.histogram(
+            "chatgpt_queue_wait_seconds", "Time requests waited for a generation slot", LATENCY_BUCKETS)
+        self.rejected = self.counter(
+            "chatgpt_requests_rejected_total", "Requests answered with the busy message")
+        self.ttft_seconds = self.histogram(
+            "chatgpt_ttft_seconds", "Time from sending a request to its first streamed token", SLOW_BUCKETS,
+            ["model"])
+        self.tokens_per_second = self.histogram(
+            "chatgpt_tokens_per_second", "Completion tokens per second after the first token", RATE_BUCKETS,
+            ["model"])
+        self.prompt_tokens = self.counter(
+            "chatgpt_prompt_tokens_total", "Prompt tokens sent", ["model"])
+        self.cached_tokens = self.counter(
+            "chatgpt_cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache",
+            ["model"])
+        self.completion_tokens = self.counter(
+            "chatgpt_completion_tokens_total", "Completion tokens received", ["model"])
+        self.cost = self.counter(
+            "chatgpt_cost_credits_total", "Cost of the requests reported by OpenRouter, in credits", ["model"])
+        self.tool_seconds = self.histogram(
+            "chatgpt_tool_seconds", "Time to run a tool call", LATENCY_BUCKETS, ["tool", "status"])
+        self.edit_seconds = self.histogram(
+            "chatgpt_edit_seconds", "Time to send an edit of a reply to the homeserver", LATENCY_BUCKETS)
+        self.edits_per_reply = self.histogram(
+            "chatgpt_edits_per_reply", "Edits sent per reply, previews and final", COUNT_BUCKETS)
+        self.rate_limited = self.counter(
+            "chatgpt_edits_rate_limited_total", "Edits rejected by the homeserver with M_LIMIT_EXCEEDED")
+
+    def track_metadata(self, cache) -> None:
+        """Expose the hit counters of a ModelMetadataCache."""
+        self.gauge("chatgpt_metadata_lookups_total",
+                   "Model metadata lookups by result: fresh or stale cache entry, or miss",
+                   lambda: {(result,): count for result, count in cache.lookups.items()},
+                   kind="counter", labels=["result"])
+
+    def track_scheduler(self, scheduler) -> None:
+        """Expose the current load of a RequestScheduler."""
+        self.gauge("chatgpt_requests_running", "Replies being generated", lambda: scheduler.running)
+        self.gauge("chatgpt_requests_queued", "Requests waiting for a generation slot", lambda: scheduler.queued)
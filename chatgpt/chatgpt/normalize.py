@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from html.parser import HTMLParser
+from typing import Any, List, Optional, Tuple
+import re
+
+from mautrix.types import Format
+
+WHITESPACE = re.compile(r"[ \t\r\n\f\v]+")
+TRAILING_SPACE = re.compile(r"[ \t]+\n")
+BLANK_LINES = re.compile(r"\n{3,}")
+MATRIX_TO = "https://matrix.to/#/"
+
+
+class _HTMLToMarkdown(HTMLParser):
+    """Converts Matrix message HTML to compact markdown, dropping ``<mx-reply>`` fallbacks.
+
+    Elements whose text needs post-processing (quotes, links, reply fallbacks)
+    collect their content into a buffer of their own, pushed on a stack.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack: List[Tuple[str, Any, List[str]]] = [("", None, [])]
+        self.lists: List[Optional[int]] = []
+        self.pre = 0
+
+    @property
+    def parts(self) -> List[str]:
+        return self.stack[-1][2]
+
+    def _block(self) -> None:
+        if self.parts and not self.parts[-1].endswith("\n\n"):
+            self.parts.append("\n\n")
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag in ("mx-reply", "blockquote", "a"):
+            self.stack.append((tag, dict(attrs).get("href"), []))
+        elif tag == "br":
+            self.parts.append("\n")
+        elif tag in ("p", "div", "table", "tr"):
+            self._block()
+        elif len(tag) == 2 and tag[0] == "h" and tag[1].isdigit():
+            self._block()
+            self.parts.append("#" * int(tag[1]) + " ")
+        elif tag in ("ul", "ol"):
+            if not self.lists:
+                self._block()
+            self.lists.append(0 if tag == "ol" else None)
+        elif tag == "li":
+            number = self.lists[-1] if self.lists else None
+            if number is not None:
+                self.lists[-1] = number = number + 1
+            indent = "  " * (len(self.lists) - 1)
+            self.parts.append(f"\n{indent}{number}. " if number is not None else f"\n{indent}- ")
+        elif tag == "pre":
+            self._block()
+            self.parts.append("```\n")
+            self.pre += 1
+        elif tag == "code" and not self.pre:
+            self.parts.append("`")
+        elif tag in ("strong", "b"):
+            self.parts.append("**")
+        elif tag in ("em", "i"):
+            self.parts.append("*")
+        elif tag in ("del", "s", "strike"):
+            self.parts.append("~~")
+        elif tag == "img":
+            alt = dict(attrs).get("alt")
+            if alt:
+                self.parts.append(alt)
+        elif tag == "hr":
+            self._block()
+            self.parts.append("---\n\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in ("mx-reply", "blockquote", "a"):
+            # Close the innermost open element of this kind, along with anything left open in it
+            while len(self.stack) > 1:
+                open_tag, href, parts = self.stack.pop()
+                text = "".join(parts).strip()
+                if open_tag == "blockquote" and text:
+                    self._block()
+                    self.parts.append("\n".join(f"> {line}" if line else ">" for line in text.split("\n")))
+                    self.parts.append("\n\n")
+                elif open_tag == "a" and text:
+                    if href and not href.startswith(MATRIX_TO) and href != text:
+                        text = f"[{text}]({href})"
+                    self.parts.append(text)
+                if open_tag == tag:
+                    break
+        elif tag in ("p", "div", "table", "tr") or (len(tag) == 2 and tag[0] == "h" and tag[1].isdigit()):
+            self._block()
+        elif tag in ("ul", "ol"):
+            if self.lists:
+                self.lists.pop()
+            if not self.lists:
+                self._block()
+        elif tag == "pre":
+            self.pre = max(self.pre - 1, 0)
+            if self.parts and not self.parts[-1].endswith("\n"):
+                self.parts.append("\n")
+            self.parts.append("```")
+            self._block()
+        elif tag == "code" and not self.pre:
+            self.parts.append("`")
+        elif tag in ("strong", "b"):
+            self.parts.append("**")
+        elif tag in ("em", "i"):
+            self.parts.append("*")
+        elif tag in ("del", "s", "strike"):
+            self.parts.append("~~")
+
+    def handle_data(self, data: str) -> None:
+        self.parts.append(data if self.pre else WHITESPACE.sub(" ", data))
+
+    def text(self) -> str:
+        self.close()
+        while len(self.stack) > 1:
+            self.handle_endtag(self.stack[-1][0])
+        return "".join(self.parts)
+
+
+def html_to_markdown(formatted_body: str) -> str:
+    """Convert message HTML to compact markdown without reply fallbacks."""
+    parser = _HTMLToMarkdown()
+    parser.feed(formatted_body)
+    return compact(parser.text())
+
+
+def strip_reply_fallback(body: str) -> str:
+    """Remove the ``> <@user:server> ...`` quote of the parent that clients prepend to replies."""
+    if not body.startswith(">"):
+        return body
+    lines = body.split("\n")
+    index = 0
+    while index < len(lines) and lines[index].startswith(">"):
+        index += 1
+    return "\n".join(lines[index:])
+
+
+def compact(text: str) -> str:
+    """Drop trailing spaces and runs of blank lines."""
+    text = TRAILING_SPACE.sub("\n", text.replace("\xa0", " "))
+    return BLANK_LINES.sub("\n\n", text).strip()
+
+
+class MessageNormalizer:
+    """Turns the content of Matrix messages into the text the model sees.
+
+    Reply fallbacks are removed, since the parent is in the history anyway,
+    HTML is converted to compact markdown and the bot's own mention pill is
+    dropped. Results are cached per event id, so a message is only parsed once.
+    """
+
+    def __init__(self, bot_name: str, max_entries: int = 1000):
+        self.bot_name = bot_name
+        self.mention = re.compile(fr'<a href="https://matrix\.to/#/{re.escape(bot_name)}">.*?</a>:? ?')
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Tuple[str, bool]]" = OrderedDict()
+
+    def mentions_bot(self, content: Any) -> bool:
+        """Whether the content mentions the bot, without normalizing it.
+
+        ``m.mentions`` is authoritative when the client sends it. Otherwise the
+        formatted body is searched for the bot's mention pill.
+        """
+        mentions = content.get("m.mentions")
+        if mentions is not None:
+            return self.bot_name in (mentions.get("user_ids") or ())
+        formatted_body = content.get("formatted_body") if content.get("format") == Format.HTML else None
+        return bool(formatted_body) and self.bot_name in formatted_body and self.mention.search(formatted_body) is not None
+
+    def normalize(self, content: Any) -> Tuple[str, bool]:
+        """Normalize message content, returning the text and whether it mentioned the bot."""
+        formatted_body = content.get("formatted_body") if content.get("format") == Format.HTML else None
+        if formatted_body:
+            formatted_body, mentions = self.mention.subn("", formatted_body)
+            text = html_to_markdown(formatted_body)
+            return (text.lstrip(": ") if mentions else text), mentions > 0
+        body = content.get("body") or ""
+        get_reply_to = getattr(content, "get_reply_to", None)
+        if get_reply_to and get_reply_to():
+            body = strip_reply_fallback(body)
+        return compact(body), False
+
+    def normalize_event(self, event: Any) -> Tuple[str, bool]:
+        """:meth:`normalize` the content of an event, cached by its event id."""
+        result = self._cache.get(event.event_id)
+        if result is not None:
+            self._cache.move_to_end(event.event_id)
+            return result
+        result = self._cache[event.event_id] = self.normalize(event.content)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return result
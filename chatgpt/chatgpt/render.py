@@ -0,0 +1,83 @@
+from typing import List, Optional
+import re
+
+from mautrix.util import markdown
+
+LIST_ITEM = re.compile(r"^(?:[*+-]|\d{1,9}[.)])(?:\s|$)")
+FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+
+
+class StreamingRenderer:
+    """Renders a growing markdown document for streamed edits.
+
+    The document is cut into top-level blocks at blank lines outside code fences.
+    The HTML of every completed block is cached, so each call only renders the
+    blocks that are still open instead of the whole document. The text passed to
+    :meth:`render` is expected to only grow; if it doesn't, the cache is reset.
+    """
+
+    def __init__(self, allow_html: bool = True):
+        self.allow_html = allow_html
+        self._done_text = ""
+        self._done_html: List[str] = []
+
+    def reset(self) -> None:
+        self._done_text = ""
+        self._done_html = []
+
+    def render(self, text: str) -> str:
+        if not text.startswith(self._done_text):
+            self.reset()
+        start = len(self._done_text)
+        for end in self._completed_blocks(text, start):
+            self._done_html.append(markdown.render(text[start:end], allow_html=self.allow_html))
+            start = end
+        self._done_text = text[:start]
+        tail = text[start:]
+        if tail.strip():
+            return "".join(self._done_html) + markdown.render(tail, allow_html=self.allow_html)
+        return "".join(self._done_html)
+
+    @staticmethod
+    def _completed_blocks(text: str, start: int):
+        """Yield the end offsets of blocks in ``text[start:]`` that can't change anymore.
+
+        A block is complete when it's followed by a blank line and then a line that
+        starts a new block: not indented, and not another item of the same list or
+        quote (splitting those would render as separate lists or quotes).
+        """
+        fence: Optional[str] = None
+        block_first: Optional[str] = None
+        blank_at: Optional[int] = None
+        pos = start
+        for line in text[start:].splitlines(keepends=True):
+            line_start = pos
+            pos += len(line)
+            if not line.endswith("\n"):
+                # The last line may still be incomplete
+                break
+            stripped = line.strip()
+            if fence is not None:
+                if stripped.startswith(fence) and not stripped.lstrip(fence[0]):
+                    fence = None
+                continue
+            if not stripped:
+                if block_first is not None and blank_at is None:
+                    blank_at = line_start
+                continue
+            if blank_at is not None:
+                if not line[0].isspace() and not StreamingRenderer._continues(block_first, line):
+                    yield line_start
+                    block_first = None
+                blank_at = None
+            if block_first is None:
+                block_first = line
+            match = FENCE.match(line)
+            if match:
+                fence = match.group(1)
+
+    @staticmethod
+    def _continues(block_first: str, line: str) -> bool:
+        if LIST_ITEM.match(block_first) and LIST_ITEM.match(line):
+            return True
+        return block_first.startswith(">") and line.startswith(">")
@@ -0,0 +1,195 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import time
+
+
+class ModelStats:
+    """Time to first token and outcome of the recent requests to one model."""
+
+    __slots__ = ("ttfts", "results")
+
+    def __init__(self, window: int):
+        self.ttfts: Deque[float] = deque(maxlen=window)
+        self.results: Deque[bool] = deque(maxlen=window)
+
+    def record(self, ttft: Optional[float]) -> None:
+        """Record a request that got its first chunk after ``ttft`` seconds, or failed if None."""
+        if ttft is not None:
+            self.ttfts.append(ttft)
+        self.results.append(ttft is not None)
+
+    def record_censored(self, elapsed: float) -> None:
+        """Record a request that was cancelled without a first chunk after ``elapsed`` seconds.
+
+        Its TTFT is at least ``elapsed``, so it's counted as that. Leaving it out would
+        bias the percentile toward the requests that won the race.
+        """
+        self.ttfts.append(elapsed)
+
+    def ttft_percentile(self, fraction: float) -> float:
+        ttfts = sorted(self.ttfts)
+        return ttfts[min(int(fraction * len(ttfts)), len(ttfts) - 1)]
+
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+
+class RoutedStream:
+    """The stream that won the race, with its first chunk put back in front."""
+
+    def __init__(self, model: str, stream: Any, iterator: Any, first: Any):
+        self.model = model
+        self.stream = stream
+        self.iterator = iterator
+        self.first = first
+
+    async def __aenter__(self) -> "RoutedStream":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stream.close()
+
+    async def __aiter__(self):
+        if self.first is not None:
+            yield self.first
+        async for chunk in self.iterator:
+            yield chunk
+
+
+class LatencyRouter:
+    """Streams chat completions, hedging slow models with a fallback model.
+
+    The time to first token (TTFT) and errors of every model are tracked in a
+    rolling window. If the first chunk of a stream hasn't arrived by the
+    model's ``percentile`` TTFT (clamped to ``min_deadline``..``max_deadline``,
+    ``default_deadline`` until there are ``min_samples`` samples), the same
+    request is sent to the first fallback model within the price limit, and
+    the stream that starts first wins. The other one is cancelled and its
+    connection closed, and the time it waited is recorded as its TTFT. A failed request falls back right away, and a model
+    whose error rate is above ``max_error_rate`` is hedged from the start.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        fallback_models: Optional[List[str]] = None,
+        percentile: float = 0.9,
+        min_deadline: float = 2.0,
+        max_deadline: float = 15.0,
+        default_deadline: float = 8.0,
+        min_samples: int = 10,
+        max_error_rate: float = 0.5,
+        window: int = 100,
+    ):
+        self.log = logging.getLogger("maubot.chatgpt.router")
+        self.client = client
+        self.fallback_models = fallback_models or []
+        self.percentile = percentile
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self.default_deadline = default_deadline
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self._stats: Dict[str, ModelStats] = {}
+
+    def stats(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelStats(self.window)
+        return stats
+
+    def deadline(self, model: str) -> float:
+        """Seconds to wait for the first chunk from ``model`` before hedging."""
+        stats = self._stats.get(model)
+        if stats is None:
+            return self.default_deadline
+        if len(stats.results) >= self.min_samples and stats.error_rate() > self.max_error_rate:
+            return 0.0
+        if len(stats.ttfts) < self.min_samples:
+            return self.default_deadline
+        return min(max(stats.ttft_percentile(self.percentile), self.min_deadline), self.max_deadline)
+
+    async def _fallback_for(self, model: str) -> Optional[str]:
+        for fallback in self.fallback_models:
+            if fallback == model:
+                continue
+            if (await self.client.check_model_pricing(fallback))["is_allowed"]:
+                return fallback
+            self.log.debug(f"Skipping fallback {fallback}, it exceeds the price limit")
+        return None
+
+    async def _open(self, model: str, kwargs: Dict[str, Any]) -> Tuple[Any, Any, Any]:
+        """Start a stream and wait for its first chunk."""
+        started = time.monotonic()
+        try:
+            stream = await self.client.create_chat_completion(model=model, stream=True, **kwargs)
+        except Exception:
+            self.stats(model).record(None)
+            raise
+        iterator = stream.__aiter__()
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                self.stats(model).record(None)
+            await stream.close()
+            raise
+        self.stats(model).record(time.monotonic() - started)
+        return stream, iterator, first
+
+    @staticmethod
+    def _discard(task: asyncio.Task) -> None:
+        """Cancel a losing request, closing its stream if it was already open."""
+        def close(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is None:
+                asyncio.create_task(task.result()[0].close())
+        task.cancel()
+        task.add_done_callback(close)
+
+    async def create_stream(self, model: str, **kwargs: Any) -> RoutedStream:
+        """Stream a chat completion from ``model``, or from a fallback if it's slow or fails.
+
+        Takes the arguments of :meth:`OpenRouterClient.create_chat_completion`. The
+        model that answered is the ``model`` of the returned stream.
+        """
+        tasks: Dict[asyncio.Task, str] = {asyncio.create_task(self._open(model, kwargs)): model}
+        started = {model: time.monotonic()}
+        hedged = not self.fallback_models
+        deadline = self.deadline(model)
+        error: Optional[BaseException] = None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=None if hedged else deadline,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task_model = tasks.pop(task)
+                    if task.exception() is None:
+                        if task_model != model:
+                            self.log.info(f"Fallback {task_model} answered before {model}")
+                        now = time.monotonic()
+                        for loser, loser_model in tasks.items():
+                            if not loser.done():
+                                self.stats(loser_model).record_censored(now - started[loser_model])
+                        return RoutedStream(task_model, *task.result())
+                    error = task.exception()
+                    self.log.warning(f"Request to {task_model} failed: {error}")
+                if not hedged:
+                    hedged = True
+                    fallback = await self._fallback_for(model)
+                    if fallback is not None:
+                        if tasks:
+                            self.log.info(f"No first token from {model} in {deadline:.1f}s, "
+                                          f"hedging with {fallback}")
+                        tasks[asyncio.create_task(self._open(fallback, kwargs))] = fallback
+                        started[fallback] = time.monotonic()
+            raise error
+        finally:
+            for task in tasks:
+                self._discard(task)
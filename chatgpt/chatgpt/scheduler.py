@@ -0,0 +1,139 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+import asyncio
+import logging
+import time
+
+
+class QueueFull(Exception):
+    """Raised when a request can't be queued because the queue is full."""
+    pass
+
+
+class Ticket:
+    """A request's place in the :class:`RequestScheduler` queue.
+
+    Use as an async context manager; leaving it releases the slot, or the place
+    in the queue if the request never got a slot.
+    """
+
+    __slots__ = ("scheduler", "room_id", "user_id", "queued_at", "future", "wait_time")
+
+    def __init__(self, scheduler: "RequestScheduler", room_id: str, user_id: str):
+        self.scheduler = scheduler
+        self.room_id = room_id
+        self.user_id = user_id
+        self.queued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.wait_time: Optional[float] = None
+
+    async def wait(self) -> float:
+        """Wait for a slot, returning the seconds spent in the queue."""
+        await asyncio.shield(self.future)
+        return self.wait_time
+
+    async def __aenter__(self) -> "Ticket":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self.future.done():
+            self.scheduler._release()
+        else:
+            self.future.cancel()
+            self.scheduler._dequeue(self)
+
+
+class RequestScheduler:
+    """Limits concurrent generations and shares the slots fairly.
+
+    At most ``max_concurrent`` requests run at once. Waiting requests are queued
+    per room and per user, and free slots go round-robin over the rooms and,
+    within a room, over its users, so a busy room or user can't starve the
+    others. At most ``max_queued`` requests wait at once; beyond that,
+    :meth:`enqueue` raises :class:`QueueFull`.
+    """
+
+    def __init__(self, max_concurrent: int = 8, max_queued: int = 50, window: int = 1000):
+        self.log = logging.getLogger("maubot.chatgpt.scheduler")
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.running = 0
+        self.queued = 0
+        self.served = 0
+        self.rejected = 0
+        # Round-robin order: rooms, then the users of each room, then their requests
+        self._rooms: "OrderedDict[str, OrderedDict[str, Deque[Ticket]]]" = OrderedDict()
+        self._waits: Deque[float] = deque(maxlen=window)
+
+    def enqueue(self, room_id: str, user_id: str) -> Ticket:
+        """Queue a request, or give it a slot right away if one is free."""
+        ticket = Ticket(self, room_id, user_id)
+        if self.running < self.max_concurrent and not self.queued:
+            self._start(ticket)
+            return ticket
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise QueueFull(f"{self.queued} requests already waiting")
+        users = self._rooms.get(room_id)
+        if users is None:
+            users = self._rooms[room_id] = OrderedDict()
+        tickets = users.get(user_id)
+        if tickets is None:
+            tickets = users[user_id] = deque()
+        tickets.append(ticket)
+        self.queued += 1
+        return ticket
+
+    def _start(self, ticket: Ticket) -> None:
+        self.running += 1
+        self.served += 1
+        ticket.wait_time = time.monotonic() - ticket.queued_at
+        self._waits.append(ticket.wait_time)
+        if ticket.wait_time >= 1:
+            self.log.info(f"Request of {ticket.user_id} in {ticket.room_id} waited {ticket.wait_time:.1f}s "
+                          f"for a slot, {self.queued} still waiting")
+        ticket.future.set_result(None)
+
+    def _release(self) -> None:
+        self.running -= 1
+        while self.running < self.max_concurrent and self._rooms:
+            room_id, users = self._rooms.popitem(last=False)
+            user_id, tickets = users.popitem(last=False)
+            ticket = tickets.popleft()
+            self.queued -= 1
+            # Both go to the back of the line if they have more requests waiting
+            if tickets:
+                users[user_id] = tickets
+            if users:
+                self._rooms[room_id] = users
+            self._start(ticket)
+
+    def _dequeue(self, ticket: Ticket) -> None:
+        users = self._rooms.get(ticket.room_id)
+        tickets = users.get(ticket.user_id) if users else None
+        if not tickets or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        self.queued -= 1
+        if not tickets:
+            del users[ticket.user_id]
+        if not users:
+            del self._rooms[ticket.room_id]
+
+    def wait_percentile(self, fraction: float) -> float:
+        """A percentile of the queue waits of recent requests, in seconds."""
+        if not self._waits:
+            return 0.0
+        waits = sorted(self._waits)
+        return waits[min(int(fraction * len(waits)), len(waits) - 1)]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "served": self.served,
+            "rejected": self.rejected,
+            "wait_p50": self.wait_percentile(0.5),
+            "wait_p95": self.wait_percentile(0.95),
+            "wait_max": max(self._waits, default=0.0),
+        }
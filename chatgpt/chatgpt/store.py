@@ -0,0 +1,234 @@
+from collections import OrderedDict
+from typing import Any, List, Optional
+import logging
+import sys
+
+
+class ThreadMessage:
+    """A message in a reply chain, as the bot sees it.
+
+    ``role`` is None for events that are part of the chain but not sent to the
+    model (e.g. non-message events); they only link to their parent.
+    """
+
+    __slots__ = ("event_id", "room_id", "parent_id", "role", "name", "content")
+
+    def __init__(self, event_id: str, room_id: str, parent_id: Optional[str],
+                 role: Optional[str], name: Optional[str], content: Optional[str]):
+        self.event_id = event_id
+        self.room_id = room_id
+        self.parent_id = parent_id
+        self.role = role
+        self.name = name
+        self.content = content
+
+    def to_message(self) -> dict:
+        return {"role": self.role, "name": self.name, "content": self.content}
+
+
+class ThreadStore:
+    """Reply-chain cache, in memory and backed by the plugin database.
+
+    Lets the bot walk a reply chain without fetching events it already knows
+    from the homeserver.
+    """
+
+    _columns = "event_id, room_id, parent_id, role, name, content"
+    # Guards against walking forever if the stored chain ever contains a loop
+    max_depth = 1000
+
+    def __init__(self, database: Any = None, max_entries: int = 10000):
+        self.log = logging.getLogger("maubot.chatgpt.store")
+        self.database = database
+        self.max_entries = max_entries
+        self._messages: "OrderedDict[str, ThreadMessage]" = OrderedDict()
+
+    def _remember(self, message: ThreadMessage) -> None:
+        self._messages[message.event_id] = message
+        self._messages.move_to_end(message.event_id)
+        while len(self._messages) > self.max_entries:
+            self._messages.popitem(last=False)
+
+    async def put(self, message: ThreadMessage) -> None:
+        """Store or replace a message."""
+        self._remember(message)
+        if self.database is None:
+            return
+        try:
+            await self.database.execute(
+                f"INSERT INTO thread_message ({self._columns}) VALUES ($1, $2, $3, $4, $5, $6) "
+                "ON CONFLICT (event_id) DO UPDATE SET parent_id=excluded.parent_id, role=excluded.role, "
+                "name=excluded.name, content=excluded.content",
+                message.event_id, message.room_id, message.parent_id,
+                message.role, message.name, message.content,
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to store thread message {message.event_id}: {e}")
+
+    async def get(self, event_id: str) -> Optional[ThreadMessage]:
+        """Get a single message, or None if it's not stored."""
+        message = self._messages.get(event_id)
+        if message is not None:
+            self._messages.move_to_end(event_id)
+            return message
+        if self.database is None:
+            return None
+        try:
+            row = await self.database.fetchrow(
+                f"SELECT {self._columns} FROM thread_message WHERE event_id=$1", event_id
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to load thread message {event_id}: {e}")
+            return None
+        if row is None:
+            return None
+        message = ThreadMessage(row["event_id"], row["room_id"], row["parent_id"],
+                                row["role"], row["name"], row["content"])
+        self._remember(message)
+        return message
+
+    async def get_chain(self, event_id: str) -> List[ThreadMessage]:
+        """Get the known part of the reply chain ending at ``event_id``, newest first.
+
+        The walk stops at the first unknown parent, which is the ``parent_id`` of
+        the last returned message. Returns an empty list if ``event_id`` is unknown.
+        """
+        chain = []
+        while event_id and len(chain) < self.max_depth:
+            message = self._messages.get(event_id)
+            if message is None:
+                break
+            self._messages.move_to_end(event_id)
+            chain.append(message)
+            event_id = message.parent_id
+        if event_id and len(chain) < self.max_depth and self.database is not None:
+            for message in await self._load_chain(event_id):
+                self._remember(message)
+                chain.append(message)
+        return chain
+
+    async def _load_chain(self, event_id: str) -> List[ThreadMessage]:
+        try:
+            rows = await self.database.fetch(
+                f"""WITH RECURSIVE chain({self._columns}, depth) AS (
+                    SELECT {self._columns}, 0 FROM thread_message WHERE event_id=$1
+                    UNION ALL
+                    SELECT t.event_id, t.room_id, t.parent_id, t.role, t.name, t.content, c.depth + 1
+                    FROM thread_message t JOIN chain c ON t.event_id=c.parent_id
+                    WHERE c.depth < $2
+                )
+                SELECT {self._columns} FROM chain ORDER BY depth""",
+                event_id, self.max_depth,
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to load reply chain of {event_id}: {e}")
+            return []
+        return [ThreadMessage(row["event_id"], row["room_id"], row["parent_id"],
+                              row["role"], row["name"], row["content"]) for row in rows]
+
+
+class ReplyStore:
+    """Final text of the bot's own replies, keyed by event id.
+
+    The homeserver only has the placeholder and the rendered edits of a reply,
+    so the clean text the model should see is kept here: in a size-bounded LRU
+    in front of the plugin database.
+    """
+
+    def __init__(self, database: Any = None, max_bytes: int = 4 * 1024 * 1024):
+        self.log = logging.getLogger("maubot.chatgpt.store")
+        self.database = database
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._replies: "OrderedDict[str, str]" = OrderedDict()
+
+    def _remember(self, event_id: str, content: str) -> None:
+        old = self._replies.pop(event_id, None)
+        if old is not None:
+            self._size -= sys.getsizeof(old)
+        self._replies[event_id] = content
+        self._size += sys.getsizeof(content)
+        while self._size > self.max_bytes and self._replies:
+            _, evicted = self._replies.popitem(last=False)
+            self._size -= sys.getsizeof(evicted)
+
+    async def get(self, event_id: str) -> Optional[str]:
+        """Get the text of a reply, or None if the bot doesn't know it."""
+        content = self._replies.get(event_id)
+        if content is not None:
+            self._replies.move_to_end(event_id)
+            return content
+        if self.database is None:
+            return None
+        try:
+            content = await self.database.fetchval(
+                "SELECT content FROM assistant_reply WHERE event_id=$1", event_id
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to load reply {event_id}: {e}")
+            return None
+        if content is not None:
+            self._remember(event_id, content)
+        return content
+
+    async def put(self, event_id: str, room_id: str, content: str) -> None:
+        """Store the final text of a reply."""
+        self._remember(event_id, content)
+        if self.database is None:
+            return
+        try:
+            await self.database.execute(
+                "INSERT INTO assistant_reply (event_id, room_id, content) VALUES ($1, $2, $3) "
+                "ON CONFLICT (event_id) DO UPDATE SET content=excluded.content",
+                event_id, room_id, content,
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to store reply {event_id}: {e}")
+
+
+class SentEvents:
+    """Ids of the events the bot sent, a bounded set backed by the plugin database.
+
+    Tells whether a message replies to the bot without fetching its parent
+    from the homeserver, also for replies that haven't been stored yet and
+    after a restart.
+    """
+
+    def __init__(self, database: Any = None, max_entries: int = 10000):
+        self.log = logging.getLogger("maubot.chatgpt.store")
+        self.database = database
+        self.max_entries = max_entries
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+    def _remember(self, event_id: str) -> None:
+        self._ids[event_id] = None
+        self._ids.move_to_end(event_id)
+        if len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+
+    async def add(self, event_id: str, room_id: str) -> None:
+        self._remember(event_id)
+        if self.database is None:
+            return
+        try:
+            await self.database.execute(
+                "INSERT INTO sent_event (event_id, room_id) VALUES ($1, $2) ON CONFLICT (event_id) DO NOTHING",
+                event_id, room_id,
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to store sent event {event_id}: {e}")
+
+    async def contains(self, event_id: str) -> bool:
+        """Whether the bot sent ``event_id``, checking the database if it's not in memory."""
+        if event_id in self._ids:
+            return True
+        if self.database is None:
+            return False
+        try:
+            found = await self.database.fetchval("SELECT 1 FROM sent_event WHERE event_id=$1", event_id)
+        except Exception as e:
+            self.log.warning(f"Failed to load sent event {event_id}: {e}")
+            return False
+        if found is not None:
+            self._remember(event_id)
+        return found is not None
@@ -0,0 +1,129 @@
+from typing import Any, Dict, List, Optional
+import html
+
+
+class _ToolCallParts:
+    __slots__ = ("id", "name", "arguments")
+
+    def __init__(self):
+        self.id: Optional[str] = None
+        self.name: Optional[str] = None
+        self.arguments: List[str] = []
+
+
+class StreamAccumulator:
+    """Collects a streamed chat completion from the typed chunk objects.
+
+    Content, reasoning and tool-call fragments are kept in separate lists, so
+    each chunk costs an append instead of copying the whole text so far. The
+    joined text is cached until the next fragment arrives.
+    """
+
+    __slots__ = ("_content", "_content_text", "_reasoning", "_reasoning_text",
+                 "_reasoning_html", "_reasoning_html_text", "_tool_calls", "_tool_index",
+                 "finish_reason", "usage", "chunks")
+
+    def __init__(self):
+        self._content: List[str] = []
+        self._content_text: Optional[str] = ""
+        self._reasoning: List[str] = []
+        self._reasoning_text: Optional[str] = ""
+        self._reasoning_html: List[str] = []
+        self._reasoning_html_text: Optional[str] = ""
+        self._tool_calls: List[_ToolCallParts] = []  # In order of appearance
+        self._tool_index: Dict[int, _ToolCallParts] = {}
+        self.finish_reason: Optional[str] = None
+        self.usage: Any = None
+        self.chunks = 0
+
+    def add(self, chunk: Any) -> bool:
+        """Add a chunk, returning True if the visible content or reasoning changed."""
+        self.chunks += 1
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return False
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        delta = choice.delta
+        if delta is None:
+            return False
+
+        changed = False
+        content = delta.content
+        if content:
+            self._content.append(content)
+            self._content_text = None
+            changed = True
+        # Not part of the OpenAI schema, the SDK keeps it as an extra field
+        reasoning = getattr(delta, "reasoning", None)
+        if reasoning:
+            self._reasoning.append(reasoning)
+            self._reasoning_html.append(html.escape(reasoning).replace("\n", "<br>"))
+            self._reasoning_text = self._reasoning_html_text = None
+            changed = True
+        if delta.tool_calls:
+            for fragment in delta.tool_calls:
+                parts = self._tool_parts(fragment)
+                if fragment.id:
+                    parts.id = fragment.id
+                function = fragment.function
+                if function is not None:
+                    if function.name:
+                        parts.name = function.name
+                    if function.arguments:
+                        parts.arguments.append(function.arguments)
+        return changed
+
+    def _tool_parts(self, fragment: Any) -> _ToolCallParts:
+        """Find the call a tool-call fragment belongs to, by index and id.
+
+        Fragments are matched by index. Some providers omit the index or reuse
+        index 0 for every call, so a fragment with a new id always starts a new
+        call and a fragment without index or id continues the latest one.
+        """
+        parts = None
+        if fragment.index is not None:
+            parts = self._tool_index.get(fragment.index)
+            if parts is not None and fragment.id and parts.id and fragment.id != parts.id:
+                parts = None
+        elif not fragment.id and self._tool_calls:
+            parts = self._tool_calls[-1]
+        if parts is None:
+            parts = _ToolCallParts()
+            self._tool_calls.append(parts)
+        if fragment.index is not None:
+            self._tool_index[fragment.index] = parts
+        return parts
+
+    @property
+    def content(self) -> str:
+        if self._content_text is None:
+            self._content_text = "".join(self._content)
+        return self._content_text
+
+    @property
+    def reasoning(self) -> str:
+        if self._reasoning_text is None:
+            self._reasoning_text = "".join(self._reasoning)
+        return self._reasoning_text
+
+    @property
+    def reasoning_html(self) -> str:
+        """The reasoning as escaped HTML with line breaks."""
+        if self._reasoning_html_text is None:
+            self._reasoning_html_text = "".join(self._reasoning_html)
+        return self._reasoning_html_text
+
+    def tool_calls(self) -> List[Dict[str, Any]]:
+        """The assembled tool calls, in the format of an assistant message's ``tool_calls``."""
+        return [
+            {
+                "id": parts.id or f"call_{index}",
+                "type": "function",
+                "function": {"name": parts.name, "arguments": "".join(parts.arguments)},
+            }
+            for index, parts in enumerate(self._tool_calls)
+            if parts.name
+        ]
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import asyncio
+import logging
+
+from .store import ThreadMessage
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a chat conversation. Extend the previous summary "
+    "with the new messages. Keep the facts, names, decisions, open questions and anything "
+    "the participants may refer back to, and drop small talk. Write in the language of the "
+    "conversation, as compact notes. Reply with the updated summary only."
+)
+
+
+class ThreadSummary:
+    """The summary of a thread, from its root up to and including ``last_event_id``."""
+
+    __slots__ = ("root_id", "last_event_id", "content")
+
+    def __init__(self, root_id: str, last_event_id: str, content: str):
+        self.root_id = root_id
+        self.last_event_id = last_event_id
+        self.content = content
+
+    def covered(self, thread: List[ThreadMessage]) -> int:
+        """How many messages of ``thread`` (oldest first) the summary covers.
+
+        Zero if the summary was made of another branch of the thread.
+        """
+        for index, message in enumerate(thread):
+            if message.event_id == self.last_event_id:
+                return index + 1
+        return 0
+
+    def to_message(self) -> dict:
+        return {"role": "system", "content": f"Summary of the earlier conversation:\n{self.content}"}
+
+
+class ThreadSummarizer:
+    """Rolling summaries of long reply threads, stored per thread root.
+
+    When the history of a thread no longer fits in the context, the turns that
+    fell out are summarized with a cheap model, and the summary is sent in
+    their place from then on. The summary is only ever extended with the turns
+    that newly fell out, never rebuilt from the whole thread.
+
+    Summaries are updated in the background, so the reply that first drops a
+    turn doesn't wait for the summarizer; the turn is in the summary of the
+    next reply.
+    """
+
+    def __init__(self, client: Any, model: str, max_tokens: int = 1000,
+                 database: Any = None, max_entries: int = 1000):
+        self.log = logging.getLogger("maubot.chatgpt.summary")
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.database = database
+        self.max_entries = max_entries
+        self._summaries: "OrderedDict[str, ThreadSummary]" = OrderedDict()
+        self._updating: Dict[str, asyncio.Task] = {}
+
+    def _remember(self, summary: ThreadSummary) -> None:
+        self._summaries[summary.root_id] = summary
+        self._summaries.move_to_end(summary.root_id)
+        while len(self._summaries) > self.max_entries:
+            self._summaries.popitem(last=False)
+
+    async def get(self, root_id: str) -> Optional[ThreadSummary]:
+        """Get the stored summary of the thread starting at ``root_id``."""
+        summary = self._summaries.get(root_id)
+        if summary is not None:
+            self._summaries.move_to_end(root_id)
+            return summary
+        if self.database is None:
+            return None
+        try:
+            row = await self.database.fetchrow(
+                "SELECT last_event_id, content FROM thread_summary WHERE root_id=$1", root_id
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to load summary of thread {root_id}: {e}")
+            return None
+        if row is None:
+            return None
+        summary = ThreadSummary(root_id, row["last_event_id"], row["content"])
+        self._remember(summary)
+        return summary
+
+    def extend_in_background(self, root_id: str, previous: Optional[ThreadSummary],
+                             messages: List[ThreadMessage]) -> None:
+        """Add ``messages``, the turns that follow ``previous``, to the summary of ``root_id``.
+
+        Does nothing if the thread's summary is already being updated; the turns
+        are still outside the context next time and get summarized then.
+        """
+        if not messages or root_id in self._updating:
+            return
+        task = asyncio.create_task(self._extend(root_id, previous, messages))
+        self._updating[root_id] = task
+        task.add_done_callback(lambda _: self._updating.pop(root_id, None))
+
+    async def _extend(self, root_id: str, previous: Optional[ThreadSummary],
+                      messages: List[ThreadMessage]) -> None:
+        turns = "\n\n".join(f"{message.name or message.role} ({message.role}): {message.content}"
+                            for message in messages)
+        prompt = f"Previous summary:\n{previous.content if previous else '(none)'}\n\nNew messages:\n{turns}"
+        try:
+            response = await self.client.create_chat_completion(
+                messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": prompt}],
+                model=self.model,
+                temperature=0.2,
+                max_tokens=self.max_tokens,
+            )
+            content = (response["choices"][0]["message"].get("content") or "").strip()
+        except Exception as e:
+            self.log.warning(f"Summarizing thread {root_id} failed: {e}")
+            return
+        if not content:
+            self.log.warning(f"Summarizer returned nothing for thread {root_id}")
+            return
+        summary = ThreadSummary(root_id, messages[-1].event_id, content)
+        self.log.debug(f"Summarized {len(messages)} more messages of thread {root_id}")
+        self._remember(summary)
+        if self.database is None:
+            return
+        try:
+            await self.database.execute(
+                "INSERT INTO thread_summary (root_id, last_event_id, content) VALUES ($1, $2, $3) "
+                "ON CONFLICT (root_id) DO UPDATE SET last_event_id=excluded.last_event_id, "
+                "content=excluded.content",
+                root_id, summary.last_event_id, summary.content,
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to store summary of thread {root_id}: {e}")
+
+    def close(self) -> None:
+        for task in self._updating.values():
+            task.cancel()
@@ -1,5 +1,6 @@
-from .weather import weather, weather_tool
-from .electricity import fetch_electricity_prices, electricity_tool, vat
+from .weather import weather, weather_tool, configure as configure_weather
+from .electricity import fetch_electricity_prices, electricity_tool, PriceStore, configure as configure_electricity
+from .runtime import ToolRuntime, ToolError
 
 # List of available tools for the bot
 available_tools = [
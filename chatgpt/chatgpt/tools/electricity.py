@@ -1,67 +1,275 @@
-import requests
+from typing import Any, Dict, List, Optional
+import asyncio
 import datetime
+import json
+import logging
+import zoneinfo
+
+import aiohttp
+
+from .runtime import ToolError
 
 # Global VAT rate, will be set by the bot
 vat = 1.0
+# Global price store, will be set by the bot
+price_store: Optional["PriceStore"] = None
+
+HELSINKI = zoneinfo.ZoneInfo("Europe/Helsinki")
+
+
+def configure(store: "PriceStore", vat_rate: float) -> None:
+    """Set the price store and VAT rate used by the tool."""
+    global price_store, vat
+    price_store = store
+    vat = vat_rate
+
+
+class PriceStore:
+    """Day-ahead spot prices keyed by date, in memory and in the plugin database.
+
+    Published prices for a date never change, so a date is only downloaded once.
+    Tomorrow's prices are prefetched in the background after they're published.
+    Only dates from yesterday on are kept in memory, older ones are loaded from
+    the database when asked for.
+    """
 
-def fetch_electricity_prices(user, date):
-    """Get electricity prices for a given date."""
-    # Define the base URL template
     url_template = "https://www.sahkohinta-api.fi/api/v1/halpa?tunnit=24&tulos=sarja&aikaraja={date}"
 
+    def __init__(self, http: aiohttp.ClientSession, database: Any = None, timeout: float = 10):
+        self.log = logging.getLogger("maubot.chatgpt.electricity")
+        self.http = http
+        self.database = database
+        self.timeout = timeout
+        self._prices: Dict[str, List[dict]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def get(self, date: str) -> Optional[List[dict]]:
+        """Get the price series of a date (YYYY-MM-DD), or None if it's not published."""
+        prices = self._prices.get(date)
+        if prices is not None:
+            return prices
+        if self.database is not None:
+            prices = await self._load(date)
+            if prices is not None:
+                self._remember(date, prices)
+                return prices
+        task = self._inflight.get(date)
+        if task is None:
+            task = asyncio.create_task(self._fetch(date))
+            self._inflight[date] = task
+            task.add_done_callback(lambda _: self._inflight.pop(date, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, date: str) -> Optional[List[dict]]:
+        url = self.url_template.format(date=date)
+        async with self.http.get(url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+            if response.status != 200:
+                self.log.debug(f"Prices for {date} not available (status code {response.status})")
+                return None
+            prices = await response.json(content_type=None)
+        if not prices:
+            return None
+        self._remember(date, prices)
+        if self.database is not None:
+            await self._save(date, prices)
+        return prices
+
+    def _remember(self, date: str, prices: List[dict]) -> None:
+        self._prices[date] = prices
+        # YYYY-MM-DD dates sort chronologically as strings
+        yesterday = (datetime.datetime.now(HELSINKI).date() - datetime.timedelta(days=1)).isoformat()
+        for old in [known for known in self._prices if known < yesterday]:
+            del self._prices[old]
+
+    async def _load(self, date: str) -> Optional[List[dict]]:
+        try:
+            data = await self.database.fetchval("SELECT data FROM electricity_price WHERE date=$1", date)
+        except Exception as e:
+            self.log.warning(f"Failed to load prices for {date} from database: {e}")
+            return None
+        return json.loads(data) if data else None
+
+    async def _save(self, date: str, prices: List[dict]) -> None:
+        try:
+            await self.database.execute(
+                "INSERT INTO electricity_price (date, data) VALUES ($1, $2) "
+                "ON CONFLICT (date) DO UPDATE SET data=excluded.data",
+                date, json.dumps(prices),
+            )
+        except Exception as e:
+            self.log.warning(f"Failed to store prices for {date} in database: {e}")
+
+    async def prefetch(self, publish_time: datetime.time, retry_interval: float = 900) -> None:
+        """Fetch tomorrow's prices every day once they're published, until cancelled."""
+        while True:
+            now = datetime.datetime.now(HELSINKI)
+            publish_at = datetime.datetime.combine(now.date(), publish_time, tzinfo=HELSINKI)
+            if now >= publish_at:
+                tomorrow = (now + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+                try:
+                    prices = await self.get(tomorrow)
+                except Exception as e:
+                    self.log.warning(f"Prefetching prices for {tomorrow} failed: {e}")
+                    prices = None
+                if prices is not None:
+                    self.log.debug(f"Prices for {tomorrow} are available")
+                    # Done for today, wait for the next publication
+                    next_day = datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                                         publish_time, tzinfo=HELSINKI)
+                    await asyncio.sleep((next_day - now).total_seconds())
+                else:
+                    await asyncio.sleep(retry_interval)
+            else:
+                await asyncio.sleep((publish_at - now).total_seconds())
+
+
+def resolve_date(date: str) -> str:
+    """Convert 'today' and 'tomorrow' to a YYYY-MM-DD date in Finnish time."""
+    today = datetime.datetime.now(HELSINKI).date()
     if date == "today":
-        # Get today's date
-        today = datetime.datetime.today()
-        date = today.strftime('%Y-%m-%d')
+        return today.strftime('%Y-%m-%d')
     elif date == "tomorrow":
-        # Get tomorrow's date
-        today = datetime.datetime.today()
-        tomorrow = today + datetime.timedelta(days=1)
-        date = tomorrow.strftime('%Y-%m-%d')
+        return (today + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    try:
+        return datetime.date.fromisoformat(date).strftime('%Y-%m-%d')
+    except ValueError:
+        raise ToolError(f"Invalid date {date!r}, use 'today', 'tomorrow' or YYYY-MM-DD")
 
-    url = url_template.format(date=date)
 
-    # Fetch the data
-    response = requests.get(url)
-    if response.status_code == 200:
-        price_data = response.json()
-    else:
-        return f"Error: Unable to fetch data for {date} (status code {response.status_code}) Maybe date is in the future? Prices for the next day are available around 14:00 UTC+2."
+def _percentile(sorted_prices: List[float], fraction: float) -> float:
+    position = fraction * (len(sorted_prices) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_prices) - 1)
+    return sorted_prices[lower] + (sorted_prices[upper] - sorted_prices[lower]) * (position - lower)
+
 
-    # Extract the 'hinta' values and convert them to floats
-    prices = [float(item['hinta'])*vat for item in price_data]
+def _bands(times: List[str], end: str, selected: List[bool]) -> List[str]:
+    """Collapse runs of selected slots into "HH:MM-HH:MM" ranges."""
+    bands = []
+    start = None
+    for i, is_selected in enumerate(selected + [False]):
+        if is_selected and start is None:
+            start = i
+        elif not is_selected and start is not None:
+            bands.append(f"{times[start]}-{times[i] if i < len(times) else end}")
+            start = None
+    return bands
 
-    # Calculate the average of 'hinta'
-    average_price = sum(prices) / len(prices)
 
-    # Now convert the parsed data into a string
-    formatted_string = f"Sähkön hinta on keskimäärin {average_price}. Kaikki hinnat ovat pyöristettyjä sentteinä. Hinnat sisältävät arvonlisäveron {round(vat*100-100,2)}%. Älä mainitse verotuksesta ellei erikseen kysytä. Kellonajat ovat Suomen aikaa. Vältä koko listan tulostamista käyttäjälle ja pyri kirjoittamaan kiinnostava kooste:\n"
+def summarize_prices(price_data: List[dict], vat_rate: float, window_hours: List[int]) -> Dict[str, Any]:
+    """Compute a compact summary of a day's price series.
+
+    Works on hourly and 15-minute series alike. The cheapest and most expensive
+    contiguous windows are found with one pass of sliding-window sums per window
+    length.
+    """
+    times = []
+    stamps = []
+    prices = []
     for entry in price_data:
-        price = round(float(entry['hinta'])*vat,2)
-        formatted_string += f"{entry['aikaleima_suomi']}: {price} c/kWh"
-        if price > average_price:
-            formatted_string += " (Kalliimpi kuin keskiarvo)"
-        elif price < average_price:
-            formatted_string += " (Halvempi kuin keskiarvo)"
-        formatted_string += "\n"
+        stamp = datetime.datetime.fromisoformat(entry["aikaleima_suomi"])
+        stamps.append(stamp)
+        times.append(stamp.strftime("%H:%M"))
+        prices.append(round(float(entry["hinta"]) * vat_rate, 3))
+
+    if len(stamps) > 1:
+        resolution = int((stamps[1] - stamps[0]).total_seconds() // 60) or 60
+    else:
+        resolution = 60
+    end = (stamps[-1] + datetime.timedelta(minutes=resolution)).strftime("%H:%M")
+    slot_time = lambda i: times[i] if i < len(times) else end
+
+    count = len(prices)
+    total = sum(prices)
+    min_index = min(range(count), key=prices.__getitem__)
+    max_index = max(range(count), key=prices.__getitem__)
+    sorted_prices = sorted(prices)
+
+    cheapest = {}
+    most_expensive = {}
+    slots_per_hour = max(60 // resolution, 1)
+    for hours in window_hours:
+        width = hours * slots_per_hour
+        if width < 1 or width > count:
+            continue
+        window = sum(prices[:width])
+        low = high = window
+        low_start = high_start = 0
+        for start in range(1, count - width + 1):
+            window += prices[start + width - 1] - prices[start - 1]
+            if window < low:
+                low, low_start = window, start
+            if window > high:
+                high, high_start = window, start
+        cheapest[f"{hours}h"] = {"start": times[low_start], "end": slot_time(low_start + width),
+                                 "avg": round(low / width, 2)}
+        most_expensive[f"{hours}h"] = {"start": times[high_start], "end": slot_time(high_start + width),
+                                       "avg": round(high / width, 2)}
+
+    # Hourly averages, also for 15-minute series, so that the model can answer about single hours.
+    # Cheap and expensive periods are hours in the lowest and highest quartile.
+    hourly = [round(sum(prices[i:i + slots_per_hour]) / len(prices[i:i + slots_per_hour]), 2)
+              for i in range(0, count, slots_per_hour)]
+    hour_times = times[::slots_per_hour]
+    sorted_hourly = sorted(hourly)
+    p25 = _percentile(sorted_hourly, 0.25)
+    p75 = _percentile(sorted_hourly, 0.75)
+
+    return {
+        "unit": "c/kWh",
+        "vat_percent": round(vat_rate * 100 - 100, 2),
+        "resolution_minutes": resolution,
+        "mean": round(total / count, 2),
+        "min": {"price": round(prices[min_index], 2), "time": times[min_index]},
+        "max": {"price": round(prices[max_index], 2), "time": times[max_index]},
+        "percentiles": {f"p{int(p * 100)}": round(_percentile(sorted_prices, p), 2)
+                        for p in (0.1, 0.25, 0.5, 0.75, 0.9)},
+        "cheap_periods": _bands(hour_times, end, [price <= p25 for price in hourly]),
+        "expensive_periods": _bands(hour_times, end, [price >= p75 for price in hourly]),
+        "cheapest_windows": cheapest,
+        "most_expensive_windows": most_expensive,
+        "hourly": hourly,
+    }
+
+
+async def fetch_electricity_prices(user, date, hours=None):
+    """Get a summary of electricity prices for a given date."""
+    date = resolve_date(date)
+    try:
+        price_data = await price_store.get(date)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise ToolError(f"Price service is unavailable and prices for {date} are not cached: {e}")
+    if price_data is None:
+        return f"Error: Unable to fetch data for {date}. Maybe date is in the future? Prices for the next day are available around 14:00 UTC+2."
 
-    return formatted_string
+    window_hours = [1, 3]
+    if hours and int(hours) not in window_hours:
+        window_hours.append(int(hours))
+    summary = summarize_prices(price_data, vat, window_hours)
+    summary["date"] = date
+    summary["note"] = ("Kellonajat ovat Suomen aikaa. Älä mainitse verotuksesta ellei erikseen kysytä. "
+                       "Vältä koko listan tulostamista käyttäjälle ja pyri kirjoittamaan kiinnostava kooste.")
+    return json.dumps(summary, ensure_ascii=False, separators=(",", ":"))
 
 # Tool definition for electricity prices
 electricity_tool = {
     "type": "function",
     "function": {
         "name": "fetch_electricity_prices",
-        "description": "Get the electricity prices in Finland in cents for a given date",
+        "description": "Get a summary of the electricity spot prices in Finland in cents per kWh for a given date: mean, min, max, percentiles, cheap and expensive periods, cheapest and most expensive 1 h and 3 h windows and hourly averages",
         "parameters": {
             "type": "object",
             "properties": {
                 "date": {
                     "type": "string",
                     "description": "The date for which to get the electricity prices (can be 'today' or 'tomorrow' or a specific date formatted as YYYY-MM-DD)",
+                },
+                "hours": {
+                    "type": "integer",
+                    "description": "Optional length in hours of an additional cheapest/most expensive window to find, e.g. for timing a 5 hour charge",
                 }
             },
             "required": ["date"],
         }
     }
-} 
+}
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+import asyncio
+import functools
+import inspect
+import json
+import logging
+
+
+class ToolError(Exception):
+    """An error a tool reports back to the model, e.g. an unknown location."""
+    pass
+
+
+class ToolRuntime:
+    """Executes tools off the event loop.
+
+    Async tools are awaited directly, sync tools run in a bounded thread pool.
+    Async tools run their blocking parts in the same pool with run_blocking().
+    Every tool call has a timeout and every tool a concurrency limit, both
+    configurable per tool. Failures are returned to the model as a JSON
+    ``{"error": {...}}`` tool result instead of raising.
+
+    A sync tool that times out keeps its worker thread until it returns, since
+    threads can't be cancelled. The pool size bounds how many can pile up.
+    """
+
+    def __init__(
+        self,
+        functions: Dict[str, Callable[..., Any]],
+        max_workers: int = 8,
+        default_timeout: float = 20.0,
+        default_concurrency: int = 4,
+        limits: Optional[Dict[str, Dict[str, Any]]] = None,
+    ):
+        self.log = logging.getLogger("maubot.chatgpt.tools")
+        self.functions = functions
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chatgpt-tool")
+        self._timeouts: Dict[str, float] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        limits = limits or {}
+        for name in functions:
+            tool_limits = limits.get(name) or {}
+            self._timeouts[name] = tool_limits.get("timeout", default_timeout)
+            self._semaphores[name] = asyncio.Semaphore(tool_limits.get("concurrency", default_concurrency))
+
+    async def call(self, name: str, arguments: Dict[str, Any]) -> str:
+        """Call a tool, returning its result or a structured error as a string."""
+        func = self.functions.get(name)
+        if func is None:
+            return self._error(name, "unknown_tool", f"Unknown tool {name}")
+        try:
+            inspect.signature(func).bind(**arguments)
+        except TypeError as e:
+            return self._error(name, "invalid_arguments", str(e))
+        try:
+            async with self._semaphores[name]:
+                result = await asyncio.wait_for(self._execute(func, arguments), self._timeouts[name])
+        except asyncio.TimeoutError:
+            self.log.warning(f"Tool {name} timed out after {self._timeouts[name]}s")
+            return self._error(name, "timeout", f"The tool didn't respond within {self._timeouts[name]} seconds")
+        except ToolError as e:
+            return self._error(name, "tool_error", str(e))
+        except Exception as e:
+            self.log.error(f"Tool {name} failed: {e}", exc_info=True)
+            return self._error(name, "internal_error", f"{type(e).__name__}: {e}")
+        return result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+
+    async def _execute(self, func: Callable[..., Any], arguments: Dict[str, Any]) -> Any:
+        if inspect.iscoroutinefunction(func):
+            return await func(**arguments)
+        return await self.run_blocking(func, **arguments)
+
+    async def run_blocking(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run a blocking function in the tool thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    @staticmethod
+    def _error(name: str, error_type: str, message: str) -> str:
+        return json.dumps({"error": {"tool": name, "type": error_type, "message": message}}, ensure_ascii=False)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
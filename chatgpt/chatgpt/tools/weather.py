@@ -1,6 +1,21 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import time
+
 import fmi_weather_client as fmi
 from fmi_weather_client.errors import ClientError, ServerError
 
+from .runtime import ToolError, ToolRuntime
+
+# Runs the blocking FMI requests in its thread pool, will be set by the bot
+runtime: Optional[ToolRuntime] = None
+
+
+def configure(tool_runtime: ToolRuntime) -> None:
+    """Set the tool runtime whose thread pool the FMI requests run in."""
+    global runtime
+    runtime = tool_runtime
+
 # Weather symbol mapping
 weather_map = {
     1: "Selkeää",
@@ -49,20 +64,71 @@ weather_map = {
     67: "Raekuuroja"
 }
 
-def weather(user, location):
-    try:
-        current_data = fmi.weather_by_place_name(location)
-    except ClientError as err:
-        print(f"Client error with status {err.status_code}: {err.message}")
-    except ServerError as err:
-        print(f"Server error with status {err.status_code}: {err.body}")
+class WeatherCache:
+    """TTL cache of FMI results keyed by normalized place name.
+
+    Entries expire at the next FMI update: observations every 10 minutes and
+    forecasts every hour. Concurrent lookups of the same key share one request.
+    """
+
+    max_entries = 256
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], Tuple[float, "asyncio.Future"]] = {}
+
+    async def get(self, kind: str, place: str, period: int, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        now = time.time()
+        key = (kind, place)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return await asyncio.shield(entry[1])
+        if len(self._entries) >= self.max_entries:
+            self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+        task = asyncio.ensure_future(fetch())
+        # Expire at the next multiple of the update period, plus a minute for FMI to publish
+        expires = now - now % period + period + 60
+        self._entries[key] = (expires, task)
+
+        def evict_failed(task: asyncio.Future) -> None:
+            # Failed and cancelled lookups are retried by the next request
+            if not task.cancelled() and task.exception() is None:
+                return
+            if self._entries.get(key, (None, None))[1] is task:
+                del self._entries[key]
+
+        task.add_done_callback(evict_failed)
+        return await asyncio.shield(task)
+
+
+cache = WeatherCache()
+
+
+def normalize_place(location: str) -> str:
+    """Normalize a place name, so that e.g. "Espoo", "espoo" and "Espoo, Finland" share a cache entry."""
+    place = " ".join(location.replace(",", ", ").split()).lower().rstrip(" ,.")
+    for suffix in (", finland", ", suomi", ", fi"):
+        if place.endswith(suffix):
+            place = place[:-len(suffix)]
+    return place
+
 
+async def weather(user, location):
+    place = normalize_place(location)
+    if not place:
+        raise ToolError("No location given")
+    query = place.title()
     try:
-        forecast_data = fmi.forecast_by_place_name(location, timestep_hours=6)
+        current_data, forecast_data = await asyncio.gather(
+            cache.get("current", place, 10 * 60, lambda: runtime.run_blocking(fmi.weather_by_place_name, query)),
+            cache.get("forecast", place, 60 * 60,
+                      lambda: runtime.run_blocking(fmi.forecast_by_place_name, query, timestep_hours=6)),
+        )
     except ClientError as err:
-        print(f"Client error with status {err.status_code}: {err.message}")
+        raise ToolError(f"Weather for {location} not found (status {err.status_code}): {err.message}")
     except ServerError as err:
-        print(f"Server error with status {err.status_code}: {err.body}")
+        raise ToolError(f"FMI server error (status {err.status_code}): {err.body}")
+    if current_data is None:
+        raise ToolError(f"No current weather available for {location}")
 
     # Extract the relevant information from the current weather data
     current_temperature = current_data.data.temperature
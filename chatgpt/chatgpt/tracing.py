@@ -0,0 +1,178 @@
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import random
+import time
+
+
+class Span:
+    """One phase of a request: its timing, attributes and child spans.
+
+    Payloads are captured as callables and only built when the trace is
+    emitted, so capturing them on a request that isn't logged costs nothing
+    but the closure.
+    """
+
+    __slots__ = ("trace", "name", "attributes", "started", "ended", "status", "error", "children", "payloads",
+                 "_token")
+
+    def __init__(self, trace: "Trace", name: str, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.started = time.monotonic()
+        self.ended: Optional[float] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.children: List["Span"] = []
+        self.payloads: List[Tuple[str, Callable[[], Any]]] = []
+        self._token = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def capture(self, name: str, payload: Callable[[], Any]) -> None:
+        """Attach a payload, built by calling ``payload`` only if the trace is emitted."""
+        if self.trace.tracer.payloads:
+            self.payloads.append((name, payload))
+
+    def span(self, name: str, **attributes: Any) -> "Span":
+        child = Span(self.trace, name, attributes)
+        self.children.append(child)
+        return child
+
+    def fail(self, error: BaseException) -> None:
+        if isinstance(error, asyncio.CancelledError):
+            self.status = "cancelled"
+            return
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+        self.trace.failed = True
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.ended = time.monotonic()
+        if exc is not None:
+            self.fail(exc)
+        _current_span.reset(self._token)
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 1),
+            "duration_ms": round(((self.ended or time.monotonic()) - self.started) * 1000, 1),
+        }
+        if self.status != "ok":
+            data["status"] = self.status
+        if self.error:
+            data["error"] = self.error
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.payloads:
+            data["payloads"] = {name: self.trace.tracer.render_payload(payload) for name, payload in self.payloads}
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+class Trace(Span):
+    """The root span of one request. Emitted when it ends if it was sampled or failed."""
+
+    __slots__ = ("tracer", "sampled", "failed")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, Any], sampled: bool):
+        self.tracer = tracer
+        self.sampled = sampled
+        self.failed = False
+        super().__init__(self, name, attributes)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        super().__exit__(exc_type, exc, tb)
+        if self.sampled or self.failed:
+            self.tracer.emit(self)
+
+
+class _NullSpan:
+    """Stands in for spans when there is no trace, every operation is a no-op."""
+
+    __slots__ = ()
+    sampled = False
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def capture(self, name: str, payload: Callable[[], Any]) -> None:
+        pass
+
+    def span(self, name: str, **attributes: Any) -> "_NullSpan":
+        return self
+
+    def fail(self, error: BaseException) -> None:
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+_current_span: ContextVar[Any] = ContextVar("chatgpt_span", default=NULL_SPAN)
+
+
+def current_span() -> Any:
+    """The innermost open span of the running task, or a no-op span outside of traces."""
+    return _current_span.get()
+
+
+def span(name: str, **attributes: Any) -> Any:
+    """Open a child span of the current span. Use as a context manager."""
+    return _current_span.get().span(name, **attributes)
+
+
+class Tracer:
+    """Records a tree of spans per request and logs a sample of them as JSON.
+
+    A ``sample_rate`` fraction of requests is logged, and every request that
+    failed. Spans only hold timings, sizes and ids; payloads such as the
+    messages sent are only kept with ``payloads``, since they contain what
+    the users wrote. They're attached lazily and only rendered for logged
+    requests, truncated to ``max_payload_chars``. Spans opened in tasks
+    started within a span nest under it, since tasks inherit the current span.
+    """
+
+    def __init__(self, enabled: bool = True, sample_rate: float = 0.01, payloads: bool = False,
+                 max_payload_chars: int = 4000):
+        self.log = logging.getLogger("maubot.chatgpt.trace")
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.payloads = payloads
+        self.max_payload_chars = max_payload_chars
+
+    def trace(self, name: str, **attributes: Any) -> Any:
+        """Start the trace of a request. Use as a context manager."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Trace(self, name, attributes, random.random() < self.sample_rate)
+
+    def render_payload(self, payload: Callable[[], Any]) -> Any:
+        try:
+            value = payload()
+        except Exception as e:
+            return f"<failed to capture: {e}>"
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+        if len(text) > self.max_payload_chars:
+            return text[:self.max_payload_chars] + f"… ({len(text)} characters)"
+        return value
+
+    def emit(self, trace: Trace) -> None:
+        data = trace.to_dict(trace.started)
+        data["sampled"] = trace.sampled
+        log = self.log.warning if trace.failed else self.log.info
+        log(json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str))
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+from pathlib import Path
+
+from mautrix.types import MessageEvent, TextMessageEventContent
+from mautrix.util.async_db import Database
+
+from chatgpt.bot import ChatGPTBot
+from chatgpt.db import upgrade_table
+from chatgpt.generations import GenerationRegistry
+from chatgpt.normalize import MessageNormalizer
+from chatgpt.scheduler import RequestScheduler
+from chatgpt.store import ReplyStore, SentEvents, ThreadStore
+from chatgpt.tracing import Tracer
+
+BOT = "@bot:example.org"
+USER = "@alice:example.org"
+OTHER = "@bob:example.org"
+ROOM = "!room:example.org"
+
+on_message = ChatGPTBot.on_message.__mb_passive_orig__
+chat_gpt_handler = ChatGPTBot.chat_gpt_handler.__mb_func__
+
+
+def make_bot() -> ChatGPTBot:
+    bot = ChatGPTBot.__new__(ChatGPTBot)
+    bot.config = {"bot-name": BOT}
+    bot.generations = GenerationRegistry()
+    bot.normalizer = MessageNormalizer(BOT)
+    bot.tracer = Tracer(enabled=False)
+    bot.sent_events = SentEvents()
+    bot.thread_store = ThreadStore()
+    bot.reply_store = ReplyStore()
+    return bot
+
+
+def edit_event(content: dict) -> MessageEvent:
+    return MessageEvent.deserialize({
+        "type": "m.room.message", "event_id": "$edit", "room_id": ROOM, "sender": USER,
+        "origin_server_ts": 1, "content": content,
+    })
+
+
+EDIT = {
+    "msgtype": "m.text",
+    "body": "* !c what is 2+2",
+    "m.new_content": {"msgtype": "m.text", "body": "!c what is 2+2"},
+    "m.relates_to": {"rel_type": "m.replace", "event_id": "$query"},
+}
+
+
+async def restart_query(evt: MessageEvent) -> str:
+    bot = make_bot()
+    generation = bot.generations.register(ROOM, "$query", "$reply", USER)
+    generation.task = asyncio.create_task(asyncio.sleep(10))
+    await on_message(bot, evt, ("",))
+    assert generation.task.cancelling() or generation.task.cancelled()
+    return generation.restart_query
+
+
+def test_edited_command_restarts_with_new_content():
+    assert asyncio.run(restart_query(edit_event(dict(EDIT)))) == "what is 2+2"
+
+
+def test_edited_command_restarts_with_new_content_of_fallback():
+    # The content as it is when m.new_content isn't swapped in by the deserializer
+    evt = edit_event(dict(EDIT))
+    evt.content = TextMessageEventContent.deserialize(dict(EDIT))
+    assert evt.content.body.startswith("* ")
+    assert asyncio.run(restart_query(evt)) == "what is 2+2"
+
+
+def test_edited_command_is_not_handled_as_a_new_command():
+    bot = make_bot()
+    requests = []
+
+    async def schedule_request(query, conversation_history, evt):
+        requests.append(query)
+
+    bot.schedule_request = schedule_request
+    evt = edit_event(dict(EDIT))
+    assert evt.content.get_edit() == "$query"
+    asyncio.run(chat_gpt_handler(bot, evt, query="what is 2+2"))
+    assert requests == []
+
+
+class FakeClient:
+    def __init__(self, *events: MessageEvent):
+        self.events = {event.event_id: event for event in events}
+        self.fetched = []
+
+    async def get_event(self, room_id: str, event_id: str) -> MessageEvent:
+        self.fetched.append(event_id)
+        return self.events[event_id]
+
+
+def message_event(event_id: str, sender: str, content: dict) -> MessageEvent:
+    return MessageEvent.deserialize({
+        "type": "m.room.message", "event_id": event_id, "room_id": ROOM, "sender": sender,
+        "origin_server_ts": 1, "content": content,
+    })
+
+
+async def open_database(path: Path) -> Database:
+    database = Database.create(f"sqlite://{path}", upgrade_table=upgrade_table)
+    await database.start()
+    return database
+
+
+async def handle_reply(path: Path, content: dict, parent: str = "$answer",
+                       sent_before_restart: bool = False) -> tuple:
+    """Handle a reply to ``parent``, a message the bot doesn't have in memory."""
+    database = await open_database(path / "bot.db")
+    if sent_before_restart:
+        await SentEvents(database).add("$answer", ROOM)
+    bot = make_bot()
+    bot.sent_events = SentEvents(database)
+    bot.thread_store = ThreadStore(database)
+    bot.client = FakeClient(message_event("$answer", BOT, {"msgtype": "m.text", "body": "4"}),
+                            message_event("$other", OTHER, {"msgtype": "m.text", "body": "5"}))
+    calls = []
+
+    async def get_conversation_history(evt, event_id):
+        calls.append(("history", event_id))
+        return []
+
+    async def schedule_request(query, conversation_history, evt):
+        calls.append(("request", query))
+
+    bot.get_conversation_history = get_conversation_history
+    bot.schedule_request = schedule_request
+    content = {"msgtype": "m.text", "m.relates_to": {"m.in_reply_to": {"event_id": parent}}, **content}
+    await on_message(bot, message_event("$question", USER, content), ("",))
+    stored = await database.fetchval("SELECT COUNT(*) FROM thread_message")
+    await database.stop()
+    return bot.client.fetched, calls, stored
+
+
+def test_reply_to_bot_message_sent_before_restart(tmp_path):
+    fetched, calls, stored = asyncio.run(handle_reply(tmp_path, {"body": "and 3+3?", "m.mentions": {}},
+                                                      sent_before_restart=True))
+    assert fetched == []
+    assert calls == [("history", "$answer"), ("request", "and 3+3?")]
+
+
+def test_reply_between_users_is_not_fetched(tmp_path):
+    content = {"body": "no, 6", "m.mentions": {"user_ids": [OTHER]}}
+    fetched, calls, stored = asyncio.run(handle_reply(tmp_path, content, parent="$other"))
+    assert (fetched, calls, stored) == ([], [], 0)
+
+
+def test_mention_replying_to_unknown_bot_message(tmp_path):
+    content = {"body": "and 3+3?", "m.mentions": {"user_ids": [BOT]}}
+    fetched, calls, stored = asyncio.run(handle_reply(tmp_path, content))
+    assert fetched == ["$answer"]
+    assert calls[0] == ("history", "$answer")
+    assert stored == 1
+
+
+def test_mention_replying_to_unknown_user_message(tmp_path):
+    content = {"body": "is 5 right?", "m.mentions": {"user_ids": [BOT]}}
+    fetched, calls, stored = asyncio.run(handle_reply(tmp_path, content, parent="$other"))
+    assert fetched == ["$other"]
+    assert calls == [("request", "is 5 right?")]
+    assert stored == 0
+
+
+def test_failed_generation_is_logged(caplog):
+    bot = make_bot()
+    bot.log = logging.getLogger("maubot.chatgpt")
+    bot.scheduler = RequestScheduler()
+
+    async def generate(ticket, generation, query, conversation_history, evt):
+        raise RuntimeError("boom")
+
+    async def reply(content, **kwargs):
+        return "$placeholder"
+
+    bot._generate = generate
+    evt = message_event("$question", USER, {"msgtype": "m.text", "body": "hi"})
+    evt.reply = reply
+    asyncio.run(bot.schedule_request("hi", [], evt))
+    errors = [record for record in caplog.records if record.levelno == logging.ERROR]
+    assert len(errors) == 1
+    assert str(errors[0].exc_info[1]) == "boom"
+    assert bot.generations.get("$placeholder") is None
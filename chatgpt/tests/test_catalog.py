@@ -0,0 +1,46 @@
+from chatgpt.catalog import ModelCatalog
+
+IDS = [
+    "openai/gpt-4o",
+    "openai/gpt-4o-mini",
+    "anthropic/claude-3.5-sonnet",
+    "meta-llama/llama-3.1-8b-instruct",
+    "meta-llama/llama-3.1-8b-instruct:free",
+    "google/gemini-flash-1.5",
+]
+
+
+def make_catalog() -> ModelCatalog:
+    return ModelCatalog({"data": [{"id": model_id} for model_id in IDS] + [{"name": "no id"}]})
+
+
+def test_exact_ids_and_names_resolve_directly():
+    catalog = make_catalog()
+    assert len(catalog) == len(IDS)
+    assert "openai/gpt-4o" in catalog
+    assert catalog.resolve("openai/gpt-4o-mini") == "openai/gpt-4o-mini"
+    # The name without the vendor prefix, in any case
+    assert catalog.resolve("GPT-4o") == "openai/gpt-4o"
+
+
+def test_fuzzy_lookup_through_the_trigram_index():
+    catalog = make_catalog()
+    assert catalog.resolve("claude-sonnet") == "anthropic/claude-3.5-sonnet"
+    assert catalog.resolve("gemini-flash") == "google/gemini-flash-1.5"
+    assert catalog.resolve("llama-8b") == "meta-llama/llama-3.1-8b-instruct"
+    # No trigram in common
+    assert catalog.resolve("xyz") is None
+
+
+def test_lookups_are_memoized():
+    catalog = make_catalog()
+    assert catalog.resolve("claude-sonnet") == "anthropic/claude-3.5-sonnet"
+    catalog._trigrams.clear()
+    assert catalog.resolve("claude-sonnet") == "anthropic/claude-3.5-sonnet"
+
+
+def test_free_variant():
+    catalog = make_catalog()
+    assert catalog.free_variant("meta-llama/llama-3.1-8b-instruct") == "meta-llama/llama-3.1-8b-instruct:free"
+    assert catalog.free_variant("meta-llama/llama-3.1-8b-instruct:free") == "meta-llama/llama-3.1-8b-instruct:free"
+    assert catalog.free_variant("openai/gpt-4o") is None
@@ -0,0 +1,52 @@
+from chatgpt.context import TokenCounter, cache_breakpoints, context_budget, pack_messages
+
+
+def message(role: str, content: str) -> dict:
+    return {"role": role, "content": content}
+
+
+SYSTEM = message("system", "You are a chatbot.")
+HISTORY = [message("user" if i % 2 == 0 else "assistant", f"message number {i} " + "word " * 20) for i in range(6)]
+QUERY = message("user", "What now?")
+
+
+def test_context_budget():
+    assert context_budget(128000, reserve_tokens=4000) == 124000
+    assert context_budget(None, default_length=8192, reserve_tokens=192) == 8000
+    assert context_budget(128000, max_tokens=16000, reserve_tokens=4000) == 16000
+    assert context_budget(1000, reserve_tokens=4000) == 0
+
+
+def test_everything_is_kept_within_the_budget():
+    counter = TokenCounter()
+    messages = [SYSTEM] + HISTORY + [QUERY]
+    assert pack_messages(messages, counter.count_messages(messages), counter) == messages
+
+
+def test_oldest_history_is_dropped_when_over_the_budget():
+    counter = TokenCounter()
+    messages = [SYSTEM] + HISTORY + [QUERY]
+    # Room for the two newest history messages and a bit, but not a third one
+    budget = counter.count_messages([SYSTEM] + HISTORY[-2:] + [QUERY]) + counter.count_message(HISTORY[-3]) - 1
+    assert pack_messages(messages, budget, counter) == [SYSTEM] + HISTORY[-2:] + [QUERY]
+
+
+def test_fixed_messages_are_kept_even_over_the_budget():
+    counter = TokenCounter()
+    summary = message("system", "Summary of the earlier conversation.")
+    messages = [SYSTEM, summary] + HISTORY + [QUERY]
+    assert pack_messages(messages, 0, counter) == [SYSTEM, summary, QUERY]
+
+
+def test_message_counts_are_memoized():
+    counter = TokenCounter(max_entries=2)
+    for item in HISTORY[:3]:
+        counter.count_message(item)
+    assert len(counter._counts) == 2
+    assert counter.count_message(dict(HISTORY[2], name="alice")) > counter.count_message(HISTORY[2])
+
+
+def test_cache_breakpoints_end_the_stable_prefixes():
+    messages = [SYSTEM] + HISTORY + [QUERY]
+    assert cache_breakpoints(messages) == [0, len(HISTORY)]
+    assert cache_breakpoints([SYSTEM, QUERY]) == [0]
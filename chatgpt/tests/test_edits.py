@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from mautrix.errors import MLimitExceeded
+
+from chatgpt.bot import ChatGPTBot
+from chatgpt.edits import EditScheduler
+from chatgpt.metrics import Metrics
+
+ROOM = "!room:example.org"
+
+
+class Recorder:
+    """Send function recording the edits, optionally failing the first ones."""
+
+    def __init__(self, failures: list = ()):
+        self.failures = list(failures)
+        self.sent = []
+
+    async def __call__(self, room_id, event_id, text, html=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((time.monotonic(), text))
+
+
+def preview(text: str, built: list):
+    def build():
+        built.append(text)
+        return text, None
+    return build
+
+
+def test_pending_previews_are_coalesced_into_the_latest():
+    async def run():
+        send = Recorder()
+        session = EditScheduler(send, min_interval=0.05, max_interval=0.05).session(ROOM, "$reply")
+        built = []
+        for text in ("a", "ab", "abc"):
+            session.update(preview(text, built))
+        await asyncio.sleep(0.01)
+        for text in ("abcd", "abcde"):
+            session.update(preview(text, built))
+        await asyncio.sleep(0.1)
+        await session.close()
+        return built, [text for _, text in send.sent], session.edits
+
+    built, sent, edits = asyncio.run(run())
+    # Only the previews that were actually sent are built
+    assert built == sent == ["abc", "abcde"]
+    assert edits == 2
+
+
+def test_rate_limited_edit_backs_off():
+    class Client:
+        def __init__(self):
+            self.calls = []
+
+        async def send_message(self, room_id, content):
+            self.calls.append(time.monotonic())
+            if len(self.calls) == 1:
+                raise MLimitExceeded(429, "Too Many Requests")
+
+    async def run():
+        bot = ChatGPTBot.__new__(ChatGPTBot)
+        bot.client = Client()
+        bot.metrics = Metrics()
+        scheduler = EditScheduler(bot._edit, min_interval=0.05)
+        session = scheduler.session(ROOM, "$reply")
+        await session.flush("final")
+        await session.close()
+        return bot.client.calls, bot.metrics.rate_limited.samples(), session.edits
+
+    calls, rate_limited, edits = asyncio.run(run())
+    assert len(calls) == 2
+    # The retry waits out the backoff of the room
+    assert calls[1] - calls[0] >= 0.05
+    assert rate_limited == ["chatgpt_edits_rate_limited_total 1"]
+    assert edits == 1
+
+
+def test_flush_drops_pending_previews_and_sends_the_final_edit():
+    async def run():
+        send = Recorder(failures=[RuntimeError("connection reset")])
+        scheduler = EditScheduler(send, min_interval=10, max_interval=10, final_attempts=2)
+        session = scheduler.session(ROOM, "$reply")
+        built = []
+        session.update(preview("preview", built))
+        await asyncio.sleep(0.01)
+        # The failed preview is dropped, the next one waits for the interval
+        session.update(preview("newer preview", built))
+        await session.flush("final")
+        await session.close()
+        return built, [text for _, text in send.sent], session.edits, scheduler._rooms
+
+    built, sent, edits, rooms = asyncio.run(run())
+    assert built == ["preview"]
+    assert sent == ["final"]
+    assert edits == 1
+    # The room is released once its last session is closed
+    assert rooms == {}
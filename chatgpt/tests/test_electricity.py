@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+
+from chatgpt.tools.electricity import HELSINKI, PriceStore, summarize_prices
+
+
+def series(prices: list, minutes: int = 60) -> list:
+    start = datetime.datetime(2025, 1, 1)
+    return [{"aikaleima_suomi": (start + datetime.timedelta(minutes=minutes * i)).isoformat(), "hinta": str(price)}
+            for i, price in enumerate(prices)]
+
+
+# Cheap at night, expensive in the evening
+HOURLY = [2, 1, 1, 1, 2, 3, 5, 8, 9, 7, 6, 5, 5, 5, 6, 7, 9, 12, 14, 13, 10, 8, 5, 3]
+
+
+def test_summarize_hourly_prices():
+    summary = summarize_prices(series(HOURLY), 1.0, [1, 3])
+    assert summary["resolution_minutes"] == 60
+    assert summary["min"] == {"price": 1, "time": "01:00"}
+    assert summary["max"] == {"price": 14, "time": "18:00"}
+    assert summary["cheapest_windows"]["3h"] == {"start": "01:00", "end": "04:00", "avg": 1}
+    assert summary["most_expensive_windows"]["3h"] == {"start": "17:00", "end": "20:00", "avg": 13}
+    assert summary["hourly"] == HOURLY
+    assert summary["expensive_periods"] == ["08:00-09:00", "16:00-21:00"]
+
+
+def test_summarize_quarter_hour_prices():
+    # The same day at 15-minute resolution, with the last slot of every hour doubled
+    quarters = [price * (2 if slot == 3 else 1) for price in HOURLY for slot in range(4)]
+    summary = summarize_prices(series(quarters, minutes=15), 1.255, [1])
+    assert summary["resolution_minutes"] == 15
+    assert summary["vat_percent"] == 25.5
+    assert len(summary["hourly"]) == 24
+    assert summary["hourly"][1] == round(1.255 * 5 / 4, 2)
+    # Windows are whole hours, but can start at any quarter
+    assert summary["cheapest_windows"]["1h"] == {"start": "01:00", "end": "02:00", "avg": round(1.255 * 5 / 4, 2)}
+    assert summary["max"]["time"] == "18:45"
+    assert summary["cheap_periods"][-1].endswith("00:00")
+
+
+def test_windows_longer_than_the_day_are_skipped():
+    summary = summarize_prices(series(HOURLY), 1.0, [1, 5, 25])
+    assert list(summary["cheapest_windows"]) == ["1h", "5h"]
+    assert summary["cheapest_windows"]["5h"]["start"] == "00:00"
+
+
+class FakeResponse:
+    status = 200
+
+    def __init__(self, prices):
+        self.prices = prices
+
+    async def json(self, content_type=None):
+        return self.prices
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeHttp:
+    def get(self, url, timeout):
+        return FakeResponse(series(HOURLY))
+
+
+def test_price_store_forgets_dates_before_yesterday():
+    today = datetime.datetime.now(HELSINKI).date()
+    dates = [(today + datetime.timedelta(days=offset)).isoformat() for offset in (-3, -2, -1, 0, 1)]
+
+    async def run():
+        store = PriceStore(FakeHttp())
+        for date in dates:
+            await store.get(date)
+        return sorted(store._prices)
+
+    assert asyncio.run(run()) == dates[2:]
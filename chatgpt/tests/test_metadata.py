@@ -0,0 +1,78 @@
+import asyncio
+
+import httpx
+
+from chatgpt.metadata import ModelInfo, ModelMetadataCache
+
+ENDPOINTS = {"data": {"endpoints": [
+    {"pricing": {"prompt": "0.000002", "completion": "0.000008"}, "context_length": 128000,
+     "supported_parameters": ["tools", "temperature"]},
+    {"pricing": {"prompt": "0.000001", "completion": "bad"}, "context_length": 64000,
+     "max_completion_tokens": 4096, "supported_parameters": ["temperature"]},
+]}}
+
+
+class Fetcher:
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    async def __call__(self, model: str) -> dict:
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return ENDPOINTS
+
+
+def age(cache: ModelMetadataCache, model: str, seconds: float) -> None:
+    cache._entries[model].fetched_at -= seconds
+
+
+def test_endpoints_are_merged():
+    info = ModelInfo.from_endpoints("openai/gpt-4o", ENDPOINTS)
+    assert (info.prompt_price, info.completion_price) == (0.000001, 0.000008)
+    assert (info.context_length, info.max_completion_tokens) == (128000, 4096)
+    assert info.supports_tools
+    assert ModelInfo.from_json(info.model, info.to_json(), info.fetched_at).supported_parameters == {
+        "tools", "temperature"}
+
+
+def test_entries_expire_after_the_ttl():
+    async def run():
+        fetch = Fetcher()
+        cache = ModelMetadataCache(fetch, ttl=60, max_stale=600)
+        await cache.get("model")
+        await cache.get("model")
+        assert fetch.calls == 1
+
+        # Stale: served right away and refreshed in the background, once
+        age(cache, "model", 120)
+        stale = await cache.get("model")
+        await cache.get("model")
+        assert stale.age() >= 120
+        await asyncio.sleep(0)
+        assert fetch.calls == 2
+        assert (await cache.get("model")).age() < 60
+
+        # Expired: refreshed before returning, the old entry is the fallback if that fails
+        age(cache, "model", 1200)
+        fetch.error = httpx.ConnectError("down")
+        assert (await cache.get("model")).age() >= 1200
+        assert fetch.calls == 3
+        return cache.lookups
+
+    assert asyncio.run(run()) == {"fresh": 2, "stale": 2, "miss": 2}
+
+
+def test_unknown_models_are_cached_as_missing():
+    async def run():
+        fetch = Fetcher()
+        request = httpx.Request("GET", "https://openrouter.ai/api/v1/models/nope/endpoints")
+        fetch.error = httpx.HTTPStatusError("not found", request=request,
+                                            response=httpx.Response(404, request=request))
+        cache = ModelMetadataCache(fetch)
+        first = await cache.get("nope")
+        second = await cache.get("nope")
+        return first.exists, second is first, fetch.calls
+
+    assert asyncio.run(run()) == (False, True, 1)
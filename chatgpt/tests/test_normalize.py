@@ -0,0 +1,67 @@
+from mautrix.types import TextMessageEventContent
+from mautrix.util import markdown
+
+from chatgpt.normalize import MessageNormalizer, html_to_markdown, strip_reply_fallback
+
+BOT = "@bot:example.org"
+
+MARKDOWN = """# Title
+
+Some **bold**, *italic*, ~~gone~~ and `code` with a [link](https://example.org).
+
+- one
+- two
+  - nested
+
+1. first
+2. second
+
+> quoted text
+
+```
+def f():
+    return 1
+```"""
+
+
+def html_content(formatted_body: str, body: str = "", **extra) -> TextMessageEventContent:
+    return TextMessageEventContent.deserialize({
+        "msgtype": "m.text", "body": body, "format": "org.matrix.custom.html", "formatted_body": formatted_body,
+        **extra,
+    })
+
+
+def test_markdown_round_trips_through_html():
+    html = markdown.render(MARKDOWN, allow_html=True)
+    assert html_to_markdown(html) == MARKDOWN
+    # Soft line breaks collapse, which renders the same
+    html = markdown.render("> quoted\n> text", allow_html=True)
+    assert markdown.render(html_to_markdown(html), allow_html=True) == html.replace("quoted\ntext", "quoted text")
+
+
+def test_reply_fallbacks_and_mentions_are_dropped():
+    normalizer = MessageNormalizer(BOT)
+    content = html_content(
+        '<mx-reply><blockquote><a href="https://matrix.to/#/$parent">In reply to</a> earlier</blockquote></mx-reply>'
+        f'<a href="https://matrix.to/#/{BOT}">bot</a>: what about <b>this</b>?',
+        **{"m.relates_to": {"m.in_reply_to": {"event_id": "$parent"}}},
+    )
+    assert normalizer.normalize(content) == ("what about **this**?", True)
+    assert normalizer.mentions_bot(content)
+
+
+def test_plain_replies_lose_their_quote():
+    assert strip_reply_fallback("> <@alice:example.org> earlier\n> more\n\nthe answer") == "\nthe answer"
+    content = TextMessageEventContent.deserialize({
+        "msgtype": "m.text", "body": "> <@alice:example.org> earlier\n\nthe answer  \n\n\n\nend",
+        "m.relates_to": {"m.in_reply_to": {"event_id": "$parent"}},
+    })
+    assert MessageNormalizer(BOT).normalize(content) == ("the answer\n\nend", False)
+
+
+def test_mentions_of_others_are_not_the_bot():
+    normalizer = MessageNormalizer(BOT)
+    assert not normalizer.mentions_bot(html_content('<a href="https://matrix.to/#/@alice:example.org">alice</a>: hi'))
+    # m.mentions is authoritative
+    assert not normalizer.mentions_bot(html_content(f'<a href="https://matrix.to/#/{BOT}">bot</a>: hi',
+                                                    **{"m.mentions": {}}))
@@ -0,0 +1,72 @@
+import asyncio
+
+from chatgpt.router import LatencyRouter
+
+
+class FakeStream:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.closed = False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        yield "chunk"
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self, delays: dict):
+        self.delays = delays
+        self.streams = {}
+
+    async def create_chat_completion(self, model, stream, **kwargs):
+        self.streams[model] = FakeStream(self.delays[model])
+        return self.streams[model]
+
+    async def check_model_pricing(self, model):
+        return {"is_allowed": True}
+
+
+def make_router(client, **kwargs) -> LatencyRouter:
+    return LatencyRouter(client, fallback_models=["fast"], min_deadline=0.05, max_deadline=0.5,
+                         default_deadline=0.05, min_samples=4, **kwargs)
+
+
+def test_deadline_follows_the_ttft_percentile():
+    router = make_router(FakeClient({}), percentile=0.5)
+    assert router.deadline("slow") == 0.05
+    for ttft in (0.1, 0.2, 0.3):
+        router.stats("slow").record(ttft)
+    # Too few samples yet
+    assert router.deadline("slow") == 0.05
+    router.stats("slow").record(0.4)
+    assert router.deadline("slow") == 0.3
+    for ttft in (2, 3, 4, 5):
+        router.stats("slow").record(ttft)
+    assert router.deadline("slow") == 0.5
+    for _ in range(9):
+        router.stats("slow").record(None)
+    # Mostly failing, hedged from the start
+    assert router.deadline("slow") == 0.0
+
+
+def test_slow_model_is_hedged_and_cancelled():
+    async def run():
+        client = FakeClient({"slow": 1.0, "fast": 0.01})
+        router = make_router(client)
+        stream = await router.create_stream(model="slow", messages=[])
+        chunks = [chunk async for chunk in stream]
+        await asyncio.sleep(0.01)
+        return stream.model, chunks, client.streams["slow"].closed, router
+
+    model, chunks, slow_closed, router = asyncio.run(run())
+    assert (model, chunks) == ("fast", ["chunk"])
+    # The losing stream is closed
+    assert slow_closed
+    # Its wait counts as its TTFT, at least the deadline it missed
+    assert len(router.stats("slow").ttfts) == 1
+    assert router.stats("slow").ttfts[0] >= 0.05
+    assert router.stats("slow").error_rate() == 0.0
+    assert len(router.stats("fast").ttfts) == 1
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from chatgpt.scheduler import QueueFull, RequestScheduler
+
+
+async def finish(ticket) -> None:
+    await ticket.__aexit__(None, None, None)
+
+
+async def serve(scheduler: RequestScheduler, running, queued: list) -> list:
+    """Finish the running request and then each started one, returning the order they started in."""
+    order = []
+    while True:
+        await finish(running)
+        started = [ticket for ticket in queued if ticket.future.done() and ticket not in order]
+        if not started:
+            return order
+        assert len(started) == 1
+        running = started[0]
+        order.append(running)
+
+
+def labels(tickets: list) -> list:
+    return [f"{ticket.room_id}/{ticket.user_id}" for ticket in tickets]
+
+
+def test_slots_go_round_robin_over_rooms():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=1)
+        running = scheduler.enqueue("!busy", "@a")
+        queued = [scheduler.enqueue(room, "@a") for room in ("!busy", "!busy", "!busy", "!quiet", "!other")]
+        return labels(await serve(scheduler, running, queued))
+
+    assert asyncio.run(run()) == ["!busy/@a", "!quiet/@a", "!other/@a", "!busy/@a", "!busy/@a"]
+
+
+def test_slots_go_round_robin_over_users_of_a_room_in_order():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=1)
+        running = scheduler.enqueue("!room", "@a")
+        queued = [scheduler.enqueue("!room", user) for user in ("@a", "@a", "@b")]
+        order = await serve(scheduler, running, queued)
+        # The requests of a user keep their order
+        assert order.index(queued[0]) < order.index(queued[1])
+        return labels(order)
+
+    assert asyncio.run(run()) == ["!room/@a", "!room/@b", "!room/@a"]
+
+
+def test_room_that_drops_out_doesnt_stall_the_others():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=1)
+        running = scheduler.enqueue("!a", "@a")
+        gone = scheduler.enqueue("!gone", "@g")
+        queued = [scheduler.enqueue(room, "@u") for room in ("!a", "!b", "!a", "!b")]
+        # Leaving before getting a slot gives up the place in the queue
+        await finish(gone)
+        assert scheduler.queued == 4
+        order = await serve(scheduler, running, queued)
+        assert not gone.future.done() or gone.future.cancelled()
+        assert (scheduler.running, scheduler.queued) == (0, 0)
+        return labels(order)
+
+    assert asyncio.run(run()) == ["!a/@u", "!b/@u", "!a/@u", "!b/@u"]
+
+
+def test_full_queue_rejects_requests():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=1, max_queued=1)
+        scheduler.enqueue("!room", "@a")
+        scheduler.enqueue("!room", "@a")
+        with pytest.raises(QueueFull):
+            scheduler.enqueue("!other", "@b")
+        return scheduler.rejected
+
+    assert asyncio.run(run()) == 1
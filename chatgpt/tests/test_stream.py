@@ -0,0 +1,63 @@
+from openai._models import construct_type
+from openai.types.chat import ChatCompletionChunk
+
+from chatgpt.stream import StreamAccumulator
+
+
+def chunk(delta: dict = None, finish_reason: str = None, usage: dict = None) -> ChatCompletionChunk:
+    choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    # Built like the SDK builds streamed chunks, without validation, so providers' deviations show
+    return construct_type(type_=ChatCompletionChunk, value={
+        "id": "gen", "object": "chat.completion.chunk", "created": 1, "model": "model",
+        "choices": choices, "usage": usage,
+    })
+
+
+def call(index=None, id=None, name=None, arguments=None) -> dict:
+    function = {key: value for key, value in (("name", name), ("arguments", arguments)) if value is not None}
+    return {"index": index, "id": id, "type": "function" if id else None, "function": function}
+
+
+def collect(*chunks: ChatCompletionChunk) -> StreamAccumulator:
+    acc = StreamAccumulator()
+    for item in chunks:
+        acc.add(item)
+    return acc
+
+
+def test_content_and_reasoning_are_joined():
+    acc = StreamAccumulator()
+    assert acc.add(chunk({"role": "assistant", "reasoning": "a < b\n"}))
+    assert acc.add(chunk({"content": "Hello"}))
+    assert acc.content == "Hello"
+    assert acc.add(chunk({"content": ", world"}))
+    assert not acc.add(chunk({}, finish_reason="stop"))
+    assert not acc.add(chunk(usage={"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13}))
+    assert (acc.content, acc.reasoning, acc.reasoning_html) == ("Hello, world", "a < b\n", "a &lt; b<br>")
+    assert (acc.finish_reason, acc.usage.completion_tokens, acc.chunks) == ("stop", 3, 5)
+
+
+def test_tool_call_deltas_are_assembled_by_index():
+    acc = collect(
+        chunk({"tool_calls": [call(0, "call_a", "weather", '{"loc'), call(1, "call_b", "weather", "")]}),
+        chunk({"tool_calls": [call(1, arguments='{"location": "Oulu"}')]}),
+        chunk({"tool_calls": [call(0, arguments='ation": "Espoo"}')]}, finish_reason="tool_calls"),
+    )
+    assert acc.tool_calls() == [
+        {"id": "call_a", "type": "function", "function": {"name": "weather", "arguments": '{"location": "Espoo"}'}},
+        {"id": "call_b", "type": "function", "function": {"name": "weather", "arguments": '{"location": "Oulu"}'}},
+    ]
+
+
+def test_tool_calls_reusing_an_index_or_without_one():
+    acc = collect(
+        # Every call at index 0, told apart by their ids
+        chunk({"tool_calls": [call(0, "call_a", "weather", '{"location": "Espoo"}')]}),
+        chunk({"tool_calls": [call(0, "call_b", "fetch_electricity_prices", '{"date": ')]}),
+        # No index or id: continues the latest call
+        chunk({"tool_calls": [call(arguments='"today"}')]}),
+        # A name is needed for a call to count
+        chunk({"tool_calls": [call(id="call_c")]}),
+    )
+    assert [(c["id"], c["function"]["arguments"]) for c in acc.tool_calls()] == [
+        ("call_a", '{"location": "Espoo"}'), ("call_b", '{"date": "today"}')]
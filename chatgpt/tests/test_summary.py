@@ -0,0 +1,79 @@
+import asyncio
+
+from chatgpt.bot import ChatGPTBot
+from chatgpt.context import TokenCounter
+from chatgpt.store import ThreadMessage
+from chatgpt.summary import ThreadSummarizer, ThreadSummary
+
+SYSTEM = {"role": "system", "content": "You are a chatbot."}
+QUERY = {"role": "user", "name": "alice", "content": "And what did we decide?"}
+THREAD = [ThreadMessage(f"$e{i}", "!room", f"$e{i - 1}" if i else None, "user" if i % 2 == 0 else "assistant",
+                        "alice" if i % 2 == 0 else "bot", f"turn {i} " + "word " * 30) for i in range(6)]
+
+
+class FakeClient:
+    def __init__(self):
+        self.prompts = []
+
+    async def create_chat_completion(self, messages, model, **kwargs):
+        self.prompts.append(messages[-1]["content"])
+        return {"choices": [{"message": {"content": f"summary {len(self.prompts)}"}}]}
+
+
+def make_bot(budget: int) -> ChatGPTBot:
+    bot = ChatGPTBot.__new__(ChatGPTBot)
+    bot.summarizer = ThreadSummarizer(FakeClient(), model="cheap")
+    bot.token_counter = TokenCounter()
+
+    async def context_budget(model):
+        return budget
+
+    bot._context_budget = context_budget
+    return bot
+
+
+def messages() -> list:
+    return [SYSTEM] + [message.to_message() for message in THREAD] + [QUERY]
+
+
+def test_covered_turns():
+    summary = ThreadSummary("$e0", "$e2", "notes")
+    assert summary.covered(THREAD) == 3
+    assert ThreadSummary("$e0", "$elsewhere", "notes").covered(THREAD) == 0
+
+
+def test_thread_within_the_budget_is_sent_whole():
+    async def run():
+        bot = make_bot(100000)
+        packed = await bot._fit_context(messages(), THREAD, "model")
+        await asyncio.sleep(0)
+        return packed, bot.summarizer.client.prompts
+
+    packed, prompts = asyncio.run(run())
+    assert packed == messages()
+    assert prompts == []
+
+
+def test_turns_over_the_budget_are_summarized_and_replaced():
+    counter = TokenCounter()
+    # Room for the last two turns and the summary, but not for a third turn
+    summary_message = ThreadSummary("$e0", "$e3", "summary 1").to_message()
+    budget = counter.count_messages([SYSTEM, summary_message] + messages()[-3:])
+
+    async def run():
+        bot = make_bot(budget)
+        first = await bot._fit_context(messages(), THREAD, "model")
+        await asyncio.sleep(0.01)
+        summary = await bot.summarizer.get("$e0")
+        second = await bot._fit_context(messages(), THREAD, "model")
+        await asyncio.sleep(0.01)
+        return first, summary, second, bot.summarizer.client.prompts
+
+    first, summary, second, prompts = asyncio.run(run())
+    assert first == [SYSTEM] + messages()[-3:]
+    # The dropped turns are summarized in the background, once
+    assert len(prompts) == 1
+    assert "turn 3" in prompts[0] and "turn 4" not in prompts[0]
+    assert (summary.last_event_id, summary.content) == ("$e3", "summary 1")
+    # and sent in their place next time
+    assert second == [SYSTEM, summary.to_message()] + messages()[-3:]
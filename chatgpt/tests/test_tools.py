@@ -0,0 +1,100 @@
+import asyncio
+import importlib
+import json
+import threading
+import time
+
+from chatgpt.tools.runtime import ToolError, ToolRuntime
+from chatgpt.tools.weather import WeatherCache
+
+# The package exports the tool function under the module's name
+weather_tool = importlib.import_module("chatgpt.tools.weather")
+
+
+def blocking_tool(user):
+    time.sleep(0.05)
+    return threading.current_thread().name
+
+
+async def failing_tool(user):
+    raise ToolError("No such place")
+
+
+def test_blocking_calls_share_the_bounded_pool():
+    async def run():
+        runtime = ToolRuntime({"blocking": blocking_tool}, max_workers=1, default_concurrency=4)
+        try:
+            return await asyncio.gather(
+                runtime.call("blocking", {"user": "alice"}),
+                runtime.run_blocking(blocking_tool, "alice"),
+            )
+        finally:
+            runtime.shutdown()
+
+    started = time.monotonic()
+    assert asyncio.run(run()) == ["chatgpt-tool_0", "chatgpt-tool_0"]
+    # A single worker runs them one after the other
+    assert time.monotonic() - started >= 0.1
+
+
+def test_errors_are_returned_to_the_model():
+    async def run():
+        runtime = ToolRuntime({"failing": failing_tool, "blocking": blocking_tool}, default_timeout=0.01)
+        try:
+            return [json.loads(result)["error"]["type"] for result in await asyncio.gather(
+                runtime.call("failing", {"user": "alice"}),
+                runtime.call("blocking", {"user": "alice"}),
+                runtime.call("blocking", {"user": "alice", "place": "Espoo"}),
+                runtime.call("missing", {}),
+            )]
+        finally:
+            runtime.shutdown()
+
+    assert asyncio.run(run()) == ["tool_error", "timeout", "invalid_arguments", "unknown_tool"]
+
+
+def test_weather_cache_shares_lookups_and_evicts_cancelled_ones():
+    async def run():
+        cache = WeatherCache()
+        fetches = []
+
+        async def fetch():
+            fetches.append(None)
+            await asyncio.sleep(0.01)
+            return len(fetches)
+
+        assert await asyncio.gather(cache.get("current", "espoo", 600, fetch),
+                                    cache.get("current", "espoo", 600, fetch)) == [1, 1]
+        lookup = asyncio.ensure_future(cache.get("forecast", "espoo", 3600, fetch))
+        await asyncio.sleep(0)
+        cache._entries[("forecast", "espoo")][1].cancel()
+        await asyncio.gather(lookup, return_exceptions=True)
+        # Fetched again instead of raising CancelledError until the entry expires
+        return await cache.get("forecast", "espoo", 3600, fetch)
+
+    assert asyncio.run(run()) == 2
+
+
+def test_weather_requests_run_in_the_tool_pool(monkeypatch):
+    threads = []
+
+    def weather_by_place_name(place):
+        threads.append(threading.current_thread().name)
+
+    def forecast_by_place_name(place, timestep_hours):
+        threads.append(threading.current_thread().name)
+
+    monkeypatch.setattr(weather_tool.fmi, "weather_by_place_name", weather_by_place_name)
+    monkeypatch.setattr(weather_tool.fmi, "forecast_by_place_name", forecast_by_place_name)
+    monkeypatch.setattr(weather_tool, "cache", WeatherCache())
+
+    async def run():
+        runtime = ToolRuntime({"weather": weather_tool.weather})
+        weather_tool.configure(runtime)
+        try:
+            return json.loads(await runtime.call("weather", {"user": "alice", "location": "Espoo, Finland"}))
+        finally:
+            runtime.shutdown()
+
+    assert asyncio.run(run())["error"]["message"] == "No current weather available for Espoo, Finland"
+    assert [name.startswith("chatgpt-tool") for name in threads] == [True, True]